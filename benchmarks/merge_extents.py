@@ -0,0 +1,56 @@
+#!/usr/bin/env python2
+"""Measure how long ``merge_extents()`` and ``fix_extents_overlap()`` take
+over synthetic streams of extents
+
+For each size, makes that many hits spread over a few streams, the way a
+regexp search plus a couple of structural filters would produce them for one
+big file, and times merging them. The hits of the first stream overlap each
+other, like raw trilite extents do, and are run through
+``fix_extents_overlap()`` first.
+
+Usage: merge_extents.py [number of streams (default: 3)]
+
+"""
+from random import randint, seed
+from sys import argv
+from time import time
+
+from dxr.query import fix_extents_overlap, merge_extents
+
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+
+def stream(hits, overlapping):
+    """Return a sorted list of ``hits`` (start, end, keys) extents."""
+    extents = []
+    start = 0
+    for _ in xrange(hits):
+        start += randint(0, 3) if overlapping else randint(8, 40)
+        extents.append((start, start + randint(1, 8), []))
+    return extents
+
+
+def main():
+    streams = int(argv[1]) if len(argv) > 1 else 3
+    seed(0)
+    print '%10s %12s %12s' % ('hits', 'fix (s)', 'merge (s)')
+    for size in SIZES:
+        per_stream = size // streams
+        raw = stream(per_stream, True)
+        others = [stream(per_stream, False) for _ in xrange(streams - 1)]
+
+        start = time()
+        fixed = list(fix_extents_overlap(raw))
+        fixing = time() - start
+
+        start = time()
+        for _ in merge_extents(iter(fixed), *[iter(o) for o in others]):
+            pass
+        merging = time() - start
+
+        print '%10d %12.3f %12.3f' % (size, fixing, merging)
+
+
+if __name__ == '__main__':
+    main()
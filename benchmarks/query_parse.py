@@ -0,0 +1,65 @@
+#!/usr/bin/env python2
+"""Measure how fast search queries are parsed, with and without the parse
+cache
+
+Reads queries from a file and parses each of them, first from scratch, the
+way every ``Query`` used to, and then through ``parsed_terms()``, whose cache
+has room for this many distinct queries: 1000. The file can be a web server
+access log, in which case the ``q`` param of each request to a search URL is
+used, or a plain list of queries, one per line. Live search requests a page
+per keystroke, so a log has plenty of repeats and prefixes of each other.
+
+Usage: query_parse.py <access log or file of queries>
+
+"""
+from cgi import parse_qs
+import re
+from sys import argv, exit
+from time import time
+
+from dxr.query import _parsed_queries, parsed_terms, query_grammar, QueryVisitor
+
+
+_search_request = re.compile(r'/search\?(\S*)')
+
+
+def queries(path):
+    """Return the queries from an access log or list of queries."""
+    ret = []
+    with open(path) as lines:
+        for line in lines:
+            request = _search_request.search(line)
+            if request:
+                ret.extend(q.decode('utf-8', 'replace') for q in
+                           parse_qs(request.group(1)).get('q', []))
+            elif ' ' not in line.split('"')[0]:
+                # Not a log line. Take the line as a query.
+                ret.append(line.rstrip('\n').decode('utf-8', 'replace'))
+    return ret
+
+
+def rate(count, seconds):
+    return '%d queries/s' % (count / seconds) if seconds else 'too fast to tell'
+
+
+def main():
+    if len(argv) != 2:
+        print __doc__
+        exit(1)
+    corpus = queries(argv[1])
+    print '%d queries, %d distinct' % (len(corpus), len(set(corpus)))
+
+    start = time()
+    for q in corpus:
+        QueryVisitor(is_case_sensitive=False).visit(query_grammar.parse(q))
+    print 'Uncached: %s' % rate(len(corpus), time() - start)
+
+    _parsed_queries.clear()
+    start = time()
+    for q in corpus:
+        parsed_terms(q, False)
+    print 'Cached:   %s' % rate(len(corpus), time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+"""Measure the per-file overhead of rendering pages, with and without a
+cached ``RenderContext``
+
+For each simulated file, prepares a tiny, one-line file page and renders it.
+Preparation is the work that doesn't depend on the file's contents: loading
+templates and computing the tree-wide template variables. The "uncached" path
+does that work for every file, as ``htmlify()`` used to. Preparation and
+rendering are timed separately, since rendering costs the same either way.
+
+Usage: render_overhead.py [number of files (default: 100000)]
+
+"""
+from datetime import datetime
+import os
+from os.path import join
+from shutil import rmtree
+from sys import argv
+from tempfile import mkdtemp
+from time import time
+
+from dxr.build import (linked_pathname, render_context, _write_template,
+                       _render_contexts)
+from dxr.config import Config
+from dxr.query import filter_menu_items
+from dxr.utils import browse_url, load_template_env
+
+
+LINES = [(u'int main() { return 0; }', [])]
+
+
+def uncached(tree, path):
+    """Prepare a page the way ``htmlify()`` did before ``RenderContext``, and
+    return (template, vars)."""
+    env = load_template_env(tree.config.temp_folder, tree.config.dxrroot)
+    return (
+        env.get_template('file.html'),
+        {'wwwroot': tree.config.wwwroot,
+         'tree': tree.name,
+         'tree_tuples': [(t.name,
+                          browse_url(t.name, tree.config.wwwroot, path),
+                          t.description)
+                         for t in tree.config.sorted_tree_order],
+         'generated_date': tree.config.generated_date,
+         'filters': filter_menu_items(tree.config.filter_language),
+         'paths_and_names': linked_pathname(path, tree.name),
+         'icon': 'c',
+         'path': path,
+         'name': os.path.basename(path),
+         'lines': LINES,
+         'sections': []})
+
+
+def cached(tree, path):
+    """Prepare a page using the per-process ``RenderContext``, and return
+    (template, vars)."""
+    context = render_context(tree)
+    return (context.file_template,
+            context.arguments(path,
+                              icon='c',
+                              name=os.path.basename(path),
+                              lines=LINES,
+                              sections=[]))
+
+
+def make_tree(folder):
+    """Return a tree from a minimal config with a few sibling trees, so
+    there's a Switch Tree menu to compute."""
+    source = join(folder, 'src')
+    os.mkdir(source)
+    with open(join(folder, 'dxr.config'), 'w') as file:
+        file.write('[DXR]\n'
+                   'target_folder=%s\n'
+                   'temp_folder=%s\n' % (join(folder, 'target'),
+                                         join(folder, 'temp')))
+        for name in ['code', 'other', 'third', 'fourth']:
+            file.write('[%s]\n'
+                       'source_folder=%s\n'
+                       'object_folder=%s\n'
+                       'build_command=make -j $jobs\n' % (name, source, source))
+    config = Config(join(folder, 'dxr.config'))
+    config.generated_date = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S +0000')
+    os.mkdir(config.temp_folder)
+    return config.trees[0]
+
+
+def main():
+    num_files = int(argv[1]) if len(argv) > 1 else 100000
+    folder = mkdtemp()
+    try:
+        tree = make_tree(folder)
+        paths = ['dir%s/sub%s/file%s.c' % (i % 100, i % 7, i)
+                 for i in xrange(num_files)]
+        for name, prepare in [('uncached', uncached), ('cached', cached)]:
+            _render_contexts.clear()
+            preparing = rendering = 0
+            for path in paths:
+                start = time()
+                template, vars = prepare(tree, path)
+                rendered = time()
+                _write_template(template, os.devnull, vars)
+                preparing += rendered - start
+                rendering += time() - rendered
+            print ('%-8s prepare: %6.1f us per file, render: %6.1f us per '
+                   'file' % (name,
+                             preparing / num_files * 1e6,
+                             rendering / num_files * 1e6))
+    finally:
+        rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
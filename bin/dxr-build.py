@@ -31,6 +31,11 @@ def main():
                       action='store_true', default=False,
                       help='Display the build logs during the build instead of'
                            ' only on error.')
+    parser.add_option('-i', '--incremental', dest='incremental',
+                      action='store_true', default=False,
+                      help='Update the output of the previous build, '
+                           're-indexing and re-rendering only the files which '
+                           'were added, changed, or deleted since.')
     options, args = parser.parse_args()
     if len(args) > 1:
         parser.print_usage()
@@ -49,7 +54,8 @@ def main():
     return build_instance(options.config_file,
                           nb_jobs=options.jobs,
                           tree=options.tree,
-                          verbose=options.verbose)
+                          verbose=options.verbose,
+                          incremental=options.incremental)
 
 
 if __name__ == '__main__':
@@ -1,19 +1,44 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import partial
+import json
 from logging import StreamHandler
 from os.path import isdir, isfile, join
 from sys import stderr
+from threading import Lock
 from time import time
 from urllib import quote_plus
 
 from flask import (Blueprint, Flask, send_from_directory, current_app,
-                   send_file, request, redirect, jsonify, render_template)
+                   send_file, request, redirect, jsonify, render_template,
+                   Response, stream_with_context, abort)
 
+from dxr.archive import archive_path, archive_size, PageArchive
 from dxr.query import Query, filter_menu_items
-from dxr.utils import connect_db, non_negative_int, search_url, TEMPLATE_DIR, sqlite3  # Make sure we load trilite before possibly importing the wrong version of sqlite3.
+from dxr.utils import ConnectionPool, LRUCache, non_negative_int, PRECOMPRESSED_SUFFIXES, search_url, TEMPLATE_DIR, sqlite3  # Make sure we load trilite before possibly importing the wrong version of sqlite3.
 
 
 # Look in the 'dxr' package for static files, etc.:
 dxr_blueprint = Blueprint('dxr_blueprint', 'dxr', template_folder=TEMPLATE_DIR)
 
+# Pools of DB connections, one per tree folder, shared by this process's
+# request threads:
+_connection_pools = {}
+_connection_pools_lock = Lock()
+
+# Recent search results, one LRU cache per tree folder, each alongside the
+# build it was filled from. The data changes only when a tree is rebuilt, so
+# popular searches can be answered without touching the DB at all:
+_result_caches = {}
+_result_caches_lock = Lock()
+RESULT_CACHE_SIZE = 500
+
+# Readers of trees' page archives, one per archive, for trees built with
+# pack_html:
+_page_archives = {}
+_page_archives_lock = Lock()
+
+_missing = object()
+
 
 def make_app(instance_path):
     """Return a DXR application which looks in the given folder for
@@ -52,6 +77,10 @@ def search(tree):
 
     offset = non_negative_int(querystring.get('offset'), 0)
     limit = min(non_negative_int(querystring.get('limit'), 100), 1000)
+    # A continuation token from the previous page supersedes the offset:
+    after = _path_from_token(querystring.get('after'))
+    if after is not None:
+        offset = 0
 
     config = current_app.config
     www_root = config['WWW_ROOT']
@@ -70,68 +99,110 @@ def search(tree):
         arguments['tree'] = tree
 
         # Connect to database
+        pool = _connection_pool(tree)
         try:
-            conn = connect_db(join(current_app.instance_path, 'trees', tree))
+            conn = pool.get()
         except sqlite3.Error:
             error = 'Failed to establish database connection.'
         else:
-            # Parse the search query
-            qtext = querystring.get('q', '')
-            is_case_sensitive = querystring.get('case') == 'true'
-            q = Query(conn,
-                      qtext,
-                      should_explain='explain' in querystring,
-                      is_case_sensitive=is_case_sensitive)
-
-            # Try for a direct result:
-            if querystring.get('redirect') == 'true':
-                result = q.direct_result()
-                if result:
-                    path, line = result
-                    # TODO: Does this escape qtext properly?
-                    return redirect(
-                        '%s/%s/source/%s?from=%s%s#%i' %
-                        (www_root,
-                         tree,
-                         path,
-                         qtext,
-                         '&case=true' if is_case_sensitive else '', line))
-
-            # Return multiple results:
-            template = 'search.html'
-            start = time()
             try:
-                results = list(q.results(offset, limit))
-            except sqlite3.OperationalError as e:
-                if e.message.startswith('REGEXP:'):
-                    # Malformed regex
-                    warning = e.message[7:]
-                    results = []
-                elif e.message.startswith('QUERY:'):
-                    warning = e.message[6:]
-                    results = []
-                else:
-                    error = 'Database error: %s' % e.message
-            if not error:
-                # Search template variables:
-                arguments['time'] = time() - start
-                arguments['query'] = qtext
-                arguments['search_url'] = search_url(www_root,
-                                                     arguments['tree'],
-                                                     qtext,
-                                                     redirect=False)
-                arguments['results'] = results
-                arguments['offset'] = offset
-                arguments['limit'] = limit
-                arguments['is_case_sensitive'] = is_case_sensitive
-                arguments['tree_tuples'] = [
-                        (t,
-                         search_url(www_root,
-                                    t,
-                                    qtext,
-                                    case=True if is_case_sensitive else None),
-                         description)
-                        for t, description in trees.iteritems()]
+                # Parse the search query
+                qtext = querystring.get('q', '')
+                is_case_sensitive = querystring.get('case') == 'true'
+                should_explain = 'explain' in querystring
+                q = Query(conn,
+                          qtext,
+                          should_explain=should_explain,
+                          is_case_sensitive=is_case_sensitive)
+                cache = _result_cache(tree,
+                                      config['GENERATED_DATE'],
+                                      conn.identity,
+                                      pool.version())
+
+                # Try for a direct result:
+                if querystring.get('redirect') == 'true':
+                    key = 'direct', q.cache_key()
+                    result = cache.get(key, _missing)
+                    if result is _missing:
+                        result = q.direct_result()
+                        cache.put(key, result)
+                    if result:
+                        path, line = result
+                        # TODO: Does this escape qtext properly?
+                        return redirect(
+                            '%s/%s/source/%s?from=%s%s#%i' %
+                            (www_root,
+                             tree,
+                             path,
+                             qtext,
+                             '&case=true' if is_case_sensitive else '', line))
+
+                # Return multiple results:
+                template = 'search.html'
+                start = time()
+                key = 'results', q.cache_key(), offset, limit, after
+
+                if querystring.get('format') == 'ndjson':
+                    response = Response(
+                        stream_with_context(_ndjson_results(
+                            q, cache, key, offset, limit, after,
+                            should_explain)),
+                        mimetype='application/x-ndjson')
+                    # The response gives the connection back to the pool once
+                    # it's closed, whether it streamed everything or the
+                    # client went away before it started.
+                    response.call_on_close(partial(pool.put, conn))
+                    conn = None
+                    return response
+
+                try:
+                    # Explanations are per-run profiling output; don't cache
+                    # them:
+                    results = None if should_explain else cache.get(key)
+                    if results is None:
+                        results = list(q.results(offset, limit, after=after))
+                        if not should_explain:
+                            cache.put(key, results)
+                except sqlite3.OperationalError as e:
+                    if e.message.startswith('REGEXP:'):
+                        # Malformed regex
+                        warning = e.message[7:]
+                        results = []
+                    elif e.message.startswith('QUERY:'):
+                        warning = e.message[6:]
+                        results = []
+                    else:
+                        error = 'Database error: %s' % e.message
+                if not error:
+                    # Search template variables:
+                    arguments['time'] = time() - start
+                    arguments['query'] = qtext
+                    arguments['search_url'] = search_url(www_root,
+                                                         arguments['tree'],
+                                                         qtext,
+                                                         redirect=False)
+                    arguments['results'] = results
+                    arguments['offset'] = offset
+                    arguments['limit'] = limit
+                    # A full page means there may be more to come:
+                    arguments['next'] = (
+                        _continuation_token(results[-1][1])
+                        if len(results) == limit and not should_explain
+                        else None)
+                    arguments['is_case_sensitive'] = is_case_sensitive
+                    arguments['tree_tuples'] = [
+                            (t,
+                             search_url(www_root,
+                                        t,
+                                        qtext,
+                                        case=True if is_case_sensitive else None),
+                             description)
+                            for t, description in trees.iteritems()]
+            finally:
+                # Back in the pool, with its prepared statements, for the
+                # next request:
+                if conn is not None:
+                    pool.put(conn)
     else:
         arguments['tree'] = trees.keys()[0]
         error = "Tree '%s' is not a valid tree." % tree
@@ -140,6 +211,12 @@ def search(tree):
     if warning or error:
         arguments['error'] = error or warning
 
+    if querystring.get('format') == 'ndjson':
+        # We get here only if we never got as far as streaming.
+        return Response(json.dumps({'error': error}) + '\n',
+                        status_code or 500,
+                        mimetype='application/x-ndjson')
+
     if querystring.get('format') == 'json':
         if error:
             # Return a non-OK code so the live search doesn't try to replace
@@ -151,11 +228,8 @@ def search(tree):
         # convert to dictionaries before returning the json results.
         # If further discrepancies are introduced, please document them in
         # templating.mkd.
-        arguments['results'] = [
-            {'icon': icon,
-             'path': path,
-             'lines': [{'line_number': nb, 'line': l} for nb, l in lines]}
-                for icon, path, lines in arguments['results']]
+        arguments['results'] = [_result_json(*result)
+                                for result in arguments['results']]
         return jsonify(arguments)
 
     if error:
@@ -168,9 +242,53 @@ def search(tree):
 @dxr_blueprint.route('/<tree>/source/')
 @dxr_blueprint.route('/<tree>/source/<path:path>')
 def browse(tree, path=''):
-    """Show a directory listing or a single file from one of the trees."""
+    """Show a directory listing or a single file from one of the trees.
+
+    If the build left a compressed copy of the page in an encoding the client
+    accepts, send that as it is.
+
+    """
     tree_folder = _tree_folder(tree)
-    return send_from_directory(tree_folder, _html_file_path(tree_folder, path))
+    archive = _page_archive(tree_folder)
+    if archive is not None:
+        return _packed_page(tree, archive, path)
+    disk_path = _html_file_path(tree_folder, path)
+    for encoding, suffix in PRECOMPRESSED_SUFFIXES.iteritems():
+        if (request.accept_encodings.quality(encoding) > 0 and
+                isfile(join(tree_folder, disk_path + suffix))):
+            response = send_from_directory(tree_folder, disk_path + suffix,
+                                           mimetype='text/html')
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(tree_folder, disk_path)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _packed_page(tree, archive, path):
+    """Return a response serving a page out of a tree's page archive, or 404
+    if it isn't there."""
+    encodings = [(encoding, suffix) for encoding, suffix in
+                 PRECOMPRESSED_SUFFIXES.iteritems() if
+                 request.accept_encodings.quality(encoding) > 0]
+    encodings.append((None, ''))
+    location = _page_location(
+        tree,
+        [(page_path + suffix, encoding) for page_path in
+            _packed_page_paths(path) for encoding, suffix in encodings])
+    if location is None:
+        abort(404)
+    encoding, offset, length = location
+    page = archive.page(offset, length)
+    if page is None:
+        abort(404)
+    response = Response(page, mimetype='text/html')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @dxr_blueprint.route('/<tree>/')
@@ -194,9 +312,14 @@ def parallel(tree, path=''):
 
     """
     tree_folder = _tree_folder(tree)
-    disk_path = _html_file_path(tree_folder, path)
     www_root = current_app.config['WWW_ROOT']
-    if isfile(join(tree_folder, disk_path)):
+    if _page_archive(tree_folder) is not None:
+        exists = _page_location(
+            tree,
+            [(page_path, None) for page_path in _packed_page_paths(path)])
+    else:
+        exists = isfile(join(tree_folder, _html_file_path(tree_folder, path)))
+    if exists:
         return redirect('{root}/{tree}/source/{path}'.format(
             root=www_root,
             tree=tree,
@@ -207,6 +330,153 @@ def parallel(tree, path=''):
             tree=tree))
 
 
+def _connection_pool(tree):
+    """Return the pool of DB connections for the given tree, making it if
+    this is the first request for the tree."""
+    folder = _tree_folder(tree)
+    with _connection_pools_lock:
+        pool = _connection_pools.get(folder)
+        if pool is None:
+            pool = _connection_pools[folder] = ConnectionPool(folder)
+        return pool
+
+
+def _page_archive(tree_folder):
+    """Return the reader of a tree's page archive, or None if its pages
+    aren't packed into one.
+
+    An empty archive has no pages to serve, so it counts as none. The
+    archive's size is checked on every call, so a tree rebuilt without
+    ``pack_html``, which removes the archive, goes back to being served from
+    its HTML files.
+
+    """
+    path = archive_path(tree_folder)
+    with _page_archives_lock:
+        if not archive_size(path):
+            # Any reader we had is dropped. Threads still using its map keep
+            # it alive until they're done.
+            _page_archives.pop(path, None)
+            return None
+        archive = _page_archives.get(path)
+        if archive is None:
+            archive = _page_archives[path] = PageArchive(path)
+        return archive
+
+
+def _packed_page_paths(url_path):
+    """Return the paths, within a tree's page archive, of the pages that could
+    be served when a certain path is browsed to, most likely first.
+
+    Folders don't exist on disk when pages are packed, so we can't ask the FS
+    which it is, as ``_html_file_path()`` does.
+
+    """
+    return [url_path + '.html',
+            join(url_path, current_app.config['DIRECTORY_INDEX'])]
+
+
+def _page_location(tree, candidates):
+    """Look up the first of some pages that's in a tree's page archive.
+
+    :arg candidates: An iterable of (path of the page, whatever) pairs
+    :returns: (whatever, offset, length) or None if none of them are there
+
+    """
+    pool = _connection_pool(tree)
+    conn = pool.get()
+    try:
+        for page_path, extra in candidates:
+            row = conn.execute('SELECT offset, length FROM pages '
+                               'WHERE path = ?', (page_path,)).fetchone()
+            if row:
+                return extra, row[0], row[1]
+    finally:
+        pool.put(conn)
+    return None
+
+
+def _ndjson_results(query, cache, key, offset, limit, after, should_explain):
+    """Yield search results as lines of JSON, each as soon as it's highlit.
+
+    Nothing goes out until :meth:`~dxr.query.Query.results` has run the
+    page's file query and its batched extents queries, so the time to the
+    first line is that of those queries, not of finding one match. What
+    streams is the per-file work after them: fetching and highlighting the
+    matching lines, and serializing them.
+
+    Each line is a result, shaped like those in the ``format=json`` output.
+    If the page is full, a final ``{"next": <continuation token>}`` line
+    follows. If the query fails, an ``{"error": <message>}`` line ends the
+    stream.
+
+    """
+    results = None if should_explain else cache.get(key)
+    found = []
+    try:
+        for result in (results if results is not None else
+                       query.results(offset, limit, after=after)):
+            found.append(result)
+            yield json.dumps(_result_json(*result)) + '\n'
+    except sqlite3.OperationalError as e:
+        if e.message.startswith('REGEXP:'):
+            message = e.message[7:]
+        elif e.message.startswith('QUERY:'):
+            message = e.message[6:]
+        else:
+            message = 'Database error: %s' % e.message
+        yield json.dumps({'error': message}) + '\n'
+        return
+    if results is None and not should_explain:
+        cache.put(key, found)
+    if len(found) == limit and not should_explain:
+        yield json.dumps({'next': _continuation_token(found[-1][1])}) + '\n'
+
+
+def _result_json(icon, path, lines):
+    """Return a search result as a dict, for the JSON and NDJSON output."""
+    return {'icon': icon,
+            'path': path,
+            'lines': [{'line_number': nb, 'line': l} for nb, l in lines]}
+
+
+def _continuation_token(path):
+    """Return an opaque token which, passed back as the ``after`` param,
+    continues a search after the result at the given path."""
+    return urlsafe_b64encode(path)
+
+
+def _path_from_token(token):
+    """Return the path encoded in a continuation token, or None if there's no
+    token or it's garbage."""
+    if token:
+        try:
+            return urlsafe_b64decode(token.encode('ascii'))
+        except (TypeError, UnicodeError):
+            pass
+
+
+def _result_cache(tree, generated_date, db_identity, db_version):
+    """Return the cache of search results for the given tree, emptying it
+    first if the tree has been rebuilt since it was filled.
+
+    :arg generated_date: The GENERATED_DATE of the running instance
+    :arg db_identity: The identity of the DB file the results will come from,
+        as noted by ``ConnectionPool``
+    :arg db_version: The ``ConnectionPool.version()`` of the DB, which, unlike
+        the other two, changes when an incremental build updates it in place
+
+    """
+    folder = _tree_folder(tree)
+    generation = generated_date, db_identity, db_version
+    with _result_caches_lock:
+        cached_generation, cache = _result_caches.get(folder, (None, None))
+        if cache is None or cached_generation != generation:
+            cache = LRUCache(RESULT_CACHE_SIZE)
+            _result_caches[folder] = generation, cache
+        return cache
+
+
 def _tree_folder(tree):
     """Return the on-disk path to the root of the given tree's folder in the
     instance."""
@@ -0,0 +1,124 @@
+"""A packed archive of rendered pages, for trees too big to write a file per
+page
+
+The archive is a single file of records, each a page's path and contents,
+appended one after another. Appends take an exclusive lock, so several HTML
+worker processes can add to the same archive at once. Once they're done, the
+build reads back just the headers of the new records and stores where each
+page lies in the ``pages`` table of the tree's database, which the server
+looks pages up in before reading them out of a memory map of the archive.
+
+A page written more than once (as in an incremental build) is found at its
+latest location; the older copies are left in place until the next full
+build.
+
+"""
+from fcntl import flock, LOCK_EX, LOCK_UN
+from mmap import mmap, ACCESS_READ
+import os
+from os.path import join
+import struct
+from threading import Lock
+
+
+# The name of the archive within a tree's folder
+ARCHIVE_NAME = '.dxr-pages'
+
+# A record's header: the lengths of the path (UTF-8-encoded) and of the page
+_header = struct.Struct('<II')
+
+
+def archive_path(tree_folder):
+    """Return the path of the page archive of a tree."""
+    return join(tree_folder, ARCHIVE_NAME)
+
+
+def append_pages(path, pages):
+    """Append pages to an archive, creating it if need be.
+
+    :arg path: The path to the archive
+    :arg pages: An iterable of (path of the page, contents) pairs, both
+        bytestrings
+
+    The pages go in with a single write, under an exclusive lock, so they
+    don't get interleaved with those of other processes.
+
+    """
+    data = ''.join(_header.pack(len(page_path), len(page)) + page_path + page
+                   for page_path, page in pages)
+    with open(path, 'ab') as archive:
+        flock(archive, LOCK_EX)
+        try:
+            archive.write(data)
+            archive.flush()
+        finally:
+            flock(archive, LOCK_UN)
+
+
+def archive_size(path):
+    """Return the size of an archive, 0 if it doesn't exist yet."""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def page_locations(path, start=0):
+    """Yield (path of the page, offset, length) for each record of an
+    archive, starting with the one at offset ``start``.
+
+    Only the headers are read; the pages themselves are skipped over.
+
+    """
+    with open(path, 'rb') as archive:
+        archive.seek(start)
+        while True:
+            header = archive.read(_header.size)
+            if len(header) < _header.size:
+                return
+            path_length, length = _header.unpack(header)
+            page_path = archive.read(path_length)
+            offset = archive.tell()
+            yield page_path, offset, length
+            archive.seek(length, os.SEEK_CUR)
+
+
+class PageArchive(object):
+    """A reader of the pages in an archive, through a memory map
+
+    The map is remade when the archive has changed size (grown, from an
+    incremental build) or has been replaced (by a full one).
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._map = None
+        self._inode = None
+
+    def page(self, offset, length):
+        """Return the page that's ``length`` bytes long at ``offset``, or None
+        if the archive doesn't reach that far (if it's been truncated or
+        removed, say)."""
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return None
+        with self._lock:
+            if (self._map is None or info.st_ino != self._inode or
+                    info.st_size != len(self._map)):
+                self._remap()
+            archive_map = self._map
+        if offset + length > len(archive_map):
+            return None
+        return archive_map[offset:offset + length]
+
+    def _remap(self):
+        with open(self.path, 'rb') as archive:
+            info = os.fstat(archive.fileno())
+            self._inode = info.st_ino
+            # Other threads may still be reading the old map, so leave it to
+            # be closed once they're done with it. An empty file can't be
+            # mapped, but an empty string slices the same way.
+            self._map = (mmap(archive.fileno(), 0, access=ACCESS_READ)
+                         if info.st_size else '')
@@ -1,32 +1,44 @@
+from array import array
 from codecs import getdecoder
 import cgi
 from datetime import datetime
 from errno import ENOENT
 from fnmatch import fnmatchcase
+import gzip
+from hashlib import sha1
 from heapq import merge
 from itertools import chain, groupby, izip_longest
 import json
 from operator import itemgetter
 import os
 from os import stat
-from os.path import dirname, islink
+import re
+from os.path import dirname, isdir, islink
 import shutil
+from StringIO import StringIO
 import subprocess
 import sys
 from sys import exc_info
 from traceback import format_exc
+from urllib import quote_plus
 from warnings import warn
 
 from concurrent.futures import as_completed, ProcessPoolExecutor
 from jinja2 import Markup
 from ordereddict import OrderedDict
 
+from dxr.archive import (append_pages, archive_path, archive_size,
+                         page_locations)
 from dxr.config import Config
 from dxr.plugins import load_htmlifiers, load_indexers
 import dxr.languages
 import dxr.mime
-from dxr.query import filter_menu_items
-from dxr.utils import connect_db, load_template_env, open_log, browse_url
+from dxr.query import (DIRECT_FUNCTION, DIRECT_FUNCTION_NOCASE,
+                       DIRECT_FUNCTION_QUALNAME, DIRECT_PATH,
+                       DIRECT_PATH_SUFFIX, DIRECT_TYPE, DIRECT_TYPE_NOCASE,
+                       DIRECT_TYPE_QUALNAME, filter_menu_items)
+from dxr.utils import (ascii_lower, connect_db, load_template_env, LRUCache,
+                       open_log, browse_url, PRECOMPRESSED_SUFFIXES, trigrams)
 
 try:
     from itertools import compress
@@ -62,7 +74,8 @@ def linked_pathname(path, tree_name):
     return components
 
 
-def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
+def build_instance(config_path, nb_jobs=None, tree=None, verbose=False,
+                   incremental=False):
     """Build a DXR instance.
 
     :arg config_path: The path to a config file
@@ -70,6 +83,10 @@ def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
         to whatever the config file says.
     :arg tree: A single tree to build. Defaults to all the trees in the config
         file.
+    :arg incremental: Whether to reuse the database and HTML of a previous
+        build, re-indexing and re-rendering only the files which have been
+        added, changed, or deleted since. Trees which have no previous build
+        (or one from an older DXR) are built from scratch.
 
     """
     # Load configuration file
@@ -82,6 +99,8 @@ def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
     config = Config(config_path, **overrides)
 
     skip_indexing = 'index' in config.skip_stages
+    # Whether to clean out leftovers of previous builds:
+    clean = not (skip_indexing or incremental)
 
     # Find trees to make, fail if requested tree isn't available
     if tree:
@@ -96,8 +115,8 @@ def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
     # Create config.target_folder (if not exists)
     print "Generating target folder"
     ensure_folder(config.target_folder, False)
-    ensure_folder(config.temp_folder, not skip_indexing)
-    ensure_folder(config.log_folder, not skip_indexing)
+    ensure_folder(config.temp_folder, clean)
+    ensure_folder(config.log_folder, clean)
 
     jinja_env = load_template_env(config.temp_folder, config.dxrroot)
 
@@ -126,31 +145,53 @@ def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
         # Note starting time
         start_time = datetime.now()
 
+        is_incremental = (incremental and not skip_indexing and
+                          _has_fingerprints(tree))
+        if is_incremental and not _packs_pages_as_before(tree):
+            # The pages the build doesn't re-render would be missing or stale.
+            print (" - 'pack_html' has changed since the last build; building "
+                   "from scratch")
+            is_incremental = False
+        elif incremental and not is_incremental and not skip_indexing:
+            print " - No previous build to update; building from scratch"
+        elif skip_indexing and not _packs_pages_as_before(tree):
+            print (" - 'pack_html' has changed since the last build; folder "
+                   "pages won't follow until the tree is indexed again")
+        clean_tree = not (skip_indexing or is_incremental)
+
         # Create folders (delete if exists)
-        ensure_folder(tree.target_folder, not skip_indexing) # <config.target_folder>/<tree.name>
-        ensure_folder(tree.object_folder,                    # Object folder (user defined!)
-            tree.source_folder != tree.object_folder)        # Only clean if not the srcdir
-        ensure_folder(tree.temp_folder,   not skip_indexing) # <config.temp_folder>/<tree.name>
-                                                             # (or user defined)
-        ensure_folder(tree.log_folder,    not skip_indexing) # <config.log_folder>/<tree.name>
-                                                             # (or user defined)
+        ensure_folder(tree.target_folder, clean_tree)    # <config.target_folder>/<tree.name>
+        ensure_folder(tree.object_folder,                # Object folder (user defined!)
+            tree.source_folder != tree.object_folder     # Only clean if not the srcdir
+            and not is_incremental)                      # (or we're updating it)
+        ensure_folder(tree.temp_folder,   clean_tree)    # <config.temp_folder>/<tree.name>
+                                                         # (or user defined)
+        ensure_folder(tree.log_folder,    clean_tree)    # <config.log_folder>/<tree.name>
+                                                         # (or user defined)
         # Temporary folders for plugins
-        ensure_folder(os.path.join(tree.temp_folder, 'plugins'), not skip_indexing)
+        ensure_folder(os.path.join(tree.temp_folder, 'plugins'), clean_tree)
         for plugin in tree.enabled_plugins:     # <tree.config>/plugins/<plugin>
-            ensure_folder(os.path.join(tree.temp_folder, 'plugins', plugin), not skip_indexing)
+            ensure_folder(os.path.join(tree.temp_folder, 'plugins', plugin), clean_tree)
 
         # Connect to database (exits on failure: sqlite_version, tokenizer, etc)
         conn = connect_db(tree.target_folder)
 
+        # Where the pages this build packs into the archive will start:
+        pages_start = start_page_archive(tree)
+
+        # IDs of the files whose HTML needs (re)building, None meaning all:
+        changed_ids = None
         if skip_indexing:
             print " - Skipping indexing (due to 'index' in 'skip_stages')"
         else:
             # Create database tables
-            create_tables(tree, conn)
+            create_tables(tree, conn, is_incremental)
 
             # Index all source files (for full text search)
             # Also build all folder listing while we're at it
-            index_files(tree, conn)
+            changed_ids = index_files(tree, conn, is_incremental)
+            if not is_incremental:
+                changed_ids = None
 
             # Build tree
             build_tree(tree, conn, verbose)
@@ -169,9 +210,14 @@ def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
             max_file_id = conn.execute("SELECT max(files.id) FROM files").fetchone()[0]
             if config.disable_workers:
                 print " - Worker pool disabled (due to 'disable_workers')"
-                _build_html_for_file_ids(tree, 0, max_file_id)
+                for start, end, file_ids in _html_jobs(max_file_id,
+                                                       changed_ids):
+                    _build_html_for_file_ids(tree, start, end, file_ids)
             else:
-                run_html_workers(tree, config, max_file_id)
+                run_html_workers(tree, config, max_file_id, changed_ids)
+
+        if pages_start is not None:
+            index_page_archive(tree, conn, pages_start)
 
         # Close connection
         conn.commit()
@@ -184,6 +230,34 @@ def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
     # Print a neat summary
 
 
+def start_page_archive(tree):
+    """Return the offset the pages this build packs into a tree's archive
+    will start at, if ``pack_html`` is set. Otherwise, return None.
+
+    Builds that clean out the tree's folder start a new archive. Others, like
+    incremental ones and ones which skip indexing, add to the existing one,
+    since they don't re-render every page.
+
+    """
+    if not tree.config.pack_html:
+        return None
+    return archive_size(archive_path(tree.target_folder))
+
+
+def index_page_archive(tree, conn, start):
+    """Record where the pages packed into a tree's archive since offset
+    ``start`` lie, in the ``pages`` table."""
+    print " - Indexing packed pages"
+    path = archive_path(tree.target_folder)
+    if archive_size(path) > start:
+        conn.executemany(
+            'INSERT OR REPLACE INTO pages (path, offset, length) '
+            'VALUES (?, ?, ?)',
+            ((page_path.decode('utf-8'), offset, length)
+             for page_path, offset, length in page_locations(path, start)))
+    conn.commit()
+
+
 def ensure_folder(folder, clean=False):
     """Ensure the existence of a folder.
 
@@ -196,10 +270,60 @@ def ensure_folder(folder, clean=False):
         os.mkdir(folder)
 
 
-def create_tables(tree, conn):
+def create_tables(tree, conn, incremental=False):
+    """Create the tables for the common schema.
+
+    :arg incremental: If True, keep the ``files``, ``newlines``, and
+        ``pages`` tables and trigram index from the previous build, and
+        recreate only the tables that plugins fill in.
+
+    """
     print "Creating tables"
-    conn.execute("CREATE VIRTUAL TABLE trg_index USING trilite")
-    conn.executescript(dxr.languages.language_schema.get_create_sql())
+    if incremental:
+        # Plugins will fill in their tables again from scratch, so throw away
+        # everything but the files, their newlines, the packed pages of the
+        # unchanged ones, and the trigram index (and its shadow tables).
+        for name, in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name NOT IN ('files', 'newlines', 'pages') "
+                "AND name NOT LIKE 'trg_index%' "
+                "AND name NOT LIKE 'sqlite_%'").fetchall():
+            conn.execute('DROP TABLE "%s"' % name)
+        conn.executescript('\n'.join(
+            table.get_create_sql() for name, table in
+            dxr.languages.language_schema.tables.iteritems()
+            if name not in ('files', 'newlines', 'pages')))
+    else:
+        conn.execute("CREATE VIRTUAL TABLE trg_index USING trilite")
+        conn.executescript(dxr.languages.language_schema.get_create_sql())
+
+
+def _has_fingerprints(tree):
+    """Return whether the tree has a previous build whose ``files`` table
+    records the fingerprints that incremental builds compare against (and
+    which has the ``newlines`` table kept alongside it)."""
+    if not os.path.isfile(os.path.join(tree.target_folder, '.dxr-xref.sqlite')):
+        return False
+    conn = connect_db(tree.target_folder)
+    try:
+        return ('hash' in [row['name'] for row in
+                           conn.execute("PRAGMA table_info(files)")] and
+                conn.execute("SELECT 1 FROM sqlite_master "
+                             "WHERE name = 'newlines'").fetchone() is not None)
+    finally:
+        conn.close()
+
+
+def _packs_pages_as_before(tree):
+    """Return whether the previous build of a tree packed its pages into an
+    archive iff this one is going to.
+
+    Every packed build writes at least the root folder's page, so there's an
+    archive exactly when the previous build was packed.
+
+    """
+    return (bool(tree.config.pack_html) ==
+            os.path.isfile(archive_path(tree.target_folder)))
 
 
 def _unignored_folders(folders, source_path, ignore_patterns, ignore_paths):
@@ -218,82 +342,335 @@ def _unignored_folders(folders, source_path, ignore_patterns, ignore_paths):
                 yield folder
 
 
-def index_files(tree, conn):
-    """Build the ``files`` table, the trigram index, and the HTML folder listings."""
+def index_files(tree, conn, incremental=False):
+    """Build the ``files`` table, the trigram index, and the HTML folder listings.
+
+    Folders are read by a pool of worker processes (see ``_index_folder()``).
+    This process is the only writer: it assigns file IDs, in the order of a
+    sorted walk of the tree, and inserts what the workers find in large
+    batches.
+
+    :arg incremental: If True, update the ``files`` table and trigram index
+        left by the previous build rather than filling empty ones. Files whose
+        fingerprints haven't changed are left alone, and ones which have
+        disappeared are deleted, along with their HTML.
+
+    Return a list of the IDs of files which were added or changed.
+
+    """
     print "Indexing files from the '%s' tree" % tree.name
     start_time = datetime.now()
-    cur = conn.cursor()
-    # Walk the directory tree top-down, this allows us to modify folders to
-    # exclude folders matching an ignore_pattern
-    for root, folders, files in os.walk(tree.source_folder, topdown=True):
-        # Find relative path
-        rel_path = os.path.relpath(root, tree.source_folder)
-        if rel_path == '.':
-            rel_path = ""
-
-        # List of file we indexed (ie. add to folder listing)
-        indexed_files = []
-        for f in files:
-            # Ignore file if it matches an ignore pattern
-            if any(fnmatchcase(f, e) for e in tree.ignore_patterns):
-                continue  # Ignore the file.
-
-            # file_path and path
-            file_path = os.path.join(root, f)
-            path = os.path.join(rel_path, f)
-
-            # Ignore file if its path (relative to the root) matches an ignore path
-            if any(fnmatchcase("/" + path.replace(os.sep, "/"), e) for e in tree.ignore_paths):
-                continue  # Ignore the file.
-
-            # the file
-            try:
+
+    # {folder: {file name: (id, mtime, size, hash)}} from the previous build:
+    previous = {}
+    next_id = 1
+    if incremental:
+        for id, path, mtime, size, hash in conn.execute(
+                "SELECT id, path, mtime, size, hash FROM files"):
+            folder, name = os.path.split(path)
+            previous.setdefault(folder, {})[name] = id, mtime, size, hash
+        next_id += conn.execute("SELECT max(id) FROM files").fetchone()[0] or 0
+
+    writer = _FileWriter(conn)
+    changed_ids = []
+    for rel_path, folders, files in _indexed_folders(tree, previous):
+        folder_previous = previous.pop(rel_path, {})
+        for path, icon, data, (mtime, size, hash) in files:
+            id, old_mtime, old_size, old_hash = folder_previous.pop(
+                os.path.basename(path), (None, None, None, None))
+            if id is None:
+                id = next_id
+                next_id += 1
+                writer.insert(id, path, icon, tree.source_encoding, data,
+                              mtime, size, hash)
+                changed_ids.append(id)
+            elif hash != old_hash:
+                writer.update(id, data, mtime, size, hash)
+                changed_ids.append(id)
+            elif (mtime, size) != (old_mtime, old_size):
+                # Touched but not changed: just remember the new fingerprint.
+                writer.update(id, None, mtime, size, hash)
+        # Whatever we haven't seen in this folder has gone away:
+        for name, (id, _, _, _) in folder_previous.iteritems():
+            writer.delete(tree, id, os.path.join(rel_path, name))
+    # ...as has everything in folders we haven't seen, and their listings:
+    for folder, folder_previous in previous.iteritems():
+        for name, (id, _, _, _) in folder_previous.iteritems():
+            writer.delete(tree, id, os.path.join(folder, name))
+        writer.delete_listing(tree, folder)
+    writer.flush()
+
+    if incremental:
+        print " - %s files added or changed, %s deleted" % (len(changed_ids),
+                                                            writer.deleted)
+    # Print time
+    print "(finished in %s)" % (datetime.now() - start_time)
+    return changed_ids
+
+
+class _FileWriter(object):
+    """Batcher of writes to the ``files`` and ``newlines`` tables and trigram
+    index
+
+    Rows pile up until there are enough files or bytes to make a worthwhile
+    transaction, and then they're written with ``executemany()``.
+
+    """
+    # Flush to the DB whenever this many files or bytes pile up:
+    batch_files = 5000
+    batch_bytes = 64 * 1024 * 1024
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.deleted = 0
+        self._files_rows = []  # new files
+        self._fingerprint_rows = []  # changed files
+        self._trg_deletes = []  # IDs of changed or deleted files
+        self._trg_rows = []  # new or changed contents
+        self._newline_rows = []  # and where their lines start
+        self._file_deletes = []
+        self._page_deletes = []  # paths of deleted pages, if packed
+        self._count = self._bytes = 0
+
+    def insert(self, id, path, icon, encoding, data, mtime, size, hash):
+        """Add a file which is new to the tree."""
+        self._files_rows.append((id, path, icon, encoding, mtime, size, hash))
+        self._add_contents(id, data)
+
+    def update(self, id, data, mtime, size, hash):
+        """Record a new fingerprint and, if ``data`` isn't None, new contents
+        for a file we already know."""
+        self._fingerprint_rows.append((mtime, size, hash, id))
+        if data is not None:
+            self._trg_deletes.append((id,))
+            self._add_contents(id, data)
+        else:
+            self._tally(0)
+
+    def delete(self, tree, id, path):
+        """Remove a file which has disappeared from the tree, along with its
+        HTML."""
+        self._file_deletes.append((id,))
+        self._trg_deletes.append((id,))
+        self.deleted += 1
+        html_path = os.path.join(tree.target_folder, path + '.html')
+        _remove_if_exists(html_path)
+        self._page_deletes.append((path + '.html',))
+        for suffix in PRECOMPRESSED_SUFFIXES.itervalues():
+            _remove_if_exists(html_path + suffix)
+            self._page_deletes.append((path + '.html' + suffix,))
+        self._tally(0)
+
+    def delete_listing(self, tree, folder):
+        """Remove the listing of a folder which has disappeared from the
+        tree, along with its compressed copies, whether written out or
+        packed."""
+        page_path = os.path.join(folder, tree.config.directory_index)
+        html_path = os.path.join(tree.target_folder, page_path)
+        _remove_if_exists(html_path)
+        self._page_deletes.append((page_path,))
+        for suffix in PRECOMPRESSED_SUFFIXES.itervalues():
+            _remove_if_exists(html_path + suffix)
+            self._page_deletes.append((page_path + suffix,))
+
+    def _add_contents(self, id, data):
+        self._trg_rows.append((id, data))
+        self._newline_rows.append((id, buffer(newline_offsets(data))))
+        self._tally(len(data))
+
+    def _tally(self, num_bytes):
+        self._count += 1
+        self._bytes += num_bytes
+        if self._count >= self.batch_files or self._bytes >= self.batch_bytes:
+            self.flush()
+
+    def flush(self):
+        """Write everything that's piled up, in a single transaction."""
+        execute = self.conn.executemany
+        execute("DELETE FROM trg_index WHERE id = ?", self._trg_deletes)
+        execute("DELETE FROM newlines WHERE id = ?", self._trg_deletes)
+        execute("DELETE FROM files WHERE id = ?", self._file_deletes)
+        execute("DELETE FROM pages WHERE path = ?", self._page_deletes)
+        execute("UPDATE files SET mtime = ?, size = ?, hash = ? WHERE id = ?",
+                self._fingerprint_rows)
+        execute("INSERT INTO files (id, path, icon, encoding, mtime, size, hash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._files_rows)
+        execute("INSERT INTO trg_index (id, text) VALUES (?, ?)",
+                self._trg_rows)
+        execute("INSERT INTO newlines (id, offsets) VALUES (?, ?)",
+                self._newline_rows)
+        self.conn.commit()
+        for rows in (self._files_rows, self._fingerprint_rows,
+                     self._trg_deletes, self._trg_rows, self._newline_rows,
+                     self._file_deletes, self._page_deletes):
+            del rows[:]
+        self._count = self._bytes = 0
+
+
+def newline_offsets(data):
+    """Return the byte offsets of the newlines in a file's contents, packed
+    as little-endian unsigned 32-bit ints for the ``newlines`` table."""
+    offsets = array('I')
+    find = data.find
+    offset = find('\n')
+    while offset != -1:
+        offsets.append(offset)
+        offset = find('\n', offset + 1)
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return offsets.tostring()
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError as exc:
+        if exc.errno != ENOENT:
+            raise
+
+
+def _indexed_folders(tree, previous):
+    """Walk the tree, and yield the result of ``_index_folder()`` for each
+    unignored folder.
+
+    :arg previous: A dict of {folder: {file name: (id, mtime, size, hash)}}
+        describing the files as of the previous build, empty if there wasn't
+        one
+
+    Folders are yielded depth-first, in sorted order, however many workers
+    there are, so file IDs come out the same from one build of a tree to the
+    next. Unless workers are disabled, folders are handed out to a pool of
+    ``nb_jobs`` processes ahead of when they're needed. Only a few folders per
+    worker are in flight at once so the readers can't get arbitrarily far
+    ahead of the DB writer.
+
+    """
+    def fingerprints(folder):
+        """Return the {name: (mtime, size, hash)} we send to a worker."""
+        return dict((name, info[1:]) for name, info in
+                    previous.get(folder, {}).iteritems())
+
+    # Folders yet to be indexed, relative to the source folder, the next one
+    # to yield last:
+    queued = ['']
+
+    if tree.config.disable_workers:
+        while queued:
+            folder = queued.pop()
+            rel_path, folders, files = _index_folder(tree,
+                                                     folder,
+                                                     fingerprints(folder))
+            queued.extend(os.path.join(rel_path, f) for f in reversed(folders))
+            yield rel_path, folders, files
+        return
+
+    nb_jobs = int(tree.config.nb_jobs)
+    with ProcessPoolExecutor(max_workers=nb_jobs) as pool:
+        running = {}  # {folder: future}
+        while queued:
+            # Start on the folders we'll need soonest:
+            for folder in reversed(queued):
+                if len(running) >= nb_jobs * 4:
+                    break
+                if folder not in running:
+                    running[folder] = pool.submit(_index_folder,
+                                                  tree,
+                                                  folder,
+                                                  fingerprints(folder))
+            rel_path, folders, files = running.pop(queued.pop()).result()
+            queued.extend(os.path.join(rel_path, f) for f in reversed(folders))
+            yield rel_path, folders, files
+
+
+def _index_folder(tree, rel_path, fingerprints):
+    """Read the text files directly inside one folder of the source tree, and
+    write that folder's HTML listing.
+
+    Return (``rel_path``, subfolders to descend into, list of (path, icon,
+    contents, (mtime, size, hash)) for each text file). This is the top-level
+    function of a file-indexing worker process.
+
+    :arg rel_path: Path of the folder, relative to the source folder
+    :arg fingerprints: A dict of {file name: (mtime, size, hash)} from the
+        previous build. Files whose mtime and size still match aren't read;
+        their contents come back as None.
+
+    """
+    root = os.path.join(tree.source_folder, rel_path)
+    try:
+        names = os.listdir(root)
+    except OSError:
+        # os.walk() skips folders it can't list, so we do too.
+        return rel_path, [], []
+    folders, files = [], []
+    for name in names:
+        (folders if isdir(os.path.join(root, name)) else files).append(name)
+    files.sort()
+
+    # List of (path, icon, contents, fingerprint) of files we indexed
+    indexed_files = []
+    for f in files:
+        # Ignore file if it matches an ignore pattern
+        if any(fnmatchcase(f, e) for e in tree.ignore_patterns):
+            continue  # Ignore the file.
+
+        # file_path and path
+        file_path = os.path.join(root, f)
+        path = os.path.join(rel_path, f)
+
+        # Ignore file if its path (relative to the root) matches an ignore path
+        if any(fnmatchcase("/" + path.replace(os.sep, "/"), e) for e in tree.ignore_paths):
+            continue  # Ignore the file.
+
+        # the file
+        try:
+            file_info = stat(file_path)
+            mtime, size = file_info.st_mtime, file_info.st_size
+            old_mtime, old_size, hash = fingerprints.get(f, (None, None, None))
+            if (mtime, size) == (old_mtime, old_size):
+                # Unchanged since the last build; don't bother reading it.
+                data = None
+            else:
                 with open(file_path, 'r') as source_file:
                     data = source_file.read()
-            except IOError as exc:
-                if exc.errno == ENOENT and islink(file_path):
-                    # It's just a bad symlink (or a symlink that was swiped out
-                    # from under us--whatever):
-                    continue
-                else:
-                    raise
+        except (IOError, OSError) as exc:
+            if exc.errno == ENOENT and islink(file_path):
+                # It's just a bad symlink (or a symlink that was swiped out
+                # from under us--whatever):
+                continue
+            else:
+                raise
 
+        if data is not None:
             # Discard non-text files
             if not dxr.mime.is_text(file_path, data):
                 continue
+            hash = sha1(data).hexdigest()
 
-            # Find an icon (ideally dxr.mime should use magic numbers, etc.)
-            # that's why it makes sense to save this result in the database
-            icon = dxr.mime.icon(path)
-
-            # Insert this file
-            cur.execute("INSERT INTO files (path, icon, encoding) VALUES (?, ?, ?)",
-                        (path, icon, tree.source_encoding))
-            # Index this file
-            sql = "INSERT INTO trg_index (id, text) VALUES (?, ?)"
-            cur.execute(sql, (cur.lastrowid, data))
+        # Find an icon (ideally dxr.mime should use magic numbers, etc.)
+        # that's why it makes sense to save this result in the database
+        indexed_files.append((path, dxr.mime.icon(path), data,
+                              (mtime, size, hash)))
 
-            # Okay to this file was indexed
-            indexed_files.append(f)
+    # Exclude folders that match an ignore pattern.
+    folders = list(_unignored_folders(
+        folders, rel_path, tree.ignore_patterns, tree.ignore_paths))
+    folders.sort()
 
-        # Exclude folders that match an ignore pattern.
-        # os.walk listens to any changes we make in `folders`.
-        folders[:] = _unignored_folders(
-            folders, rel_path, tree.ignore_patterns, tree.ignore_paths)
+    # Now build folder listing and folders for indexed_files
+    build_folder(tree,
+                 rel_path,
+                 [os.path.basename(path) for path, _, _, _ in indexed_files],
+                 folders)
 
-        indexed_files.sort()
-        folders.sort()
-        # Now build folder listing and folders for indexed_files
-        build_folder(tree, conn, rel_path, indexed_files, folders)
+    # Like os.walk(), list symlinked folders but don't descend into them:
+    return (rel_path,
+            [f for f in folders if not islink(os.path.join(root, f))],
+            indexed_files)
 
-    # Okay, let's commit everything
-    conn.commit()
-
-    # Print time
-    print "(finished in %s)" % (datetime.now() - start_time)
 
-
-def build_folder(tree, conn, folder, indexed_files, indexed_folders):
+def build_folder(tree, folder, indexed_files, indexed_folders):
     """Build an HTML index file for a single folder."""
     # Create the subfolder if it doesn't exist:
     ensure_folder(os.path.join(tree.target_folder, folder))
@@ -325,34 +702,24 @@ def build_folder(tree, conn, folder, indexed_files, indexed_folders):
                       _join_url(tree.name, 'source', folder, f)))
 
     # Lay down the HTML:
-    jinja_env = load_template_env(tree.config.temp_folder,
-                                  tree.config.dxrroot)
     dst_path = os.path.join(tree.target_folder,
                             folder,
                             tree.config.directory_index)
 
-    _fill_and_write_template(
-        jinja_env,
-        'folder.html',
+    context = render_context(tree)
+    _write_page(
+        tree,
+        context.folder_template,
         dst_path,
-        {# Common template variables:
-         'wwwroot': tree.config.wwwroot,
-         'tree': tree.name,
-         'tree_tuples': [(t.name,
-                          browse_url(t.name, tree.config.wwwroot, folder),
-                          t.description)
-                         for t in tree.config.sorted_tree_order],
-         'generated_date': tree.config.generated_date,
-         'paths_and_names': linked_pathname(folder, tree.name),
-         'filters': filter_menu_items(tree.config.filter_language),
-         # Autofocus only at the root of each tree:
-         'should_autofocus_query': folder == '',
-
-         # Folder template variables:
-         'name': name,
-         'path': folder,
-         'folders': folders,
-         'files': files})
+        context.arguments(
+            folder,
+            # Autofocus only at the root of each tree:
+            should_autofocus_query=folder == '',
+
+            # Folder template variables:
+            name=name,
+            folders=folders,
+            files=files))
 
 def _join_url(*args):
     """Join URL path segments with "/", skipping empty segments."""
@@ -362,8 +729,136 @@ def _join_url(*args):
 def _fill_and_write_template(jinja_env, template_name, out_path, vars):
     """Get the template `template_name` from the template folder, substitute in
     `vars`, and write the result to `out_path`."""
-    template = jinja_env.get_template(template_name)
+    _write_template(jinja_env.get_template(template_name), out_path, vars)
+
+
+def _write_template(template, out_path, vars, encodings=()):
+    """Substitute `vars` into a loaded template, and write the result to
+    `out_path`.
+
+    :arg encodings: The Content-Encodings to also write compressed copies of
+        the result in, alongside it
+
+    """
     template.stream(**vars).dump(out_path, encoding='utf-8')
+    write_compressed_copies(out_path, encodings)
+
+
+def _write_page(tree, template, out_path, vars):
+    """Render a file or folder page of a tree, and write it, along with any
+    compressed copies ``compress_html`` asks for.
+
+    The page goes to ``out_path`` or, if ``pack_html`` is set, into the tree's
+    page archive under ``out_path``'s path relative to the tree's folder. (The
+    archive takes a page in one piece, so it's rendered in memory rather than
+    streamed.)
+
+    """
+    config = tree.config
+    if not config.pack_html:
+        _write_template(template, out_path, vars, config.compress_html)
+        return
+    page = template.render(**vars).encode('utf-8')
+    path = os.path.relpath(out_path, tree.target_folder)
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    pages = [(path, page)]
+    for encoding in config.compress_html:
+        pages.append((path + PRECOMPRESSED_SUFFIXES[encoding],
+                      compressed(page, encoding)))
+    append_pages(archive_path(tree.target_folder), pages)
+
+
+def compressed(data, encoding):
+    """Return a string compressed in one of the Content-Encodings of
+    ``PRECOMPRESSED_SUFFIXES``."""
+    if encoding == 'gzip':
+        buffer_ = StringIO()
+        compressor = gzip.GzipFile(fileobj=buffer_, mode='wb')
+        try:
+            compressor.write(data)
+        finally:
+            compressor.close()
+        return buffer_.getvalue()
+    if encoding == 'br':
+        import brotli  # optional; Config makes sure it's there.
+        return brotli.compress(data)
+    raise ValueError('Unknown encoding: %s' % encoding)
+
+
+def write_compressed_copies(path, encodings):
+    """Write compressed copies of a file next to it (``foo.html.gz`` and so
+    on), so the server can send them as they are to clients which accept them.
+    Remove any copies in other encodings, which would be stale.
+
+    :arg encodings: The Content-Encodings to compress in: any of the keys of
+        ``PRECOMPRESSED_SUFFIXES``
+
+    """
+    for encoding, suffix in PRECOMPRESSED_SUFFIXES.iteritems():
+        if encoding not in encodings:
+            _remove_if_exists(path + suffix)
+        else:
+            with open(path, 'rb') as original:
+                data = original.read()
+            with open(path + suffix, 'wb') as copy:
+                copy.write(compressed(data, encoding))
+
+
+class RenderContext(object):
+    """The parts of rendering a tree's folder and file pages which are the
+    same for every page
+
+    Making one of these loads the templates and computes the tree-wide
+    template variables so that, for each page, only the page-specific ones are
+    left to compute. Get them through ``render_context()``, which keeps one
+    per tree per process.
+
+    """
+    def __init__(self, tree):
+        config = tree.config
+        env = load_template_env(config.temp_folder, config.dxrroot)
+        self.file_template = env.get_template('file.html')
+        self.folder_template = env.get_template('folder.html')
+        # browse_url() of the root of each tree, for the Switch Tree menu.
+        # Quoting works character by character, so quoting a path and
+        # appending it to one of these comes out the same as browse_url().
+        self._trees = [(t.name,
+                        browse_url(t.name, config.wwwroot, ''),
+                        t.description)
+                       for t in config.sorted_tree_order]
+        self._tree_name = tree.name
+        self._common = {
+            'wwwroot': config.wwwroot,
+            'tree': tree.name,
+            'generated_date': config.generated_date,
+            # A list, not a generator, so every page can iterate over it:
+            'filters': list(filter_menu_items(config.filter_language))}
+
+    def arguments(self, path, **page_vars):
+        """Return the template variables for the page of the file or folder
+        at ``path``: the common ones, plus the ones in ``page_vars``."""
+        vars = self._common.copy()
+        vars['path'] = path
+        quoted_path = quote_plus(path, '/')
+        vars['tree_tuples'] = [(name, root_url + quoted_path, description)
+                               for name, root_url, description in self._trees]
+        vars['paths_and_names'] = linked_pathname(path, self._tree_name)
+        vars.update(page_vars)
+        return vars
+
+
+_render_contexts = {}
+def render_context(tree):
+    """Return the ``RenderContext`` for a tree, making it on first use in
+    this process."""
+    # The tree is pickled anew for every worker job, so key on what
+    # identifies a build of it rather than on the object:
+    key = tree.name, tree.target_folder, tree.config.generated_date
+    context = _render_contexts.get(key)
+    if context is None:
+        context = _render_contexts[key] = RenderContext(tree)
+    return context
 
 
 def build_tree(tree, conn, verbose):
@@ -412,6 +907,95 @@ def build_tree(tree, conn, verbose):
     for indexer in indexers:
         indexer.post_process(tree, conn)
 
+    # Now that the plugins have filled in their symbol tables, index the names
+    index_symbol_names(conn)
+    index_direct_hits(conn)
+
+
+def index_symbol_names(conn):
+    """Fill in the symbol name index, which lets searches for names (with or
+    without wildcards) avoid scanning every symbol table with LIKE.
+
+    Every table with an ``id`` and a ``name`` column is indexed. Names are
+    lowercased the way SQLite's LIKE folds case, and each distinct one is
+    recorded in ``symbol_names``, along with its trigrams in
+    ``symbol_name_trigrams`` and the symbols that bear it in ``symbols``.
+
+    """
+    print " - Indexing symbol names"
+    for table in ['symbols', 'symbol_name_trigrams', 'symbol_names']:
+        conn.execute('DELETE FROM %s' % table)
+    tables = [name for name, in conn.execute(
+                  "SELECT name FROM sqlite_master WHERE type = 'table' "
+                  "AND name NOT LIKE 'sqlite_%' AND name NOT LIKE 'trg_%' "
+                  "AND name NOT LIKE 'symbol%'").fetchall()
+              if set(['id', 'name']) <= set(
+                  row['name'] for row in
+                  conn.execute('PRAGMA table_info("%s")' % name))]
+    if not tables:
+        return
+
+    conn.execute('INSERT INTO symbol_names (name) ' +
+                 ' UNION '.join('SELECT lower(name) FROM "%s" '
+                                'WHERE name IS NOT NULL' % table
+                                for table in tables))
+    for table in tables:
+        conn.execute('INSERT INTO symbols (name_id, tbl, id) '
+                     'SELECT symbol_names.id, ?, "{0}".id FROM "{0}" '
+                     'JOIN symbol_names '
+                     'ON symbol_names.name = lower("{0}".name)'.format(table),
+                     [table])
+    conn.executemany(
+        'INSERT INTO symbol_name_trigrams (trigram, name_id) VALUES (?, ?)',
+        ((trigram, name_id) for name_id, name in
+            conn.execute('SELECT id, name FROM symbol_names').fetchall()
+         for trigram in trigrams(name)))
+
+
+def index_direct_hits(conn):
+    """Fill in the ``direct_hits`` table with every path, path suffix, and
+    type and function name a search could be an exact match for, noting
+    where each leads if it's only in one place.
+
+    """
+    print " - Indexing direct hits"
+    conn.execute('DELETE FROM direct_hits')
+    insert = 'INSERT INTO direct_hits (tier, name, path, line, count) '
+    conn.execute(insert + 'SELECT ?, path, path, 1, count(*) FROM files '
+                          'WHERE path IS NOT NULL GROUP BY path',
+                 [DIRECT_PATH])
+
+    # The ends of paths following a slash, as in "path LIKE '%/' || term"
+    suffixes = {}
+    for path, in conn.execute('SELECT path FROM files '
+                              'WHERE path IS NOT NULL').fetchall():
+        slash = path.find('/')
+        while slash != -1:
+            suffix = ascii_lower(path[slash + 1:])
+            count, first_path = suffixes.get(suffix, (0, path))
+            suffixes[suffix] = count + 1, first_path
+            slash = path.find('/', slash + 1)
+    conn.executemany(insert + 'VALUES (?, ?, ?, 1, ?)',
+                     ((DIRECT_PATH_SUFFIX, suffix, path, count)
+                      for suffix, (count, path) in suffixes.iteritems()))
+
+    for tier, table, column, fold_case in [
+            (DIRECT_TYPE, 'types', 'name', False),
+            (DIRECT_FUNCTION, 'functions', 'name', False),
+            (DIRECT_TYPE_QUALNAME, 'types', 'qualname', True),
+            (DIRECT_FUNCTION_QUALNAME, 'functions', 'qualname', True),
+            (DIRECT_TYPE_NOCASE, 'types', 'name', True),
+            (DIRECT_FUNCTION_NOCASE, 'functions', 'name', True)]:
+        name = '%s.%s' % (table, column)
+        if fold_case:
+            name = 'lower(%s)' % name
+        # When a name is in just one place, the path and line are its.
+        conn.execute(insert + 'SELECT ?, %s, files.path, %s.file_line, '
+                              'count(*) FROM %s LEFT JOIN files '
+                              'ON files.id = %s.file_id GROUP BY %s'
+                              % (name, table, table, table, name),
+                     [tier])
+
 
 def finalize_database(conn):
     """Finalize the database."""
@@ -456,15 +1040,37 @@ def _sliced_range_bounds(a, b, slice_size):
         this_min = this_max + 1
 
 
-def run_html_workers(tree, config, max_file_id):
-    """Farm out the building of HTML to a pool of processes."""
+def _html_jobs(max_file_id, file_ids=None, slice_size=500):
+    """Divide the work of building HTML into slices, and return an iterable
+    of (start ID, end ID, file IDs or None) args for
+    ``_build_html_for_file_ids()``.
+
+    :arg file_ids: The IDs of the files to build. None means all of them.
+
+    """
+    if file_ids is None:
+        return ((start, end, None) for start, end in
+                _sliced_range_bounds(1, max_file_id, slice_size))
+    file_ids = sorted(file_ids)
+    return ((chunk[0], chunk[-1], chunk) for chunk in
+            (file_ids[i:i + slice_size] for i in
+             xrange(0, len(file_ids), slice_size)))
+
+
+def run_html_workers(tree, config, max_file_id, file_ids=None):
+    """Farm out the building of HTML to a pool of processes.
+
+    :arg file_ids: The IDs of the files to build HTML for. None means all of
+        them.
+
+    """
 
     print ' - Initializing worker pool'
 
     with ProcessPoolExecutor(max_workers=int(tree.config.nb_jobs)) as pool:
         print ' - Enqueuing jobs'
-        futures = [pool.submit(_build_html_for_file_ids, tree, start, end) for
-                   (start, end) in _sliced_range_bounds(1, max_file_id, 500)]
+        futures = [pool.submit(_build_html_for_file_ids, tree, start, end, ids)
+                   for start, end, ids in _html_jobs(max_file_id, file_ids)]
         print ' - Waiting for workers to complete'
         for num_done, future in enumerate(as_completed(futures), 1):
             print '%s of %s HTML workers done.' % (num_done, len(futures))
@@ -477,11 +1083,14 @@ def run_html_workers(tree, config, max_file_id):
                 raise type, value  # exits with non-zero
 
 
-def _build_html_for_file_ids(tree, start, end):
+def _build_html_for_file_ids(tree, start, end, file_ids=None):
     """Write HTML files for file IDs from ``start`` to ``end``. Return None if
     all goes well, a tuple of (stringified exception, exc type, exc value, file
     ID, file path) if something goes wrong while htmlifying a file.
 
+    :arg file_ids: If not None, a list of IDs between ``start`` and ``end``
+        to restrict ourselves to
+
     This is the top-level function of an HTML worker process. Log progress to a
     file named "build-html-<start>-<end>.log".
 
@@ -507,16 +1116,20 @@ def _build_html_for_file_ids(tree, start, end):
             start_time = datetime.now()
 
             # Fetch and htmlify each document:
+            sql = """
+                SELECT files.id, path, icon, trg_index.text
+                FROM trg_index, files
+                WHERE trg_index.id = files.id
+                AND trg_index.id >= ?
+                AND trg_index.id <= ?
+                """
+            args = [start, end]
+            if file_ids is not None:
+                sql += "AND trg_index.id IN (%s)" % ','.join('?' * len(file_ids))
+                args += file_ids
+            num_files = 0
             for num_files, (id, path, icon, text) in enumerate(
-                    conn.execute("""
-                                 SELECT files.id, path, icon, trg_index.text
-                                 FROM trg_index, files
-                                 WHERE trg_index.id = files.id
-                                 AND trg_index.id >= ?
-                                 AND trg_index.id <= ?
-                                 """,
-                                 [start, end]),
-                    1):
+                    conn.execute(sql, args), 1):
                 dst_path = os.path.join(tree.target_folder, path + '.html')
                 log.write('Starting %s.\n' % path)
                 htmlify(tree, conn, icon, path, text, dst_path, plugins)
@@ -540,38 +1153,28 @@ def htmlify(tree, conn, icon, path, text, dst_path, plugins):
         htmlifier = plugin.htmlify(path, text)
         if htmlifier:
             htmlifiers.append(htmlifier)
-    # Load template
-    env = load_template_env(tree.config.temp_folder,
-                            tree.config.dxrroot)
-
-    arguments = {
-        # Set common template variables
-        'wwwroot': tree.config.wwwroot,
-        'tree': tree.name,
-        'tree_tuples': [(t.name,
-                         browse_url(t.name, tree.config.wwwroot, path),
-                         t.description)
-                        for t in tree.config.sorted_tree_order],
-        'generated_date': tree.config.generated_date,
-        'filters': filter_menu_items(tree.config.filter_language),
-
+    context = render_context(tree)
+    # With menu_table set, links carry just the indices of their menus, and
+    # the menus themselves are written once, after the code.
+    menu_table = MenuTable() if tree.config.menu_table else None
+    arguments = context.arguments(
+        path,
         # Set file template variables
-        'paths_and_names': linked_pathname(path, tree.name),
-        'icon': icon,
-        'path': path,
-        'name': os.path.basename(path),
+        icon=icon,
+        name=os.path.basename(path),
 
-        # Someday, it would be great to stream this and not concretize the
-        # whole thing in RAM. The template will have to quit looping through
-        # the whole thing 3 times.
-        'lines': list(lines_and_annotations(build_lines(text, htmlifiers,
-                                                        tree.source_encoding),
-                                            htmlifiers)),
+        # The template makes a single pass over the lines, streaming them to
+        # disk as they're built, so they never all have to be in RAM at once.
+        # Everything it needs before the code itself is small: a line count
+        # for the gutter and the (sparse) annotations.
+        lines=build_lines(text, htmlifiers, tree.source_encoding, menu_table),
+        line_numbers=xrange(1, line_count(text) + 1),
+        menus=menu_table,
+        annotations=sparse_annotations(htmlifiers),
 
-        'sections': build_sections(tree, conn, path, text, htmlifiers)
-    }
+        sections=build_sections(tree, conn, path, text, htmlifiers))
 
-    _fill_and_write_template(env, 'file.html', dst_path, arguments)
+    _write_page(tree, context.file_template, dst_path, arguments)
 
 
 class Line(object):
@@ -612,20 +1215,90 @@ class Region(TagWriter):
         return u'</span>'
 
 
+# The JSON of the menus lately written, and that escaped for an attribute, by
+# menu id
+_menu_json = LRUCache(10000)
+
+
+def menu_json(menu):
+    """Return a context menu's JSON and that JSON escaped for use in an
+    attribute.
+
+    Plugins hand out the same menu object for every reference to a symbol, so
+    each is serialized only once. The menu is cached alongside, so its id
+    can't be reused while it's cached.
+
+    """
+    cached_menu, text, attr = _menu_json.get(id(menu), (None, None, None))
+    if cached_menu is not menu:
+        text = json.dumps(menu, separators=(',', ':'))
+        attr = cgi.escape(text, True)
+        _menu_json.put(id(menu), (menu, text, attr))
+    return text, attr
+
+
+class MenuTable(object):
+    """The distinct context menus of a page, each written once, at the end,
+    for its links to refer to by index rather than each carrying a copy"""
+
+    def __init__(self):
+        self._indices = {}  # JSON of each menu: its index
+        self._menus = []  # JSON of each menu, in index order
+
+    def index(self, menu):
+        """Return the index of a menu in the table, adding it if need be."""
+        text = menu_json(menu)[0]
+        index = self._indices.get(text)
+        if index is None:
+            index = self._indices[text] = len(self._menus)
+            self._menus.append(text)
+        return index
+
+    def __len__(self):
+        return len(self._menus)
+
+    def json(self):
+        """Return the table as a JSON array, safe to put in a <script>.
+
+        Every ``<`` is escaped, not just those of ``</``, so neither a closing
+        tag nor a ``<!--`` can end or confuse the script element, and so are
+        the line and paragraph separators, which JS string literals can't
+        hold raw. ``<`` appears only inside JSON strings, so the result is
+        still the same JSON.
+
+        """
+        return Markup(('[%s]' % ','.join(self._menus))
+                      .replace(u'<', u'\\u003c')
+                      .replace(u'\u2028', u'\\u2028')
+                      .replace(u'\u2029', u'\\u2029'))
+
+
 class Ref(TagWriter):
-    """Thing to open and close <a> tags"""
+    """Thing to open and close <a> tags
+
+    :arg menu_table: A MenuTable to refer to the menu through, or None to
+        write the menu itself into the tag
+
+    """
     sort_order = 1
 
+    def __init__(self, payload, menu_table=None):
+        super(Ref, self).__init__(payload)
+        self.menu_table = menu_table
+
     def opener(self):
         menu, qualname, value = self.payload
-        menu = cgi.escape(json.dumps(menu), True)
+        if self.menu_table is None:
+            menu = ' data-menu="%s"' % menu_json(menu)[1]
+        else:
+            menu = ' data-menu-id="%d"' % self.menu_table.index(menu)
         css_class = ''
         if qualname:
             css_class = ' class=\"tok' + str(hash(qualname)) +'\"'
         title = ''
         if value:
             title = ' title="' + cgi.escape(value, True) + '"'
-        return u'<a data-menu="%s"%s%s>' % (menu, css_class, title)
+        return u'<a%s%s%s>' % (menu, css_class, title)
 
     def closer(self):
         return u'</a>'
@@ -775,7 +1448,7 @@ def balanced_tags_with_empties(tags):
     yield point, False, LINE
 
 
-def tag_boundaries(htmlifiers):
+def tag_boundaries(htmlifiers, menu_table=None):
     """Return a sequence of (offset, is_start, Region/Ref/Line) tuples.
 
     Basically, split the atomic tags that come out of plugins into separate
@@ -785,9 +1458,14 @@ def tag_boundaries(htmlifiers):
     Like in Python slice notation, the offset of a tag refers to the index of
     the source code char it comes before.
 
+    :arg menu_table: A MenuTable for Refs to put their menus in, or None
+
     """
+    def ref(data):
+        return Ref(data, menu_table)
+
     for h in htmlifiers:
-        for intervals, cls in [(h.regions(), Region), (h.refs(), Ref)]:
+        for intervals, cls in [(h.regions(), Region), (h.refs(), ref)]:
             for start, end, data in intervals:
                 tag = cls(data)
                 # Filter out zero-length spans which don't do any good and
@@ -803,6 +1481,9 @@ def tag_boundaries(htmlifiers):
                     yield end, False, tag
 
 
+_newline = re.compile(r'\r\n|\r|\n')
+
+
 def line_boundaries(text):
     """Return a tag for the end of each line in a string.
 
@@ -812,10 +1493,26 @@ def line_boundaries(text):
     newline.
 
     """
+    # Equivalent to a loop over text.splitlines(True) but without making a
+    # copy of the whole text
     up_to = 0
-    for line in text.splitlines(True):
-        up_to += len(line)
+    for match in _newline.finditer(text):
+        up_to = match.end()
         yield up_to, False, LINE
+    if up_to < len(text):
+        yield len(text), False, LINE
+
+
+def line_count(text):
+    """Return the number of lines ``build_lines()`` will make of a string.
+
+    :arg text: A UTF-8-encoded string
+
+    """
+    count = text.count('\n') + text.count('\r') - text.count('\r\n')
+    if text and text[-1] not in '\r\n':
+        count += 1  # The last line has no newline.
+    return count
 
 
 def non_overlapping_refs(tags):
@@ -902,12 +1599,15 @@ def nesting_order((point, is_start, payload)):
                              -payload.sort_order)
 
 
-def build_lines(text, htmlifiers, encoding='utf-8'):
+def build_lines(text, htmlifiers, encoding='utf-8', menu_table=None):
     """Yield lines of Markup, with decorations from the htmlifier plugins
     applied.
 
     :arg text: UTF-8-encoded string. (In practice, this is not true if the
         input file wasn't UTF-8. We should make it true.)
+    :arg menu_table: A MenuTable to collect the context menus in, leaving
+        just their indices in the links, or None to put each link's menu in
+        the link itself
 
     """
     decoder = getdecoder(encoding)
@@ -919,12 +1619,34 @@ def build_lines(text, htmlifiers, encoding='utf-8'):
     # offsets. However, I think only the clang plugin returns byte offsets. I
     # bet Pygments returns char ones. We should homogenize one way or the
     # other.
-    tags = list(tag_boundaries(htmlifiers))  # start and endpoints of intervals
-    tags.extend(line_boundaries(text))
+    # start and endpoints of intervals:
+    tags = list(tag_boundaries(htmlifiers, menu_table))
     tags.sort(key=nesting_order)  # Balanced_tags undoes this, but we tolerate
                                   # that in html_lines().
     remove_overlapping_refs(tags)
-    return html_lines(balanced_tags(tags), decoded_slice)
+    # Line boundaries are merged in lazily rather than being sorted into the
+    # list, so memory scales with the number of plugin tags, not lines. No
+    # Line sorts equal to any other tag, so this is the same order as sorting
+    # them in.
+    return html_lines(balanced_tags(_merged_by_nesting_order(
+                          tags, line_boundaries(text))),
+                      decoded_slice)
+
+
+def _merged_by_nesting_order(*iterables):
+    """Lazily merge iterables of tags, each sorted by ``nesting_order()``."""
+    decorated = [((nesting_order(tag), tag) for tag in tags) for tags in
+                 iterables]
+    return (tag for key, tag in merge(*decorated))
+
+
+def sparse_annotations(htmlifiers):
+    """Collect the annotations for each annotated line, and return a list of
+    (line number, annotations list), in order by line."""
+    return [(line, [data for line_num, data in annotations]) for
+            line, annotations in
+            groupby(merge(*[h.annotations() for h in htmlifiers]),
+                    itemgetter(0))]
 
 
 def lines_and_annotations(lines, htmlifiers):
@@ -943,13 +1665,12 @@ def lines_and_annotations(lines, htmlifiers):
 
         """
         next_unannotated_line = 0
-        for line, annotations in groupby(annotations, itemgetter(0)):
+        for line, annotations in annotations:
             for next_unannotated_line in xrange(next_unannotated_line,
                                                 line - 1):
                 yield []
-            yield [data for line_num, data in annotations]
+            yield annotations
             next_unannotated_line = line
     return izip_longest(lines,
-                        non_sparse_annotations(merge(*[h.annotations() for h in
-                                                       htmlifiers])),
+                        non_sparse_annotations(sparse_annotations(htmlifiers)),
                         fillvalue=[])
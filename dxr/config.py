@@ -7,6 +7,7 @@ from os.path import isdir
 import sys
 
 import dxr
+from dxr.utils import PRECOMPRESSED_SUFFIXES
 
 
 # Please keep these config objects as simple as possible and in sync with
@@ -32,6 +33,9 @@ class Config(object):
             'generated_date':   datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S +0000"),
             'disable_workers':  "",
             'skip_stages':      "",
+            'menu_table':       "",
+            'compress_html':    "",
+            'pack_html':        "",
             'default_tree':     "",
             'filter_language':  "C"
         }, dict_type=OrderedDict)
@@ -51,6 +55,9 @@ class Config(object):
         self.generated_date   = parser.get('DXR', 'generated_date',   False, override)
         self.disable_workers  = parser.get('DXR', 'disable_workers',  False, override)
         self.skip_stages      = parser.get('DXR', 'skip_stages',      False, override)
+        self.menu_table       = parser.get('DXR', 'menu_table',       False, override)
+        self.compress_html    = parser.get('DXR', 'compress_html',    False, override)
+        self.pack_html        = parser.get('DXR', 'pack_html',        False, override)
         self.default_tree     = parser.get('DXR', 'default_tree',     False, override)
         self.filter_language  = parser.get('DXR', 'filter_language',  False, override)
         # Set configfile
@@ -82,6 +89,21 @@ class Config(object):
         # Convert skipped stages to a list
         self.skip_stages = self.skip_stages.split()
 
+        # Convert the encodings to pre-compress HTML in to a list
+        self.compress_html = self.compress_html.split()
+        for encoding in self.compress_html:
+            if encoding not in PRECOMPRESSED_SUFFIXES:
+                print >> sys.stderr, ("compress_html: unknown encoding '%s'" %
+                                      encoding)
+                sys.exit(1)
+        if 'br' in self.compress_html:
+            try:
+                import brotli
+            except ImportError:
+                print >> sys.stderr, ("compress_html: 'br' requires the brotli "
+                                      "module")
+                sys.exit(1)
+
         # Convert enabled plugins to a list
         if self.enabled_plugins == "*":
             self.enabled_plugins = [
@@ -14,9 +14,63 @@ language_schema = dxr.schema.Schema({
         ("path", "VARCHAR(1024)", True),
         ("icon", "VARCHAR(64)", True),
         ("encoding", "VARCHAR(16)", False),
+        ("mtime", "REAL", True),          # Fingerprint of the file as of the
+        ("size", "INTEGER", True),        # last build, for incremental
+        ("hash", "VARCHAR(40)", True),    # rebuilds (SHA-1 of the contents)
         ("_key", "id"),
         ("_index", "path"),               # TODO: Make this a unique index
     ],
+    # Where each line of each file starts, so search results can pull out just
+    # the lines they show rather than whole files
+    "newlines": [
+        ("id", "INTEGER", False),         # ID of the file
+        ("offsets", "BLOB", False),       # Byte offsets of its newlines, as
+                                          # little-endian 32-bit ints
+        ("_key", "id"),
+    ],
+    # Where each page lies in the page archive, if pages are packed into one
+    # (see dxr.archive)
+    "pages": [
+        ("path", "VARCHAR(1024)", False), # Path of the page within the tree's
+                                          # folder, like "foo/bar.c.html"
+        ("offset", "INTEGER", False),     # Where in the archive it starts
+        ("length", "INTEGER", False),     # How many bytes long it is
+        ("_key", "path"),
+    ],
+    # The symbol name index, so searches for names of functions, types and so
+    # on needn't scan those tables: the distinct names, lowercased...
+    "symbol_names": [
+        ("id", "INTEGER", False),
+        ("name", "VARCHAR(256)", False),
+        ("_key", "id"),
+        ("_index", "name"),
+    ],
+    # ...the 3-character substrings of each, for finding names that contain
+    # a string...
+    "symbol_name_trigrams": [
+        ("trigram", "VARCHAR(3)", False),
+        ("name_id", "INTEGER", False),    # ID of a name containing the trigram
+        ("_key", "trigram", "name_id"),
+    ],
+    # ...and which symbols bear each name
+    "symbols": [
+        ("name_id", "INTEGER", False),    # ID of the symbol's name
+        ("tbl", "VARCHAR(64)", False),    # Table the symbol is in
+        ("id", "INTEGER", False),         # ID of the symbol in that table
+        ("_key", "name_id", "tbl", "id"),
+    ],
+    # Everything a search could be an exact match for, and the one place each
+    # leads to, so jumping straight to it takes one lookup. See
+    # Query.direct_result().
+    "direct_hits": [
+        ("tier", "INTEGER", False),       # Kind of name: a DIRECT_* constant
+        ("name", "VARCHAR(1024)", False), # Path, name, or qualname, lowercased
+                                          # for the case-insensitive tiers
+        ("path", "VARCHAR(1024)", True),  # Where the name is, if it's only
+        ("line", "INTEGER", True),        # in one place
+        ("count", "INTEGER", False),      # How many places the name is in
+        ("_key", "tier", "name"),
+    ],
     "scopes": [
         ("id", "INTEGER", False),         # An ID for this scope
         ("name", "VARCHAR(256)", True),   # Name of the scope
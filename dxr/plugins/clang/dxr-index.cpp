@@ -62,6 +62,17 @@ const char *hash(std::string &str) {
 std::string srcdir;
 std::string output;
 std::string tmpdir; // Place to save all the csv files to
+// Whether to write the compact binary format rather than CSV. See
+// parse_binary_indexer_output() in indexer.py for a description of it.
+bool binaryOutput = false;
+
+// Append a little-endian 32-bit int to a string.
+void appendU32(std::string &buf, unsigned int i) {
+  buf += char(i & 0xff);
+  buf += char((i >> 8) & 0xff);
+  buf += char((i >> 16) & 0xff);
+  buf += char((i >> 24) & 0xff);
+}
 
 struct FileInfo {
   FileInfo(std::string &rname) : realname(rname) {
@@ -80,6 +91,8 @@ struct FileInfo {
   std::string realname;
   std::ostringstream info;
   bool interesting;
+  // For binary output: the IDs of the strings already written to info
+  std::map<std::string, unsigned int> strings;
 };
 
 class IndexConsumer;
@@ -126,6 +139,8 @@ private:
   CompilerInstance &ci;
   SourceManager &sm;
   std::ostream *out;
+  FileInfo *outFile;  // The file whose info out points to
+  std::string record;  // The binary record being built
   std::map<std::string, FileInfo *> relmap;
   LangOptions &features;
   DiagnosticConsumer *inner;
@@ -255,12 +270,56 @@ public:
     return ret;
   }
 
+  // Write a binary frame: its length, then its contents.
+  void writeFrame(const std::string &frame) {
+    std::string length;
+    appendU32(length, frame.size());
+    *out << length << frame;
+  }
+
+  // Return the ID of a string in the current binary output file, writing it
+  // out first if this is the first time it's been used.
+  unsigned int intern(const std::string &str) {
+    std::map<std::string, unsigned int>::iterator it = outFile->strings.find(str);
+    if (it != outFile->strings.end())
+      return it->second;
+    unsigned int id = outFile->strings.size();
+    outFile->strings.insert(make_pair(str, id));
+    writeFrame("S" + str);
+    return id;
+  }
+
   void beginRecord(const char *name, SourceLocation loc) {
-    FileInfo *f = getFileInfo(sm.getPresumedLoc(loc).getFilename());
-    out = &f->info;
-    *out << name;
+    outFile = getFileInfo(sm.getPresumedLoc(loc).getFilename());
+    out = &outFile->info;
+    if (binaryOutput) {
+      record = "R";
+      appendU32(record, intern(name));
+    } else {
+      *out << name;
+    }
+  }
+  void endRecord() {
+    if (binaryOutput)
+      writeFrame(record);
+    else
+      *out << std::endl;
   }
+  // needQuotes marks free-form text, which isn't worth interning in binary
+  // output.
   void recordValue(const char *key, std::string value, bool needQuotes=false) {
+    if (binaryOutput) {
+      appendU32(record, intern(key));
+      if (needQuotes) {
+        record += 'b';
+        appendU32(record, value.size());
+        record += value;
+      } else {
+        record += 's';
+        appendU32(record, intern(value));
+      }
+      return;
+    }
     *out << "," << key << ",\"";
     int start = 0;
     if (needQuotes) {
@@ -274,6 +333,18 @@ public:
     }
     *out << value.substr(start) << "\"";
   }
+  void recordLocation(const char *key, SourceLocation loc) {
+    if (!binaryOutput) {
+      recordValue(key, locationToString(loc));
+      return;
+    }
+    PresumedLoc fixed = sm.getPresumedLoc(loc);
+    appendU32(record, intern(key));
+    record += 'l';
+    appendU32(record, intern(getFileInfo(fixed.getFilename())->realname));
+    appendU32(record, fixed.getLine());
+    appendU32(record, fixed.getColumn());
+  }
 
   SourceLocation getFileLocation(SourceLocation loc) {
     while (loc.isValid() && loc.isMacroID())
@@ -292,9 +363,17 @@ public:
     end   = getFileLocation(end);
     if (!begin.isValid() || !end.isValid())
       return;
-    *out << ",extent," << sm.getDecomposedSpellingLoc(begin).second << ":" <<
-      sm.getDecomposedSpellingLoc(
-        Lexer::getLocForEndOfToken(end, 0, sm, features)).second;
+    unsigned int beginOffset = sm.getDecomposedSpellingLoc(begin).second;
+    unsigned int endOffset = sm.getDecomposedSpellingLoc(
+      Lexer::getLocForEndOfToken(end, 0, sm, features)).second;
+    if (binaryOutput) {
+      appendU32(record, intern("extent"));
+      record += 'e';
+      appendU32(record, beginOffset);
+      appendU32(record, endOffset);
+    } else {
+      *out << ",extent," << beginOffset << ":" << endOffset;
+    }
   }
 
   Decl *getNonClosureDecl(Decl *d)
@@ -324,7 +403,7 @@ public:
           namesource = redecl;
       }
       recordValue("scopename", getQualifiedName(*namesource));
-      recordValue("scopeloc", locationToString(scope->getLocation()));
+      recordLocation("scopeloc", scope->getLocation());
     }
   }
 
@@ -334,12 +413,12 @@ public:
 
     beginRecord("decldef", decl->getLocation());
     recordValue("qualname", getQualifiedName(*def));
-    recordValue("declloc", locationToString(decl->getLocation()));
-    recordValue("defloc", locationToString(def->getLocation()));
+    recordLocation("declloc", decl->getLocation());
+    recordLocation("defloc", def->getLocation());
     if (kind)
       recordValue("kind", kind);
     printExtent(begin, end);
-    *out << std::endl;
+    endRecord();
   }
 
   // All we need is to follow the final declaration.
@@ -361,7 +440,7 @@ public:
       filename += hash(it->second->realname);
       filename += ".";
       filename += hash(content);
-      filename += ".csv";
+      filename += binaryOutput ? ".bin" : ".csv";
 
       // Okay, I want to use the standard library for I/O as much as possible,
       // but the C/C++ standard library does not have the feature of "open
@@ -389,12 +468,12 @@ public:
         nd = d;
       recordValue("name", nd->getNameAsString());
       recordValue("qualname", getQualifiedName(*nd));
-      recordValue("loc", locationToString(d->getLocation()));
+      recordLocation("loc", d->getLocation());
       recordValue("kind", d->getKindName());
       printScope(d);
       // Linkify the name, not the `enum'
       printExtent(nd->getLocation(), nd->getLocation());
-      *out << std::endl;
+      endRecord();
     }
 
     declDef("type", d, d->getDefinition(), d->getLocation(), d->getLocation());
@@ -415,19 +494,20 @@ public:
         return true;
       beginRecord("impl", d->getLocation());
       recordValue("tcname", getQualifiedName(*d));
-      recordValue("tcloc", locationToString(d->getLocation()));
+      recordLocation("tcloc", d->getLocation());
       recordValue("tbname", getQualifiedName(*base));
-      recordValue("tbloc", locationToString(base->getLocation()));
-      *out << ",access,\"";
+      recordLocation("tbloc", base->getLocation());
+      std::string access;
       switch ((*iter).getAccessSpecifierAsWritten()) {
-      case AS_public: *out << "public"; break;
-      case AS_protected: *out << "protected"; break;
-      case AS_private: *out << "private"; break;
+      case AS_public: access = "public"; break;
+      case AS_protected: access = "protected"; break;
+      case AS_private: access = "private"; break;
       case AS_none: break; // It's implied, but we can ignore that
       }
       if ((*iter).isVirtual())
-        *out << " virtual";
-      *out << "\"" << std::endl;
+        access += " virtual";
+      recordValue("access", access);
+      endRecord();
     }
     return true;
   }
@@ -453,7 +533,7 @@ public:
         args.erase(1, 2);
       args += ")";
       recordValue("args", args);
-      recordValue("loc", locationToString(d->getLocation()));
+      recordLocation("loc", d->getLocation());
       printScope(d);
       printExtent(d->getNameInfo().getBeginLoc(), d->getNameInfo().getEndLoc());
       // Print out overrides
@@ -462,10 +542,10 @@ public:
         CXXMethodDecl::method_iterator iter = cxxd->begin_overridden_methods();
         if (iter) {
           recordValue("overridename", getQualifiedName(**iter));
-          recordValue("overrideloc", locationToString((*iter)->getLocation()));
+          recordLocation("overrideloc", (*iter)->getLocation());
         }
       }
-      *out << std::endl;
+      endRecord();
     }
 
     const FunctionDecl *def;
@@ -539,14 +619,14 @@ public:
       beginRecord("variable", d->getLocation());
       recordValue("name", d->getNameAsString());
       recordValue("qualname", getQualifiedName(*d));
-      recordValue("loc", locationToString(d->getLocation()));
+      recordLocation("loc", d->getLocation());
       recordValue("type", d->getType().getAsString(), true);
       const std::string &value = getValueForValueDecl(d);
       if (!value.empty())
         recordValue("value", value, true);
       printScope(d);
       printExtent(d->getLocation(), d->getLocation());
-      *out << std::endl;
+      endRecord();
     }
     if (VarDecl *vd = dyn_cast<VarDecl>(d)) {
       VarDecl *def = vd->getDefinition();
@@ -595,11 +675,11 @@ public:
     beginRecord("typedef", d->getLocation());
     recordValue("name", d->getNameAsString());
     recordValue("qualname", getQualifiedName(*d));
-    recordValue("loc", locationToString(d->getLocation()));
+    recordLocation("loc", d->getLocation());
 //    recordValue("underlying", d->getUnderlyingType().getAsString());
     printScope(d);
     printExtent(d->getLocation(), d->getLocation());
-    *out << std::endl;
+    endRecord();
     return true;
   }
 
@@ -612,10 +692,10 @@ public:
     beginRecord("typedef", d->getLocation());
     recordValue("name", d->getNameAsString());
     recordValue("qualname", getQualifiedName(*d));
-    recordValue("loc", locationToString(d->getLocation()));
+    recordLocation("loc", d->getLocation());
     printScope(d);
     printExtent(d->getLocation(), d->getLocation());
-    *out << std::endl;
+    endRecord();
     return true;
   }
 
@@ -627,9 +707,9 @@ public:
     beginRecord("namespace", d->getLocation());
     recordValue("name", d->getNameAsString());
     recordValue("qualname", getQualifiedName(*d));
-    recordValue("loc", locationToString(d->getLocation()));
+    recordLocation("loc", d->getLocation());
     printExtent(d->getLocation(), d->getLocation());
-    *out << std::endl;
+    endRecord();
     return true;
   }
 
@@ -642,9 +722,9 @@ public:
     beginRecord("namespace_alias", d->getAliasLoc());
     recordValue("name", d->getNameAsString());
     recordValue("qualname", getQualifiedName(*d));
-    recordValue("loc", locationToString(d->getAliasLoc()));
+    recordLocation("loc", d->getAliasLoc());
     printExtent(d->getAliasLoc(), d->getAliasLoc());
-    *out << std::endl;
+    endRecord();
 
     if (d->getQualifierLoc())
       visitNestedNameSpecifierLoc(d->getQualifierLoc());
@@ -695,12 +775,12 @@ public:
     if (!interestingLocation(d->getLocation()) || !interestingLocation(refLoc))
       return;
     beginRecord("ref", refLoc);
-    recordValue("declloc", locationToString(d->getLocation()));
-    recordValue("loc", locationToString(refLoc));
+    recordLocation("declloc", d->getLocation());
+    recordLocation("loc", refLoc);
     if (kind)
       recordValue("kind", kind);
     printExtent(refLoc, end);
-    *out << std::endl;
+    endRecord();
   }
   const char *kindForDecl(const Decl *d)
   {
@@ -755,10 +835,10 @@ public:
     beginRecord("call", e->getLocStart());
     if (m_currentFunction) {
       recordValue("callername", getQualifiedName(*m_currentFunction));
-      recordValue("callerloc", locationToString(m_currentFunction->getLocation()));
+      recordLocation("callerloc", m_currentFunction->getLocation());
     }
     recordValue("calleename", getQualifiedName(*dyn_cast<NamedDecl>(callee)));
-    recordValue("calleeloc", locationToString(callee->getLocation()));
+    recordLocation("calleeloc", callee->getLocation());
     // Determine the type of call
     const char *type = "static";
     if (CXXMethodDecl::classof(callee)) {
@@ -774,7 +854,7 @@ public:
       type = "funcptr";
     }
     recordValue("calltype", type);
-    *out << std::endl;
+    endRecord();
     return true;
   }
 
@@ -794,15 +874,15 @@ public:
     beginRecord("call", e->getLocStart());
     if (m_currentFunction) {
       recordValue("callername", getQualifiedName(*m_currentFunction));
-      recordValue("callerloc", locationToString(m_currentFunction->getLocation()));
+      recordLocation("callerloc", m_currentFunction->getLocation());
     }
     recordValue("calleename", getQualifiedName(*dyn_cast<NamedDecl>(callee)));
-    recordValue("calleeloc", locationToString(callee->getLocation()));
+    recordLocation("calleeloc", callee->getLocation());
 
     // There are no virtual constructors in C++:
     recordValue("calltype", "static");
 
-    *out << std::endl;
+    endRecord();
     return true;
   }
 
@@ -936,7 +1016,7 @@ public:
     info.FormatDiagnostic(message);
 
     beginRecord("warning", info.getLocation());
-    recordValue("loc", locationToString(info.getLocation()));
+    recordLocation("loc", info.getLocation());
     recordValue("msg", message.c_str(), true);
     StringRef opt = DiagnosticIDs::getWarningOptionForDiag(info.getID());
     if (!opt.empty())
@@ -949,7 +1029,7 @@ public:
       SourceLocation loc = getWarningExtentLocation(info.getLocation());
       printExtent(loc, loc);
     }
-    *out << std::endl;
+    endRecord();
   }
 
   // Macros!
@@ -988,7 +1068,7 @@ public:
       break;
     }
     beginRecord("macro", nameStart);
-    recordValue("loc", locationToString(nameStart));
+    recordLocation("loc", nameStart);
     recordValue("name", std::string(contents, nameLen));
     if (argsStart > 0)
       recordValue("args", std::string(contents + argsStart,
@@ -1003,7 +1083,7 @@ public:
       recordValue("text", text, true);
     }
     printExtent(nameStart, nameStart);
-    *out << std::endl;
+    endRecord();
   }
 
   void printMacroReference(const Token &tok, const MacroInfo *MI) {
@@ -1020,11 +1100,11 @@ public:
     SourceLocation refLoc = tok.getLocation();
     beginRecord("ref", refLoc);
     recordValue("name", std::string(ii->getNameStart(), ii->getLength()));
-    recordValue("declloc", locationToString(macroLoc));
-    recordValue("loc", locationToString(refLoc));
+    recordLocation("declloc", macroLoc);
+    recordLocation("loc", refLoc);
     recordValue("kind", "macro");
     printExtent(refLoc, refLoc);
-    *out << std::endl;
+    endRecord();
   }
 
   virtual void MacroExpands(const Token &tok, const MacroInfo *MI, SourceRange Range) {
@@ -1083,7 +1163,7 @@ public:
     recordValue("source_path", source->realname);
     recordValue("target_path", target->realname);
     printExtent(targetBegin, targetEnd);
-    *out << std::endl;
+    endRecord();
   }
 
 };
@@ -1202,6 +1282,8 @@ protected:
     tmpdir = realpath(tmpdir.c_str(), NULL);
     tmpdir += "/";
 
+    binaryOutput = getenv("DXR_CXX_CLANG_BINARY_OUTPUT") != NULL;
+
     return true;
   }
   void PrintHelp(llvm::raw_ostream& ros) {
@@ -3,7 +3,7 @@ import os, sys
 import fnmatch
 import urllib, re
 
-from dxr.utils import search_url
+from dxr.utils import LRUCache, search_url
 
 
 class ClangHtmlifier(object):
@@ -19,235 +19,28 @@ class ClangHtmlifier(object):
 
     def refs(self):
         """ Generate reference menus """
-        # We'll need this argument for all queries here
-        args = (self.file_id,)
-
-        # Extents for functions defined here
-        sql = """
-            SELECT extent_start, extent_end, qualname,
-                EXISTS (SELECT targetid FROM targets WHERE funcid=functions.id) AS isvirtual
-                FROM functions
-              WHERE file_id = ?
-        """
-        for start, end, qualname, isvirtual in self.conn.execute(sql, args):
-            yield start, end, (self.function_menu(qualname, isvirtual), qualname, None)
-
-        # Extents for functions declared here
-        sql = """
-            SELECT decldef.extent_start,
-                          decldef.extent_end,
-                          functions.qualname,
-                          (SELECT path FROM files WHERE files.id = functions.file_id),
-                          functions.file_line,
-                          EXISTS (SELECT targetid FROM targets WHERE funcid=functions.id) AS isvirtual
-                FROM function_decldef AS decldef, functions
-              WHERE decldef.defid = functions.id
-                  AND decldef.file_id = ?
-        """
-        for start, end, qualname, path, line, isvirtual in self.conn.execute(sql, args):
-            menu = self.function_menu(qualname, isvirtual)
-            self.add_jump_definition(menu, path, line)
-            yield start, end, (menu, qualname, None)
-
-        # Extents for variables defined here
-        sql = """
-            SELECT extent_start, extent_end, qualname, value
-                FROM variables
-              WHERE file_id = ?
-        """
-        for start, end, qualname, value in self.conn.execute(sql, args):
-            yield start, end, (self.variable_menu(qualname), qualname, value)
-
-        # Extents for variables declared here
-        sql = """
-            SELECT decldef.extent_start,
-                          decldef.extent_end,
-                          variables.qualname,
-                          variables.value,
-                          (SELECT path FROM files WHERE files.id = variables.file_id),
-                          variables.file_line
-                FROM variable_decldef AS decldef, variables
-              WHERE decldef.defid = variables.id
-                  AND decldef.file_id = ?
-        """
-        for start, end, qualname, value, path, line in self.conn.execute(sql, args):
-            menu = self.variable_menu(qualname)
-            self.add_jump_definition(menu, path, line)
-            yield start, end, (menu, qualname, value)
-
-        # Extents for types defined here
-        sql = """
-            SELECT extent_start, extent_end, qualname, kind
-                FROM types
-              WHERE file_id = ?
-        """
-        for start, end, qualname, kind in self.conn.execute(sql, args):
-            yield start, end, (self.type_menu(qualname, kind), qualname, None)
-
-        # Extents for types declared here
-        sql = """
-            SELECT decldef.extent_start,
-                          decldef.extent_end,
-                          types.qualname,
-                          types.kind,
-                          (SELECT path FROM files WHERE files.id = types.file_id),
-                          types.file_line
-                FROM type_decldef AS decldef, types
-              WHERE decldef.defid = types.id
-                  AND decldef.file_id = ?
-        """
-        for start, end, qualname, kind, path, line in self.conn.execute(sql, args):
-            menu = self.type_menu(qualname, kind)
-            self.add_jump_definition(menu, path, line)
-            yield start, end, (menu, qualname, None)
-
-        # Extents for typedefs defined here
-        sql = """
-            SELECT extent_start, extent_end, qualname
-                FROM typedefs
-              WHERE file_id = ?
-        """
-        for start, end, qualname in self.conn.execute(sql, args):
-            yield start, end, (self.typedef_menu(qualname), qualname, None)
-
-        # Extents for namespaces defined here
-        sql = """
-            SELECT extent_start, extent_end, qualname
-                FROM namespaces
-              WHERE file_id = ?
-        """
-        for start, end, qualname in self.conn.execute(sql, args):
-            yield start, end, (self.namespace_menu(qualname), qualname, None)
-
-        # Extents for namespace aliases defined here
-        sql = """
-            SELECT extent_start, extent_end, qualname
-                FROM namespace_aliases
-              WHERE file_id = ?
-        """
-        for start, end, qualname in self.conn.execute(sql, args):
-            yield start, end, (self.namespace_alias_menu(qualname), qualname, None)
-
-        # Extents for macros defined here
-        sql = """
-            SELECT extent_start, extent_end, name, text
-                FROM macros
-              WHERE file_id = ?
-        """
-        for start, end, name, value in self.conn.execute(sql, args):
-            yield start, end, (self.macro_menu(name), name, value)
-
-        # Add references to types
-        sql = """
-            SELECT refs.extent_start, refs.extent_end,
-                          types.qualname,
-                          types.kind,
-                          (SELECT path FROM files WHERE files.id = types.file_id),
-                          types.file_line
-                FROM types, type_refs AS refs
-              WHERE types.id = refs.refid AND refs.file_id = ?
-        """
-        for start, end, qualname, kind, path, line in self.conn.execute(sql, args):
-            menu = self.type_menu(qualname, kind)
-            self.add_jump_definition(menu, path, line)
-            yield start, end, (menu, qualname, None)
-
-        # Add references to typedefs
-        sql = """
-            SELECT refs.extent_start, refs.extent_end,
-                          typedefs.qualname,
-                          (SELECT path FROM files WHERE files.id = typedefs.file_id),
-                          typedefs.file_line
-                FROM typedefs, typedef_refs AS refs
-              WHERE typedefs.id = refs.refid AND refs.file_id = ?
-        """
-        for start, end, qualname, path, line in self.conn.execute(sql, args):
-            menu = self.typedef_menu(qualname)
-            self.add_jump_definition(menu, path, line)
-            yield start, end, (menu, qualname, None)
-
-        # Add references to functions
-        sql = """
-            SELECT refs.extent_start, refs.extent_end,
-                          functions.qualname,
-                          (SELECT path FROM files WHERE files.id = functions.file_id),
-                          functions.file_line,
-                          EXISTS (SELECT targetid FROM targets WHERE funcid=functions.id) AS isvirtual
-                FROM functions, function_refs AS refs
-              WHERE functions.id = refs.refid AND refs.file_id = ?
-        """
-        for start, end, qualname, path, line, isvirtual in self.conn.execute(sql, args):
-            menu = self.function_menu(qualname, isvirtual)
-            self.add_jump_definition(menu, path, line)
-            yield start, end, (menu, qualname, None)
-
-        # Add references to variables
-        sql = """
-            SELECT refs.extent_start, refs.extent_end,
-                          variables.qualname,
-                          variables.value,
-                          (SELECT path FROM files WHERE files.id = variables.file_id),
-                          variables.file_line
-                FROM variables, variable_refs AS refs
-              WHERE variables.id = refs.refid AND refs.file_id = ?
-        """
-        for start, end, qualname, value, path, line in self.conn.execute(sql, args):
-            menu = self.variable_menu(qualname)
-            self.add_jump_definition(menu, path, line)
-            yield start, end, (menu, qualname, value)
-
-        # Add references to namespaces
-        sql = """
-            SELECT refs.extent_start, refs.extent_end,
-                          namespaces.qualname,
-                          (SELECT path FROM files WHERE files.id = namespaces.file_id),
-                          namespaces.file_line
-                FROM namespaces, namespace_refs AS refs
-              WHERE namespaces.id = refs.refid AND refs.file_id = ?
-        """
-        for start, end, qualname, path, line in self.conn.execute(sql, args):
-            menu = self.namespace_menu(qualname)
-            yield start, end, (menu, qualname, None)
-
-        # Add references to namespace aliases
-        sql = """
-            SELECT refs.extent_start, refs.extent_end,
-                          namespace_aliases.qualname,
-                          (SELECT path FROM files WHERE files.id = namespace_aliases.file_id),
-                          namespace_aliases.file_line
-                FROM namespace_aliases, namespace_alias_refs AS refs
-              WHERE namespace_aliases.id = refs.refid AND refs.file_id = ?
-        """
-        for start, end, qualname, path, line in self.conn.execute(sql, args):
-            menu = self.namespace_alias_menu(qualname)
-            self.add_jump_definition(menu, path, line)
-            yield start, end, (menu, qualname, None)
-
-        # Add references to macros
-        sql = """
-            SELECT refs.extent_start, refs.extent_end,
-                          macros.name,
-                          macros.text,
-                          (SELECT path FROM files WHERE files.id = macros.file_id),
-                          macros.file_line
-                FROM macros, macro_refs AS refs
-              WHERE macros.id = refs.refid AND refs.file_id = ?
-        """
-        for start, end, name, value, path, line in self.conn.execute(sql, args):
-            menu = self.macro_menu(name)
-            self.add_jump_definition(menu, path, line)
-            yield start, end, (menu, name, value)
-
-        # Link all the #includes in this file to the files they reference.
-        for start, end, path in self.conn.execute(
-                'SELECT extent_start, extent_end, path FROM includes '
-                'INNER JOIN files ON files.id=includes.target_id '
-                'WHERE includes.file_id = ?', args):
-            yield start, end, ([{'html': 'Jump to file',
-                                 'title': 'Jump to what is included here.',
-                                 'href': self.tree.config.wwwroot + '/' +
-                                         self.tree.name + '/source/' + path,
-                                 'icon': 'jump'}], '', None)
+        for (kind, start, end, qualname, detail, path, line,
+             isvirtual) in self.conn.execute(_refs_sql,
+                                             (self.file_id,) * len(_ref_kinds)):
+            make_menu, detail_is_value = _ref_kinds[kind][1:]
+            if make_menu is None and path is None:
+                continue  # an #include of a file we don't know
+
+            # Popular symbols are referenced from all over, so reuse their
+            # menus, and Ref will serialize each only once.
+            key = (self.tree.name, make_menu, qualname, detail, isvirtual,
+                   path, line)
+            menu = _menus.get(key)
+            if menu is None:
+                if make_menu is None:
+                    menu = self.include_menu(path)
+                else:
+                    menu = make_menu(self, qualname, detail, isvirtual)
+                    if path is not None:
+                        self.add_jump_definition(menu, path, line)
+                _menus.put(key, menu)
+            yield start, end, (menu, qualname,
+                               detail if detail_is_value else None)
 
     def search(self, query):
         """ Auxiliary function for getting the search url for query """
@@ -273,6 +66,16 @@ class ClangHtmlifier(object):
             'icon':   'jump'
         })
 
+    def include_menu(self, path):
+        """ Build menu for an #include, linking to the file it includes """
+        return [{
+            'html':   'Jump to file',
+            'title':  'Jump to what is included here.',
+            'href':   self.tree.config.wwwroot + '/' + self.tree.name +
+                      '/source/' + path,
+            'icon':   'jump'
+        }]
+
     def type_menu(self, qualname, kind):
         """ Build menu for type """
         menu = []
@@ -496,6 +299,154 @@ class ClangHtmlifier(object):
             yield 'field', name, "#%s" % line
 
 
+# What refs() links, in the order it yields them: the SQL selecting the
+# extent, qualname, and a detail (the kind of a type or the value of a
+# variable or macro) of each thing, the file ID and line of its definition if
+# it should have a jump to that, and whether it's virtual; the function making
+# its menu from those; and whether the detail is the link's title.
+_ref_kinds = [
+    # Functions defined here
+    # (This first SELECT names the columns for all the rest.)
+    ("""SELECT extent_start, extent_end, qualname, NULL AS detail,
+               NULL AS def_file_id, NULL AS line,
+               EXISTS (SELECT targetid FROM targets WHERE funcid=functions.id)
+                   AS isvirtual
+          FROM functions
+         WHERE file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.function_menu(qualname, isvirtual),
+     False),
+    # Functions declared here
+    ("""SELECT decldef.extent_start, decldef.extent_end, functions.qualname,
+               NULL, functions.file_id, functions.file_line,
+               EXISTS (SELECT targetid FROM targets WHERE funcid=functions.id)
+          FROM function_decldef AS decldef, functions
+         WHERE decldef.defid = functions.id AND decldef.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.function_menu(qualname, isvirtual),
+     False),
+    # Variables defined here
+    ("""SELECT extent_start, extent_end, qualname, value, NULL, NULL, 0
+          FROM variables
+         WHERE file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.variable_menu(qualname),
+     True),
+    # Variables declared here
+    ("""SELECT decldef.extent_start, decldef.extent_end, variables.qualname,
+               variables.value, variables.file_id, variables.file_line, 0
+          FROM variable_decldef AS decldef, variables
+         WHERE decldef.defid = variables.id AND decldef.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.variable_menu(qualname),
+     True),
+    # Types defined here
+    ("""SELECT extent_start, extent_end, qualname, kind, NULL, NULL, 0
+          FROM types
+         WHERE file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.type_menu(qualname, detail),
+     False),
+    # Types declared here
+    ("""SELECT decldef.extent_start, decldef.extent_end, types.qualname,
+               types.kind, types.file_id, types.file_line, 0
+          FROM type_decldef AS decldef, types
+         WHERE decldef.defid = types.id AND decldef.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.type_menu(qualname, detail),
+     False),
+    # Typedefs defined here
+    ("""SELECT extent_start, extent_end, qualname, NULL, NULL, NULL, 0
+          FROM typedefs
+         WHERE file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.typedef_menu(qualname),
+     False),
+    # Namespaces defined here
+    ("""SELECT extent_start, extent_end, qualname, NULL, NULL, NULL, 0
+          FROM namespaces
+         WHERE file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.namespace_menu(qualname),
+     False),
+    # Namespace aliases defined here
+    ("""SELECT extent_start, extent_end, qualname, NULL, NULL, NULL, 0
+          FROM namespace_aliases
+         WHERE file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.namespace_alias_menu(qualname),
+     False),
+    # Macros defined here
+    ("""SELECT extent_start, extent_end, name, text, NULL, NULL, 0
+          FROM macros
+         WHERE file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.macro_menu(qualname),
+     True),
+    # References to types
+    ("""SELECT refs.extent_start, refs.extent_end, types.qualname, types.kind,
+               types.file_id, types.file_line, 0
+          FROM types, type_refs AS refs
+         WHERE types.id = refs.refid AND refs.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.type_menu(qualname, detail),
+     False),
+    # References to typedefs
+    ("""SELECT refs.extent_start, refs.extent_end, typedefs.qualname, NULL,
+               typedefs.file_id, typedefs.file_line, 0
+          FROM typedefs, typedef_refs AS refs
+         WHERE typedefs.id = refs.refid AND refs.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.typedef_menu(qualname),
+     False),
+    # References to functions
+    ("""SELECT refs.extent_start, refs.extent_end, functions.qualname, NULL,
+               functions.file_id, functions.file_line,
+               EXISTS (SELECT targetid FROM targets WHERE funcid=functions.id)
+          FROM functions, function_refs AS refs
+         WHERE functions.id = refs.refid AND refs.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.function_menu(qualname, isvirtual),
+     False),
+    # References to variables
+    ("""SELECT refs.extent_start, refs.extent_end, variables.qualname,
+               variables.value, variables.file_id, variables.file_line, 0
+          FROM variables, variable_refs AS refs
+         WHERE variables.id = refs.refid AND refs.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.variable_menu(qualname),
+     True),
+    # References to namespaces (which get no jump, as they're all over)
+    ("""SELECT refs.extent_start, refs.extent_end, namespaces.qualname, NULL,
+               NULL, NULL, 0
+          FROM namespaces, namespace_refs AS refs
+         WHERE namespaces.id = refs.refid AND refs.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.namespace_menu(qualname),
+     False),
+    # References to namespace aliases
+    ("""SELECT refs.extent_start, refs.extent_end, namespace_aliases.qualname,
+               NULL, namespace_aliases.file_id, namespace_aliases.file_line, 0
+          FROM namespace_aliases, namespace_alias_refs AS refs
+         WHERE namespace_aliases.id = refs.refid AND refs.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.namespace_alias_menu(qualname),
+     False),
+    # References to macros
+    ("""SELECT refs.extent_start, refs.extent_end, macros.name, macros.text,
+               macros.file_id, macros.file_line, 0
+          FROM macros, macro_refs AS refs
+         WHERE macros.id = refs.refid AND refs.file_id = ?""",
+     lambda h, qualname, detail, isvirtual: h.macro_menu(qualname),
+     True),
+    # #includes, whose "definition" is the file they include
+    ("""SELECT extent_start, extent_end, '', NULL, target_id, NULL, 0
+          FROM includes
+         WHERE file_id = ?""",
+     None,
+     False),
+]
+
+# Menus built lately, by tree, menu maker, the arguments to it, and the
+# definition they jump to, kept across files so each is built once per worker
+_menus = LRUCache(10000)
+
+# All of the above in one query, numbered by kind, with the paths of the
+# definitions looked up at once
+_refs_sql = """
+    SELECT refs.kind, refs.extent_start, refs.extent_end, refs.qualname,
+           refs.detail, files.path, refs.line, refs.isvirtual
+      FROM (%s) AS refs LEFT JOIN files ON files.id = refs.def_file_id
+     ORDER BY refs.kind
+""" % '\n     UNION ALL\n'.join(
+    sql.replace('SELECT ', 'SELECT %d AS kind, ' % kind, 1)
+    for kind, (sql, make_menu, detail_is_value) in enumerate(_ref_kinds))
+
+
 _tree = None
 _conn = None
 def load(tree, conn):
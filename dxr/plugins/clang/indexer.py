@@ -1,9 +1,12 @@
 import csv, cgi
+from datetime import datetime
 import json
+from concurrent.futures import ProcessPoolExecutor
 import dxr.plugins
 import dxr.schema
 import os, sys
 import re, urllib
+from struct import unpack_from
 from dxr.languages import language_schema
 
 
@@ -32,6 +35,8 @@ def pre_process(tree, env):
     env['DXR_CLANG_FLAGS'] = flags_str
     env['DXR_CXX_CLANG_OBJECT_FOLDER']  = tree.object_folder
     env['DXR_CXX_CLANG_TEMP_FOLDER']    = temp_folder
+    if getattr(tree, 'plugin_clang_binary_output', ''):
+        env['DXR_CXX_CLANG_BINARY_OUTPUT'] = '1'
 
 
 def post_process(tree, conn):
@@ -40,10 +45,13 @@ def post_process(tree, conn):
     conn.executescript(schema.get_create_sql())
 
     print " - Processing files"
+    load_location_caches(conn)
     temp_folder = os.path.join(tree.temp_folder, 'plugins', PLUGIN_NAME)
-    for f in os.listdir(temp_folder):
-        csv_path = os.path.join(temp_folder, f)
-        dump_indexer_output(conn, csv_path)
+    csv_paths = [os.path.join(temp_folder, f) for f in os.listdir(temp_folder)]
+    writer = BatchWriter(conn)
+    for csv_path, lines in parsed_indexer_outputs(tree, csv_paths):
+        dump_indexer_output(conn, csv_path, lines, writer)
+    writer.flush()
 
     fixup_scope(conn)
     
@@ -258,28 +266,35 @@ schema = dxr.schema.Schema({
 
 
 file_cache = {}
+scope_cache = {}  # {(file_id, file_line, file_col): scope ID}
 decl_master = {}
 inheritance = {}
 calls = {}
 overrides = {}
 
-def getFileID(conn, path):
-    global file_cache
+def load_location_caches(conn):
+    """Load all the files and scopes into memory so looking up a location
+    costs a dict lookup rather than a query.
 
-    file_id = file_cache.get(path, False)
+    Once this is called, ``file_cache`` is complete, and ``addScope()`` and
+    ``handleScope()`` keep ``scope_cache`` in step with the scopes table.
 
-    if file_id is not False:
-        return file_id
+    """
+    global file_cache, scope_cache
+    file_cache = dict(conn.execute("SELECT path, id FROM files"))
+    scope_cache = {}
+    for id, file_id, file_line, file_col in conn.execute(
+            "SELECT id, file_id, file_line, file_col FROM scopes"):
+        scope_cache.setdefault((file_id, file_line, file_col), id)
 
-    cur = conn.cursor()
-    row = cur.execute("SELECT id FROM files where path=?", (path,)).fetchone()
-    file_id = None
-    if row:
-        file_id = row[0]
-    file_cache[path] = file_id
-    return file_id
+def getFileID(conn, path):
+    # Any file not in the cache isn't in the DB either (probably ignored).
+    return file_cache.get(path)
 
 def splitLoc(conn, value):
+    # Binary output has locations already split into (path, line, col).
+    if isinstance(value, tuple):
+        return (getFileID(conn, value[0]), value[1], value[2])
     arr = value.split(':')
     return (getFileID(conn, arr[0]), int(arr[1]), int(arr[2]))
 
@@ -302,20 +317,25 @@ def fixupExtent(args, extents_key='extent'):
         return
 
     value = args[extents_key]
-    arr = value.split(':')
-
-    args['extent_start'] = int(arr[0])
-    args['extent_end'] = int(arr[1])
+    if isinstance(value, tuple):  # from binary output
+        args['extent_start'], args['extent_end'] = value
+    else:
+        arr = value.split(':')
+        args['extent_start'] = int(arr[0])
+        args['extent_end'] = int(arr[1])
     del args[extents_key]
 
 def getScope(args, conn):
-    row = conn.execute("SELECT id FROM scopes WHERE file_id=? AND file_line=? AND file_col=?",
-                                          (args['file_id'], args['file_line'], args['file_col'])).fetchone()
-
-    if row is not None:
-        return row[0]
+    return scope_cache.get((args['file_id'], args['file_line'], args['file_col']))
 
-    return None
+def insertScope(scope, conn):
+    """Insert a row into the scopes table, and remember it in
+    ``scope_cache``."""
+    stmt = language_schema.get_insert_sql('scopes', scope)
+    conn.execute(stmt[0], stmt[1])
+    # Like the unique index on the location, first come, first served:
+    scope_cache.setdefault((scope['file_id'], scope['file_line'], scope['file_col']),
+                           scope['id'])
 
 def addScope(args, conn, name, id):
     scope = {}
@@ -326,8 +346,7 @@ def addScope(args, conn, name, id):
     scope['file_col'] = args['file_col']
     scope['language'] = 'native'
 
-    stmt = language_schema.get_insert_sql('scopes', scope)
-    conn.execute(stmt[0], stmt[1])
+    insertScope(scope, conn)
 
 def handleScope(args, conn, canonicalize=False):
     scope = {}
@@ -349,8 +368,7 @@ def handleScope(args, conn, canonicalize=False):
 
     if scopeid is None:
         scope['id'] = scopeid = dxr.utils.next_global_id()
-        stmt = language_schema.get_insert_sql('scopes', scope)
-        conn.execute(stmt[0], stmt[1])
+        insertScope(scope, conn)
 
     if scopeid is not None:
         args['scopeid'] = scopeid
@@ -496,15 +514,14 @@ def process_namespace_alias(args, conn):
 
 def process_include(args, conn):
     """Turn an "include" line from a CSV into a row in the "includes" table."""
-    fixupExtent(args)
+    args['file_id'] = getFileID(conn, args['source_path'])
+    args['target_id'] = getFileID(conn, args['target_path'])
     # If the ignore_patterns in the config file keep an #included file from
     # making it into the files table, just pretend that include doesn't exist.
-    # Thus, IGNORE.
-    return ('INSERT OR IGNORE INTO includes '
-            '(file_id, extent_start, extent_end, target_id) '
-            'VALUES ((SELECT id FROM files WHERE path=?), ?, ?, '
-                    '(SELECT id FROM files WHERE path=?))',
-            (args['source_path'], args['extent_start'], args['extent_end'], args['target_path']))
+    if args['file_id'] is None or args['target_id'] is None:
+        return None
+    fixupExtent(args)
+    return schema.get_insert_sql('includes', args)
 
 def load_indexer_output(fname):
     f = open(fname, "rb")
@@ -523,46 +540,172 @@ def load_indexer_output(fname):
     finally:
         f.close()
 
-def dump_indexer_output(conn, fname):
-    f = open(fname, 'r')
-    limit = 0
+def parse_indexer_output(fname):
+    """Read a file written by the compiler plugin, and return a list of
+    (kind, args dict) for each record.
+
+    This is the top-level function of a parsing worker process.
 
+    """
+    if fname.endswith('.bin'):
+        return parse_binary_indexer_output(fname)
+    return parse_csv_indexer_output(fname)
+
+
+def parse_csv_indexer_output(fname):
+    """Read a CSV file written by the compiler plugin, and return a list of
+    (kind, args dict) for each line."""
+    f = open(fname, 'r')
     try:
-        parsed_iter = csv.reader(f)
-        for line in parsed_iter:
-            args = {}
-            # Our first column is the type that we're reading, the others are just
-            # a key/value pairs array to be passed in
-            for i in range(1, len(line), 2):
-                args[line[i]] = line[i + 1]
+        lines = []
+        for line in csv.reader(f):
+            # Our first column is the type that we're reading, the others are
+            # just a key/value pairs array to be passed in
+            lines.append((line[0], dict(zip(line[1::2], line[2::2]))))
+        return lines
+    finally:
+        f.close()
+
 
-            stmt = globals()['process_' + line[0]](args, conn)
+def parse_binary_indexer_output(fname):
+    """Read a binary file written by the compiler plugin (when the
+    ``plugin_clang_binary_output`` option is set), and return a list of
+    (kind, args dict) for each record.
+
+    The file is a series of frames, each a little-endian 32-bit length
+    followed by that many bytes. A frame beginning with "S" defines the next
+    string in the file's string table (IDs count up from 0); the rest of the
+    frame is the string. A frame beginning with "R" is a record: the 32-bit
+    string ID of its kind, then fields, each a 32-bit key string ID, a type
+    byte, and a value:
+
+    * ``s``: a 32-bit string ID
+    * ``b``: a 32-bit length and that many bytes of text
+    * ``l``: a location: 32-bit string ID of the path, line, and column.
+      These come out as (path, line, column) tuples rather than
+      "path:line:col" strings.
+    * ``e``: an extent: 32-bit start and end offsets. These come out as
+      (start, end) tuples.
+
+    Fields are unpacked straight out of the file's buffer; only the strings
+    are copied, and those just once per file.
+
+    """
+    with open(fname, 'rb') as f:
+        data = f.read()
+    strings = []
+    records = []
+    offset, end = 0, len(data)
+    while offset < end:
+        length, = unpack_from('<I', data, offset)
+        offset += 4
+        frame_end = offset + length
+        if data[offset] == 'S':
+            strings.append(data[offset + 1:frame_end])
+        else:  # 'R'
+            kind, = unpack_from('<I', data, offset + 1)
+            args = {}
+            pos = offset + 5
+            while pos < frame_end:
+                key, type = unpack_from('<Ic', data, pos)
+                pos += 5
+                if type == 's':
+                    value = strings[unpack_from('<I', data, pos)[0]]
+                    pos += 4
+                elif type == 'b':
+                    size, = unpack_from('<I', data, pos)
+                    value = data[pos + 4:pos + 4 + size]
+                    pos += 4 + size
+                elif type == 'l':
+                    path, line, col = unpack_from('<III', data, pos)
+                    value = strings[path], line, col
+                    pos += 12
+                else:  # 'e'
+                    value = unpack_from('<II', data, pos)
+                    pos += 8
+                args[strings[key]] = value
+            records.append((strings[kind], args))
+        offset = frame_end
+    return records
+
+
+def parsed_indexer_outputs(tree, fnames):
+    """Parse CSV files in a pool of worker processes, and yield (file name,
+    result of ``parse_indexer_output()``) for each, in order.
+
+    Only a few files are parsed ahead of the consumer, so memory use doesn't
+    grow with the number of files.
+
+    """
+    if tree.config.disable_workers:
+        for fname in fnames:
+            yield fname, parse_indexer_output(fname)
+        return
 
+    nb_jobs = int(tree.config.nb_jobs)
+    with ProcessPoolExecutor(max_workers=nb_jobs) as pool:
+        pending = []  # (file name, future) pairs, in order
+        fnames = iter(fnames)
+        while True:
+            for fname in fnames:
+                pending.append((fname, pool.submit(parse_indexer_output,
+                                                   fname)))
+                if len(pending) >= nb_jobs * 2:
+                    break
+            if not pending:
+                break
+            fname, future = pending.pop(0)
+            yield fname, future.result()
+
+
+class BatchWriter(object):
+    """Accumulator of the INSERTs the ``process_*`` functions return
+
+    Rows are grouped by statement (and thus by table and column set, since
+    ``Schema.get_insert_sql()`` makes one statement per table) and written
+    with ``executemany()`` once enough pile up. Rows for the same table stay
+    in order, so the same ones win ``INSERT OR IGNORE`` conflicts as when they
+    were inserted one at a time.
+
+    """
+    batch_rows = 50000
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = {}  # {SQL: [parameters, ...]}
+        self._count = 0
+
+    def add(self, sql, parameters):
+        self._rows.setdefault(sql, []).append(parameters)
+        self._count += 1
+        if self._count >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """Write and commit everything accumulated so far."""
+        for sql, rows in self._rows.iteritems():
+            self.conn.executemany(sql, rows)
+        self.conn.commit()
+        self._rows = {}
+        self._count = 0
+
+
+def dump_indexer_output(conn, fname, lines, writer):
+    """Process the parsed lines of one CSV file, handing the resulting rows
+    to a ``BatchWriter``."""
+    for kind, args in lines:
+        try:
+            stmt = globals()['process_' + kind](args, conn)
             if stmt is None:
                 continue
-
             if isinstance(stmt, list):
-                for elem in list:
-                    conn.execute(elem[0], elem[1])
-            elif isinstance(stmt, tuple):
-                try:
-                    conn.execute(stmt[0], stmt[1])
-                except Exception:
-                    print line
-                    print stmt
-                    raise
+                for sql, parameters in stmt:
+                    writer.add(sql, parameters)
             else:
-                conn.execute(stmt)
-
-            limit = limit + 1
-
-            if limit > 10000:
-                limit = 0
-                conn.commit()
-    except IndexError:
-        raise
-    finally:
-        f.close()
+                writer.add(stmt[0], stmt[1])
+        except Exception:
+            print fname, kind, args
+            raise
 
 def canonicalize_decl(name, id, line, col):
     value = decl_master.get((name, id, line, col), None)
@@ -731,126 +874,71 @@ def generate_callgraph(conn):
 
 
 def update_defids(conn):
-    sql = """
-        UPDATE type_decldef SET defid = (
-              SELECT id
-                FROM types AS def
-               WHERE def.file_id   = definition_file_id
-                 AND def.file_line = definition_file_line
-                 AND def.file_col  = definition_file_col
-        )"""
-    conn.execute(sql)
-    sql = """
-        UPDATE function_decldef SET defid = (
-              SELECT id
-                FROM functions AS def
-               WHERE def.file_id   = definition_file_id
-                 AND def.file_line = definition_file_line
-                 AND def.file_col  = definition_file_col
-        )"""
-    conn.execute(sql)
-    sql = """
-        UPDATE variable_decldef SET defid = (
-              SELECT id
-                FROM variables AS def
-               WHERE def.file_id   = definition_file_id
-                 AND def.file_line = definition_file_line
-                 AND def.file_col  = definition_file_col
-        )"""
-    conn.execute(sql)
+    # Point declarations at their definitions:
+    for kind, definitions in [('type', 'types'),
+                              ('function', 'functions'),
+                              ('variable', 'variables')]:
+        resolve_ids(conn, kind + '_decldef', 'defid', 'definition',
+                    definitions, 'id', only_null=False)
 
 
 def update_refs(conn):
     # References to declarations
-    sql = """
-        UPDATE type_refs SET refid = (
-                SELECT defid
-                  FROM type_decldef AS decl
-                 WHERE decl.file_id   = referenced_file_id
-                   AND decl.file_line = referenced_file_line
-                   AND decl.file_col  = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE function_refs SET refid = (
-                SELECT defid
-                  FROM function_decldef AS decl
-                 WHERE decl.file_id   = referenced_file_id
-                   AND decl.file_line = referenced_file_line
-                   AND decl.file_col  = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE variable_refs SET refid = (
-                SELECT defid
-                  FROM variable_decldef AS decl
-                 WHERE decl.file_id   = referenced_file_id
-                   AND decl.file_line = referenced_file_line
-                   AND decl.file_col  = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
+    for kind in ['type', 'function', 'variable']:
+        resolve_ids(conn, kind + '_refs', 'refid', 'referenced',
+                    kind + '_decldef', 'defid')
 
     # References to definitions
-    sql = """
-        UPDATE macro_refs SET refid = (
-                SELECT id
-                  FROM macros AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE type_refs SET refid = (
-                SELECT id
-                  FROM types AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE typedef_refs SET refid = (
-                SELECT id
-                  FROM typedefs AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE function_refs SET refid = (
-                SELECT id
-                  FROM functions AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE variable_refs SET refid = (
-                SELECT id
-                  FROM variables AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE namespace_refs SET refid = (
-                SELECT id
-                  FROM namespaces AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE namespace_alias_refs SET refid = (
+    for kind, definitions in [('macro', 'macros'),
+                              ('type', 'types'),
+                              ('typedef', 'typedefs'),
+                              ('function', 'functions'),
+                              ('variable', 'variables'),
+                              ('namespace', 'namespaces'),
+                              ('namespace_alias', 'namespace_aliases')]:
+        resolve_ids(conn, kind + '_refs', 'refid', 'referenced',
+                    definitions, 'id')
+
+
+def resolve_ids(conn, table, column, prefix, source, source_column,
+                only_null=True):
+    """Fill in ``table.column`` from the ``source_column`` of the ``source``
+    row at the location given by the ``<prefix>_file_id``, ``_file_line``,
+    and ``_file_col`` columns of ``table``.
+
+    Rather than trusting ``source`` to have a usable index on its location,
+    first copy its locations and IDs into a temporary table with a covering
+    index, so each row's lookup is a single index probe. Print the time each
+    step took.
+
+    :arg only_null: Whether to fill in only rows where ``column`` is NULL
+
+    """
+    start = datetime.now()
+    conn.execute('DROP TABLE IF EXISTS temp.ids_by_location')
+    conn.execute("""
+        CREATE TEMP TABLE ids_by_location AS
+            SELECT file_id, file_line, file_col, min(%s) AS id
+              FROM %s
+             GROUP BY file_id, file_line, file_col""" % (source_column, source))
+    conn.execute("""
+        CREATE UNIQUE INDEX temp.ids_by_location_index
+            ON ids_by_location (file_id, file_line, file_col, id)""")
+    indexed = datetime.now()
+
+    cursor = conn.execute("""
+        UPDATE %(table)s SET %(column)s = (
                 SELECT id
-                  FROM namespace_aliases AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
+                  FROM temp.ids_by_location AS loc
+                 WHERE loc.file_id   = %(prefix)s_file_id
+                   AND loc.file_line = %(prefix)s_file_line
+                   AND loc.file_col  = %(prefix)s_file_col
+        )%(where)s""" % {'table': table,
+                         'column': column,
+                         'prefix': prefix,
+                         'where': (' WHERE %s IS NULL' % column) if only_null
+                                  else ''})
+    conn.execute('DROP TABLE temp.ids_by_location')
+    print '   - %s.%s from %s: indexed in %s, %s rows updated in %s' % (
+        table, column, source, indexed - start, cursor.rowcount,
+        datetime.now() - indexed)
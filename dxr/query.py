@@ -1,25 +1,38 @@
+from array import array
+from bisect import bisect_right
 import cgi
+from heapq import heapify, heappop, heappush
 from itertools import chain, groupby
 import re
 import struct
+import sys
 import time
 
 from jinja2 import Markup
 from parsimonious import Grammar
 from parsimonious.nodes import NodeVisitor
 
+from dxr.utils import ascii_lower, LRUCache, trigrams
+
 
 # TODO: Some kind of UI feedback for bad regexes
 
 
 # TODO
 #   - Special argument files-only to just search for file names
-#   - If no plugin returns an extents query, don't fetch content
 
 
 # Pattern for matching a file and line number filename:n
 _line_number = re.compile("^.*:[0-9]+$")
 
+# The kinds of names in the direct_hits table, in the order direct_result()
+# prefers them:
+(DIRECT_PATH, DIRECT_PATH_SUFFIX, DIRECT_TYPE, DIRECT_FUNCTION,
+ DIRECT_TYPE_QUALNAME, DIRECT_FUNCTION_QUALNAME, DIRECT_TYPE_NOCASE,
+ DIRECT_FUNCTION_NOCASE) = range(8)
+
+_newline = re.compile('\n')
+
 class Query(object):
     """Query object, constructor will parse any search query"""
 
@@ -27,11 +40,13 @@ class Query(object):
         self.conn = conn
         self._should_explain = should_explain
         self._sql_profile = []
+        self._plan = []  # description of the last results() plan, for explain
         self.is_case_sensitive = is_case_sensitive
 
         # A dict with a key for each filter type (like "regexp") in the query.
-        # There is also a special "text" key where free text ends up.
-        self.terms = QueryVisitor(is_case_sensitive=is_case_sensitive).visit(query_grammar.parse(querystr))
+        # There is also a special "text" key where free text ends up. It's
+        # shared with other Querys for the same string, so it's read-only.
+        self.terms = parsed_terms(querystr, is_case_sensitive)
 
     def single_term(self):
         """Return the single textual term comprising the query.
@@ -43,6 +58,12 @@ class Query(object):
         if self.terms.keys() == ['text'] and len(self.terms['text']) == 1:
             return self.terms['text'][0]['arg']
 
+    def cache_key(self):
+        """Return a hashable summary of the query which is the same for any
+        two queries that must return the same results, regardless of term
+        order or spacing."""
+        return _frozen(self.terms), self.is_case_sensitive
+
     #TODO Use named place holders in filters, this would make the filters easier to write
 
     def execute_sql(self, sql, *parameters):
@@ -65,43 +86,85 @@ class Query(object):
     # See: queryparser.py for details in query specification
     def results(self,
                 offset=0, limit=100,
-                markup='<b>', markdown='</b>'):
+                markup='<b>', markdown='</b>',
+                after=None):
         """Return search results as an iterable of these::
 
             (icon,
              path within tree,
              (line_number, highlighted_line_of_code)), ...
 
+        :arg after: If not None, return only results whose paths sort after
+            this one: typically the last path of the previous page. Unlike
+            paging with ``offset``, this lets SQLite seek straight to the
+            page rather than finding and throwing away every result before
+            it.
+
+        This is a generator, but not an incremental one all the way down: the
+        query that picks the page of files and the filters' extents queries
+        for the whole page all run before the first result comes out, so as
+        to take a constant number of round trips per page. Only the fetching
+        and highlighting of each file's lines is deferred until that file is
+        reached.
+
         """
-        sql = """
-            SELECT files.path, files.icon, files.encoding, trg_index.text, files.id,
-            extents(trg_index.contents)
-                FROM trg_index, files
-              WHERE %s ORDER BY files.path LIMIT ? OFFSET ?
-        """
-        conditions = " files.id = trg_index.id "
-        arguments = []
+        conditions = []
+        if after is not None:
+            conditions.append(Condition("files.path > ?", [after], False,
+                                        cost=0))
 
         # Give each registered filter an opportunity to contribute to the
         # query. This query narrows down the universe to a set of matching
         # files:
-        has_extents = False
+        statistics = self._statistics()
+        needs_contents = False
         for f in filters:
-            for conds, args, exts in f.filter(self.terms):
-                has_extents = exts or has_extents
-                conditions += " AND " + conds
-                arguments += args
-
-        sql %= conditions
+            for condition in f.conditions(self.terms, statistics):
+                needs_contents = needs_contents or (condition.has_extents and
+                                                    f.needs_contents)
+                conditions.append(condition)
+        conditions, arguments = self._planned(conditions,
+                                              statistics,
+                                              offset + limit,
+                                              can_drive=not needs_contents)
+
+        if needs_contents:
+            # Text searches get their extents out of the trigram index, so
+            # they have to join against it, and they might as well take the
+            # whole contents while they're there.
+            sql = """
+                SELECT files.path, files.icon, files.encoding, trg_index.text,
+                       files.id, extents(trg_index.contents)
+                    FROM trg_index, files
+                  WHERE %s ORDER BY files.path LIMIT ? OFFSET ?
+            """
+            conditions.insert(0, "files.id = trg_index.id")
+        else:
+            # Structural searches leave the contents alone. We fetch just the
+            # highlit lines of each result below.
+            sql = """
+                SELECT files.path, files.icon, files.encoding, NULL, files.id,
+                       NULL
+                    FROM files
+                  WHERE %s ORDER BY files.path LIMIT ? OFFSET ?
+            """
+        sql %= " AND ".join(conditions) or "1"
         arguments += [limit, offset]
 
-        #TODO Actually do something with the has_extents, ie. don't fetch contents
+        rows = list(self.execute_sql(sql, arguments))
 
-        cursor = self.execute_sql(sql, arguments)
+        # Let each filter do one or more additional queries to find the
+        # extents to highlight, covering the whole page of files at once:
+        file_ids = [row[4] for row in rows]
+        extents_by_filter = [
+            f.extents_for_files(self.terms, self.execute_sql, file_ids)
+            for f in filters] if file_ids else []
+        # ...and where the lines of those files begin and end:
+        newlines = self._newlines(file_ids)
 
         # For each returned file (including, only in the case of the trilite
         # filter, a set of extents)...
-        for path, icon, encoding, content, file_id, extents in cursor:
+        for path, icon, encoding, content, file_id, extents in rows:
             elist = []
 
             # Special hack for TriLite extents
@@ -112,18 +175,24 @@ class Query(object):
                     matchExtents.append((s, e, []))
                 elist.append(fix_extents_overlap(sorted(matchExtents)))
 
-            # Let each filter do one or more additional queries to find the
-            # extents to highlight:
-            for f in filters:
-                for e in f.extents(self.terms, self.execute_sql, file_id):
-                    elist.append(e)
+            for extents_by_file in extents_by_filter:
+                elist.extend(extents_by_file.get(file_id, []))
             offsets = list(merge_extents(*elist))
 
             if self._should_explain:
                 continue
 
             # Yield the file, metadata, and iterable of highlighted offsets:
-            yield icon, path, _highlit_lines(content, offsets, markup, markdown, encoding)
+            if not offsets:
+                lines = []
+            elif content is None:
+                lines = self._highlit_lines_of_file(file_id, offsets, markup,
+                                                    markdown, encoding,
+                                                    newlines.get(file_id))
+            else:
+                lines = _highlit_lines(content, offsets, markup, markdown,
+                                       encoding, newlines.get(file_id))
+            yield icon, path, lines
 
 
         # TODO: Decouple and lexically evacuate this profiling stuff from
@@ -137,6 +206,8 @@ class Query(object):
                     ret.append((i, arr[i]))
             return ret
 
+        if self._should_explain and self._plan:
+            yield "", "plan", number_lines(self._plan)
         for i in range(len(self._sql_profile)):
             profile = self._sql_profile[i]
             yield ("",
@@ -150,17 +221,166 @@ class Query(object):
                           number_lines(map(lambda row: row["detail"], profile["explanation"])))
 
 
+    def _statistics(self):
+        """Return the statistics ``ANALYZE`` gathered at build time, as a dict
+        of index names to lists of numbers: the rows in the index's table,
+        then the average rows per distinct value of the index's first
+        column, and so on.
+
+        Return an empty dict if there are no statistics.
+
+        Pooled connections keep them between queries, along with the schema
+        version they were read at. Every build recreates the plugins' tables,
+        which changes the schema version, so a rebuilt DB is read afresh.
+
+        """
+        version = self.conn.execute('PRAGMA schema_version').fetchone()[0]
+        cached = getattr(self.conn, 'statistics', None)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        statistics = self._read_statistics()
+        try:
+            self.conn.statistics = version, statistics
+        except AttributeError:  # a plain sqlite3.Connection
+            pass
+        return statistics
+
+    def _read_statistics(self):
+        """Read ``Query._statistics()`` out of ``sqlite_stat1``."""
+        if not self.conn.execute("SELECT 1 FROM sqlite_master "
+                                 "WHERE name = 'sqlite_stat1'").fetchone():
+            return {}
+        statistics = {}
+        for index, stat in self.conn.execute(
+                'SELECT idx, stat FROM sqlite_stat1 WHERE idx IS NOT NULL'):
+            try:
+                statistics[index] = [int(n) for n in stat.split()]
+            except ValueError:  # newer SQLite can append words like "unordered"
+                statistics[index] = [int(n) for n in stat.split()
+                                     if n.isdigit()]
+        return statistics
+
+    def _planned(self, conditions, statistics, rows_wanted, can_drive):
+        """Put conditions in the order that should be cheapest to evaluate,
+        and return the SQL conditions and their arguments, in order.
+
+        Cheap conditions go first, and, among ones as costly as each other,
+        the ones expected to match the fewest files, so SQLite can
+        short-circuit the rest. If we expect a condition to match few enough
+        files, we turn it around so SQLite starts from the matching symbols
+        and looks up their files, rather than running a subquery for each
+        file in path order.
+
+        :arg rows_wanted: How many results SQLite needs to find before it can
+            stop (the offset plus the limit)
+        :arg can_drive: Whether we're free to choose which table SQLite
+            starts from. (We're not when the trigram index is in the query.)
+
+        """
+        conditions = sorted(conditions, key=lambda c: (c.cost,
+                                                       c.rows is None,
+                                                       c.rows))
+        files = statistics.get('files_path_index', [None])[0]
+
+        # Walking the files in path order with a subquery per file stops as
+        # soon as enough have matched. Driving from the symbols has to find
+        # every match and then sort them. So drive only if the matches are
+        # fewer than the files we'd expect to walk before finding enough.
+        driver = None
+        if can_drive and files:
+            candidates = [c for c in conditions
+                          if c.driver is not None and c.rows is not None]
+            if candidates:
+                best = min(candidates, key=lambda c: c.rows)
+                if best.rows < files * min(1, rows_wanted / float(max(best.rows, 1))):
+                    driver = best
+
+        sql = []
+        arguments = []
+        self._plan = []
+        for i, c in enumerate(conditions):
+            if c is driver:
+                sql.append('files.id IN (%s)' % c.driver)
+            else:
+                sql.append(c.sql)
+            arguments += c.args
+            self._plan.append('%d. %s%s: %s' % (
+                i + 1,
+                'cost %s' % c.cost,
+                '' if c.rows is None else ', ~%s rows' % c.rows,
+                ' '.join(sql[-1].split())))
+            if c is driver:
+                self._plan[-1] += ' (drives the query)'
+        if files is not None:
+            self._plan.append('(%s files)' % files)
+        return sql, arguments
+
+    def _newlines(self, file_ids):
+        """Return a dict of file IDs to the offsets of the newlines in those
+        files, leaving out any the ``newlines`` table doesn't know about.
+
+        They're read in as few queries as SQLite's limit on parameters
+        allows, as ``SearchFilter.extents_for_files()`` reads extents.
+
+        """
+        newlines = {}
+        for i in xrange(0, len(file_ids), _FILES_PER_QUERY):
+            some_ids = file_ids[i:i + _FILES_PER_QUERY]
+            for file_id, offsets in self.execute_sql(
+                    'SELECT id, offsets FROM newlines WHERE id IN (%s)' %
+                        ', '.join(['?'] * len(some_ids)),
+                    some_ids):
+                newlines[file_id] = _unpacked_offsets(offsets)
+        return newlines
+
+    def _highlit_lines_of_file(self, file_id, offsets, markup, markdown,
+                               encoding, newlines):
+        """Return the same thing as ``_highlit_lines()``, reading the file's
+        contents out of the DB first.
+
+        :arg newlines: The offsets of the newlines in the file, or None to
+            find them in its contents
+
+        This does read the whole file, once, but only for files on the page,
+        and not through the sorted page query. The ``newlines`` table tells
+        us where the lines to highlight lie within it. SQLite can't take a
+        ``substr()`` of a value without reading all of it (and trilite hands
+        it the whole text each time), so pulling out just those lines with a
+        ``substr()`` apiece reads the file once per line instead.
+
+        """
+        row = self.execute_sql(
+            'SELECT CAST(text AS BLOB) FROM trg_index WHERE id = ?',
+            [file_id]).fetchone()
+        return _highlit_lines(str(row[0]) if row else '',
+                              offsets,
+                              markup,
+                              markdown,
+                              encoding,
+                              newlines)
+
     def direct_result(self):
         """Return a single search result that is an exact match for the query.
 
         If there is such a result, return a tuple of (path from root of tree,
         line number). Otherwise, return None.
 
+        The candidates come out of the ``direct_hits`` table in one query. In
+        order of preference, the query may be...
+
+        * the path of a file, or the end of one following a slash,
+          case-insensitively
+        * the name of a type or function
+        * the qualified name of a type, or the start of that of a function,
+          case-insensitively
+        * the name of a type or function, case-insensitively
+
+        ...and the first of those that leads to exactly one place wins.
+
         """
         term = self.single_term()
         if not term:
             return None
-        cur = self.conn.cursor()
 
         line_number = -1
         if _line_number.match(term):
@@ -169,125 +389,198 @@ class Query(object):
                 term = parts[0]
                 line_number = int(parts[1])
 
-        # See if we can find only one file match
-        cur.execute("""
-            SELECT path FROM files WHERE
-                path = :term
-                OR path LIKE :termPre
-            LIMIT 2
-        """, {"term": term,
-              "termPre": "%/" + term})
-
-        rows = cur.fetchall()
-        if rows and len(rows) == 1:
-            if line_number >= 0:
-                return (rows[0]['path'], line_number)
-            return (rows[0]['path'], 1)
-
-        # Case sensitive type matching
-        cur.execute("""
-            SELECT
-                (SELECT path FROM files WHERE files.id = types.file_id) as path,
-                types.file_line
-              FROM types WHERE types.name = ? LIMIT 2
-        """, (term,))
-        rows = cur.fetchall()
-        if rows and len(rows) == 1:
-            return (rows[0]['path'], rows[0]['file_line'])
-
-        # Case sensitive function names
-        cur.execute("""
-            SELECT
-                    (SELECT path FROM files WHERE files.id = functions.file_id) as path,
-                    functions.file_line
-                FROM functions WHERE functions.name = ? LIMIT 2
-        """, (term,))
-        rows = cur.fetchall()
-        if rows and len(rows) == 1:
-            return (rows[0]['path'], rows[0]['file_line'])
-
-        # Try fully qualified names
+        folded = ascii_lower(term)
+        lookups = [(DIRECT_PATH, term), (DIRECT_PATH_SUFFIX, folded),
+                   (DIRECT_TYPE, term), (DIRECT_FUNCTION, term),
+                   (DIRECT_TYPE_NOCASE, folded),
+                   (DIRECT_FUNCTION_NOCASE, folded)]
+        sql = ' UNION ALL '.join(['SELECT tier, path, line, count '
+                                  'FROM direct_hits '
+                                  'WHERE tier = ? AND name = ?'] *
+                                 len(lookups))
+        args = [arg for lookup in lookups for arg in lookup]
         if '::' in term:
-            # Case insensitive type matching
-            cur.execute("""
-                SELECT
-                      (SELECT path FROM files WHERE files.id = types.file_id) as path,
-                      types.file_line
-                    FROM types WHERE types.qualname LIKE ? LIMIT 2
-            """, (term,))
-            rows = cur.fetchall()
-            if rows and len(rows) == 1:
-                return (rows[0]['path'], rows[0]['file_line'])
-
-            # Case insensitive function names
-            cur.execute("""
-            SELECT
-                  (SELECT path FROM files WHERE files.id = functions.file_id) as path,
-                  functions.file_line
-                FROM functions WHERE functions.qualname LIKE ? LIMIT 2
-            """, (term + '%',))  # Trailing % to eat "(int x)" etc.
-            rows = cur.fetchall()
-            if rows and len(rows) == 1:
-                return (rows[0]['path'], rows[0]['file_line'])
-
-        # Case insensitive type matching
-        cur.execute("""
-        SELECT
-              (SELECT path FROM files WHERE files.id = types.file_id) as path,
-              types.file_line
-            FROM types WHERE types.name LIKE ? LIMIT 2
-        """, (term,))
-        rows = cur.fetchall()
-        if rows and len(rows) == 1:
-            return (rows[0]['path'], rows[0]['file_line'])
-
-        # Case insensitive function names
-        cur.execute("""
-        SELECT
-              (SELECT path FROM files WHERE files.id = functions.file_id) as path,
-              functions.file_line
-            FROM functions WHERE functions.name LIKE ? LIMIT 2
-        """, (term,))
-        rows = cur.fetchall()
-        if rows and len(rows) == 1:
-            return (rows[0]['path'], rows[0]['file_line'])
+            # Function qualnames are matched by prefix, to eat "(int x)" etc.
+            sql += (' UNION ALL SELECT tier, path, line, count FROM direct_hits '
+                    'WHERE tier = ? AND name = ? '
+                    'UNION ALL SELECT * FROM ('
+                    'SELECT tier, path, line, count FROM direct_hits '
+                    'WHERE tier = ? AND name >= ? AND name < ? LIMIT 2)')
+            args.extend([DIRECT_TYPE_QUALNAME, folded,
+                         DIRECT_FUNCTION_QUALNAME, folded,
+                         _prefix_upper_bound(folded)])
+
+        hits = {}
+        for tier, path, line, count in self.conn.execute(sql, args):
+            hits.setdefault(tier, []).append((path, line, count))
+
+        def only_hit(*tiers):
+            """Return the (path, line) of the one place the given tiers lead
+            to, or None if there isn't exactly one."""
+            found = [hit for tier in tiers for hit in hits.get(tier, [])]
+            if sum(count for path, line, count in found) == 1:
+                return found[0][:2]
+
+        # See if we can find only one file match
+        hit = only_hit(DIRECT_PATH, DIRECT_PATH_SUFFIX)
+        if hit:
+            return hit[0], line_number if line_number >= 0 else 1
+
+        for tier in [DIRECT_TYPE, DIRECT_FUNCTION, DIRECT_TYPE_QUALNAME,
+                     DIRECT_FUNCTION_QUALNAME, DIRECT_TYPE_NOCASE,
+                     DIRECT_FUNCTION_NOCASE]:
+            hit = only_hit(tier)
+            if hit:
+                return hit
 
         # Okay we've got nothing
         return None
 
 
-def _highlit_line(content, offsets, markup, markdown, encoding):
-    """Return a line of string ``content`` with the given ``offsets`` prefixed
-    by ``markup`` and suffixed by ``markdown``.
+# How many files' extents ExistsLikeFilter asks for in one query:
+_FILES_PER_QUERY = 500
+
+# The parts of an ExistsLikeFilter's ext_sql that get changed to handle many
+# files at once:
+_file_id_param = re.compile(r'(\w+)\.file_id = \?')
+_select = re.compile(r'^\s*SELECT ')
+
+# The parts of an ExistsLikeFilter's filter_sql that get changed to select
+# file IDs rather than check one:
+_file_id_correlation = re.compile(r'\s+AND\s+(\w+)\.file_id = files\.id')
+_select_1 = re.compile(r'^\s*SELECT 1\b')
+
+# The planner's guess at what share of a table a name with wildcards matches:
+# 1 row in this many
+_WILDCARD_FRACTION = 20
+
+
+def _has_wildcard(arg):
+    """Return whether a filter's argument has any of the shell wildcards
+    ``like_escape()`` turns into LIKE ones."""
+    return '*' in arg or '?' in arg
+
+
+# The index whose statistics show there is a symbol name index to use:
+_NAME_INDEX = 'symbol_names_name_index'
+
+# The pieces of a LIKE pattern: escaped characters, wildcards, and plain text
+_like_token = re.compile(r'\\(.)|([%_])|([^\\%_]+)', re.S)
+
+
+def _prefix_upper_bound(prefix):
+    """Return the least string that sorts after every one starting with a
+    given non-empty prefix."""
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def _name_ids_sql(pattern):
+    """Return SQL selecting the IDs of the names in the symbol name index
+    that match a LIKE pattern made by ``like_escape()``, and its arguments.
+
+    A pattern without wildcards is looked up directly. Otherwise, the names
+    are narrowed down by the literal text the pattern starts with or by the
+    trigrams of all its literal text, whichever is more selective, and LIKE
+    weeds out the rest.
+
+    """
+    runs = ['']  # The literal text between wildcards
+    for escaped, wildcard, text in _like_token.findall(pattern):
+        if wildcard:
+            runs.append('')
+        else:
+            runs[-1] += escaped or text
+    runs = [ascii_lower(run) for run in runs]
+    if len(runs) == 1:
+        return 'SELECT id FROM symbol_names WHERE name = ?', runs
+
+    like = ' AND name LIKE ? ESCAPE "\\"'
+    prefix = runs[0]
+    grams = sorted(set(gram for run in runs for gram in trigrams(run)))
+    if prefix and (len(prefix) >= 3 or not grams):
+        return ('SELECT id FROM symbol_names WHERE name >= ? AND name < ?' +
+                like,
+                [prefix, _prefix_upper_bound(prefix), pattern])
+    if grams:
+        return ('SELECT id FROM symbol_names WHERE id IN '
+                '(SELECT name_id FROM symbol_name_trigrams '
+                'WHERE trigram IN (%s) GROUP BY name_id HAVING count(*) = %d)'
+                % (', '.join(['?'] * len(grams)), len(grams)) + like,
+                grams + [pattern])
+    # Nothing to go on, like "*_": scanning the distinct names still beats
+    # scanning the symbols.
+    return 'SELECT id FROM symbol_names WHERE 1' + like, [pattern]
+
+
+def _unpacked_offsets(blob):
+    """Return the sequence of newline offsets stored in a row of the
+    ``newlines`` table."""
+    offsets = array('I')
+    offsets.fromstring(str(blob))
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return offsets
+
+
+def _frozen(value):
+    """Return a hashable, order-independent copy of a structure of dicts and
+    lists, like ``Query.terms``."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _frozen(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(sorted(_frozen(v) for v in value))
+    return value
+
+
+def _lines_and_extents(newlines, offsets):
+    """Bucket extents by the lines they fall on, and return a list of (line
+    number, line start offset, line end offset, [(start, end), ...]) tuples,
+    with the extents made relative to the start of their line.
+
+    :arg newlines: The sorted offsets of the newlines in the file
+    :arg offsets: Extents, as passed to ``_highlit_lines()``
+
+    Each extent costs a binary search through the newlines, not a scan of
+    the file. The last line, having no newline to end it, gets an end offset
+    beyond any file's.
+
+    """
+    lines = []
+    for index, extents in groupby(offsets,
+                                  lambda (s, e, _): bisect_right(newlines, s)):
+        start = newlines[index - 1] + 1 if index else 0
+        end = newlines[index] if index < len(newlines) else 2 ** 31
+        lines.append((index + 1, start, end, [(s - start, e - start)
+                                              for s, e, _ in extents]))
+    return lines
+
+
+def _highlit_line(line, offsets, markup, markdown, encoding):
+    """Return a string ``line`` with the given ``offsets`` prefixed by
+    ``markup`` and suffixed by ``markdown``.
+
+    :arg offsets: (start, end) extents, relative to the start of the line
 
     We assume that none of the offsets split a multibyte character. Leading
     whitespace is stripped.
 
     """
     def chunks():
-        try:
-            # Start on the line the highlights are on:
-            chars_before = content.rindex('\n', 0, offsets[0][0]) + 1
-        except ValueError:
-            chars_before = None
+        chars_before = 0
         for start, end in offsets:
-            yield cgi.escape(content[chars_before:start].decode(encoding,
-                                                                'replace'))
+            yield cgi.escape(line[chars_before:start].decode(encoding,
+                                                             'replace'))
             yield markup
-            yield cgi.escape(content[start:end].decode(encoding, 'replace'))
+            yield cgi.escape(line[start:end].decode(encoding, 'replace'))
             yield markdown
             chars_before = end
         # Make sure to get the rest of the line after the last highlight:
-        try:
-            next_newline = content.index('\n', chars_before)
-        except ValueError:  # eof
-            next_newline = None
-        yield cgi.escape(content[chars_before:next_newline].decode(encoding,
-                                                                   'replace'))
+        yield cgi.escape(line[chars_before:].decode(encoding, 'replace'))
     return ''.join(chunks()).lstrip()
 
 
-def _highlit_lines(content, offsets, markup, markdown, encoding):
+def _highlit_lines(content, offsets, markup, markdown, encoding,
+                   newlines=None):
     """Return a list of (line number, highlit line) tuples.
 
     :arg content: The contents of the file against which the offsets are
@@ -296,31 +589,21 @@ def _highlit_lines(content, offsets, markup, markdown, encoding):
     :arg offsets: A sequence of non-overlapping (start offset, end offset,
         [keylist (presently unused)]) tuples describing each extent to
         highlight. The sequence must be in order by start offset.
+    :arg newlines: The offsets of the newlines in ``content``, as stored in
+        the ``newlines`` table. If None, we find them ourselves.
 
     Assumes no newlines are highlit.
 
     """
-    line_extents = []  # [(line_number, (start, end)), ...]
-    lines_before = 1
-    chars_before = 0
-    for start, end, _ in offsets:
-        # How many lines we've skipped since we last knew what line we were on:
-        lines_since = content.count('\n', chars_before, start)
-
-        # Figure out what line we're on, and throw this extent into its bucket:
-        line = lines_before + lines_since
-        line_extents.append((line, (start, end)))
-
-        lines_before = line
-        chars_before = end
-
-    # Bucket highlit ranges by line, and build up the marked up strings:
-    return [(line, _highlit_line(content,
-                                 [extent for line, extent in lines_and_extents],
-                                 markup,
-                                 markdown,
-                                 encoding)) for
-            line, lines_and_extents in groupby(line_extents, lambda (l, e): l)]
+    if newlines is None:
+        newlines = [m.start() for m in _newline.finditer(content)]
+    return [(number, _highlit_line(content[start:end],
+                                   extents,
+                                   markup,
+                                   markdown,
+                                   encoding))
+            for number, start, end, extents in
+                _lines_and_extents(newlines, offsets)]
 
 
 def like_escape(val):
@@ -331,20 +614,6 @@ def like_escape(val):
                .replace("?", "_")
                .replace("*", "%"))
 
-class genWrap(object):
-    """Auxiliary class for wrapping a generator and make it nicer"""
-    def __init__(self, gen):
-        self.gen = gen
-        self.value = None
-    def next(self):
-        try:
-            self.value = self.gen.next()
-            return True
-        except StopIteration:
-            self.value = None
-            return False
-
-
 def merge_extents(*elist):
     """
         Take a list of extents generators and merge them into one stream of extents
@@ -355,51 +624,110 @@ def merge_extents(*elist):
 
         Where keyset is a list of something that should be applied to the extent
         between start and end.
+
+        The heads of the generators are kept in a heap, so each extent costs
+        O(log(number of generators)) rather than a scan of all of them.
     """
-    elist = [genWrap(e) for e in elist]
-    elist = [e for e in elist if e.next()]
-    while len(elist) > 0:
-        start = min((e.value[0] for e in elist))
-        end = min((e.value[1] for e in elist if e.value[0] == start))
+    # [(start, generator index, end, keys, generator), ...]:
+    heads = []
+    for i, extents in enumerate(elist):
+        extents = iter(extents)
+        for start, end, keys in extents:
+            heads.append((start, i, end, keys, extents))
+            break
+    heapify(heads)
+
+    while heads:
+        # Take every head starting where the earliest one does, in generator
+        # order, so keys come out in the same order every time:
+        starting = [heappop(heads)]
+        start = starting[0][0]
+        while heads and heads[0][0] == start:
+            starting.append(heappop(heads))
+        end = min(head[2] for head in starting)
+
         keylist = []
-        for e in (e for e in elist if e.value[0] == start):
-            for k in e.value[2]:
+        for _, i, head_end, keys, extents in starting:
+            for k in keys:
                 if k not in keylist:
                     keylist.append(k)
-            e.value = (end, e.value[1], e.value[2])
+            if end < head_end:
+                # Keep the rest of the extent for later.
+                heappush(heads, (end, i, head_end, keys, extents))
+            else:
+                for next_start, next_end, next_keys in extents:
+                    heappush(heads, (next_start, i, next_end, next_keys,
+                                     extents))
+                    break
         yield start, end, keylist
-        elist = [e for e in elist if e.value[0] < e.value[1] or e.next()]
 
 
 def fix_extents_overlap(extents):
     """
         Take a sorted list of extents and yield the extents without overlapings.
         Assumes extents are of similar format as in merge_extents
+
+        This is a single sweep: each extent is compared only with what's left
+        of the one before it.
     """
-    # There must be two extents for there to be an overlap
-    while len(extents) >= 2:
-        # Take the two next extents
-        start1, end1, keys1 = extents[0]
-        start2, end2, keys2 = extents[1]
+    extents = iter(extents)
+    for current in extents:
+        break
+    else:
+        return
+    for start2, end2, keys2 in extents:
+        start1, end1, keys1 = current
         # Check for overlap
         if end1 <= start2:
             # If no overlap, yield first extent
-            yield start1, end1, keys1
-            extents = extents[1:]
+            yield current
+            current = start2, end2, keys2
             continue
-        # If overlap, yield extent from start1 to start2
+        # If overlap, yield extent from start1 to start2, then the overlapping
+        # part, and carry the rest of the second extent on:
         if start1 != start2:
             yield start1, start2, keys1
-        extents[0] = (start2, end1, keys1 + keys2)
-        extents[1] = (end1, end2, keys2)
-    if len(extents) > 0:
-        yield extents[0]
+        yield start2, end1, keys1 + keys2
+        current = end1, end2, keys2
+    yield current
+
+
+class Condition(object):
+    """A condition a filter adds to the query, along with what the planner
+    needs to know to decide where to put it"""
+
+    def __init__(self, sql, args, has_extents, cost=1, rows=None,
+                 driver=None):
+        """
+        :arg sql: SQL conditioned on files.id
+        :arg args: The arguments to the SQL
+        :arg has_extents: Whether the filter offers extents for results
+        :arg cost: How expensive the condition is to evaluate for a file, on a
+            rough scale: 0 for comparisons against ``files`` columns or
+            constraints the trigram index handles itself, 1 for subqueries,
+            and 2 for subqueries which rule out few files
+        :arg rows: An estimate of how many files match, or None for no idea
+        :arg driver: SQL selecting the IDs of the matching files, which takes
+            the same args. Given this, the planner can have SQLite start from
+            it rather than from ``files``.
+
+        """
+        self.sql = sql
+        self.args = args
+        self.has_extents = has_extents
+        self.cost = cost
+        self.rows = rows
+        self.driver = driver
 
 
 class SearchFilter(object):
     """Base class for all search filters, plugins subclasses this class and
             registers an instance of them calling register_filter
     """
+    # Whether the extents I offer come out of the trigram index, so the query
+    # has to join against it:
+    needs_contents = False
+
     def __init__(self, description='', languages=None):
         self.description = description
         self.languages = languages or []
@@ -426,6 +754,21 @@ class SearchFilter(object):
         """
         return []
 
+    def conditions(self, terms, statistics):
+        """Yield a ``Condition`` for each of the conditions ``filter()``
+        would.
+
+        Override this to tell the planner what the conditions cost and how
+        many files they might match. By default, they're assumed to be
+        middling subqueries matching who knows how many files.
+
+        :arg statistics: The DB's statistics, as returned by
+            ``Query._statistics()``
+
+        """
+        for conds, args, exts in self.filter(terms):
+            yield Condition(conds, args, exts)
+
     def extents(self, terms, execute_sql, file_id):
         """Return an ordered iterable of extents to highlight. Or an iterable
         of generators. It seems to vary.
@@ -439,6 +782,18 @@ class SearchFilter(object):
         """
         return []
 
+    def extents_for_files(self, terms, execute_sql, file_ids):
+        """Return a dict of file IDs to what ``extents()`` would return for
+        each of the given files.
+
+        Override this to fetch the extents for a whole page of results in a
+        few queries rather than a few per file. By default, it just calls
+        ``extents()`` for each file.
+
+        """
+        return dict((file_id, list(self.extents(terms, execute_sql, file_id)))
+                    for file_id in file_ids)
+
     def names(self):
         """Return a list of filter names this filter handles.
 
@@ -462,6 +817,7 @@ class SearchFilter(object):
 
 class TriLiteSearchFilter(SearchFilter):
     params = ['text', 'regexp']
+    needs_contents = True
 
     def filter(self, terms):
         not_conds = []
@@ -479,7 +835,7 @@ class TriLiteSearchFilter(SearchFilter):
                                                else 'isubstr-extents:') +
                             term['arg']],
                            True)
-        for term in terms.get('re', []) + terms.get('regexp', []):
+        for term in chain(terms.get('re', []), terms.get('regexp', [])):
             if term['arg']:
                 if term['not']:
                     not_conds.append("trg_index.contents MATCH ?")
@@ -495,6 +851,12 @@ class TriLiteSearchFilter(SearchFilter):
                    not_args,
                    False)
 
+    def conditions(self, terms, statistics):
+        for conds, args, exts in self.filter(terms):
+            # A positive MATCH is handed to the trigram index itself. A NOT
+            # IN has to consult the index for every file.
+            yield Condition(conds, args, exts, cost=0 if exts else 2)
+
     # Notice that extents is more efficiently handled in the search query
     # Sorry to break the pattern, but it's significantly faster.
 
@@ -532,6 +894,10 @@ class SimpleFilter(SearchFilter):
             else:
                 yield self.filter_sql, self.formatter(arg), self.ext_sql is not None
 
+    def conditions(self, terms, statistics):
+        for conds, args, exts in self.filter(terms):
+            yield Condition(conds, args, exts, cost=0)
+
     def extents(self, terms, execute_sql, file_id):
         if self.ext_sql:
             for term in terms.get(self.param, []):
@@ -559,36 +925,123 @@ class ExistsLikeFilter(SearchFilter):
         self.param = param
         self.filter_sql = filter_sql
         self.ext_sql = ext_sql
+        if ext_sql:
+            # ext_sql for many files at once: select the file ID as well, and
+            # leave a %s for a list of them.
+            alias = _file_id_param.search(ext_sql).group(1)
+            self.batch_ext_sql = _select.sub(
+                'SELECT %s.file_id, ' % alias,
+                _file_id_param.sub(r'\1.file_id IN (%%s)', ext_sql, 1),
+                1)
         self.qual_expr = " %s = ? " % qual_name
         self.like_expr = """ %s LIKE ? ESCAPE "\\" """ % like_name
 
-    def filter(self, terms):
+        # filter_sql turned around to select the matching files' IDs, for
+        # the planner to start from:
+        correlation = _file_id_correlation.search(filter_sql)
+        self.driver_sql = correlation and _select_1.sub(
+            'SELECT %s.file_id' % correlation.group(1),
+            _file_id_correlation.sub('', filter_sql, 1),
+            1)
+
+        # The index whose statistics tell how many rows match a name:
+        alias, column = qual_name.split('.')
+        self.index_name = '%s_%s_index' % (self._table(alias), column)
+
+        # like_name turned into a lookup in the symbol name index, with a %s
+        # for the SQL selecting the matching names' IDs:
+        alias, column = like_name.split('.')
+        self.name_expr = column == 'name' and (
+            " %s.id IN (SELECT symbols.id FROM symbols "
+            "WHERE symbols.tbl = '%s' AND symbols.name_id IN (%%s)) "
+            % (alias, self._table(alias)))
+
+    def _table(self, alias):
+        """Return the name of the table a name in filter_sql refers to."""
+        table = re.search(r'(\w+)\s+as\s+%s\b' % alias, self.filter_sql,
+                          re.I)
+        return table.group(1) if table else alias
+
+    def _expression(self, term, use_name_index=False):
+        """Return the SQL expression to put in place of the %s in filter_sql
+        or ext_sql to match a term, and its arguments.
+
+        :arg use_name_index: Whether to find unqualified names through the
+            symbol name index rather than by scanning with LIKE
+
+        """
+        arg = term['arg']
+        if term['qualified']:
+            return self.qual_expr, [arg]
+        if use_name_index and self.name_expr:
+            names_sql, args = _name_ids_sql(like_escape(arg))
+            return self.name_expr % names_sql, args
+        return self.like_expr, [like_escape(arg)]
+
+    def filter(self, terms, use_name_index=False):
         for term in terms.get(self.param, []):
-            is_qualified = term['qualified']
-            arg = term['arg']
-            filter_sql = (self.filter_sql % (self.qual_expr if is_qualified
-                                             else self.like_expr))
-            sql_params = [arg if is_qualified else like_escape(arg)]
+            sql_expr, sql_params = self._expression(term, use_name_index)
+            filter_sql = self.filter_sql % sql_expr
             if term['not']:
                 yield 'NOT EXISTS (%s)' % filter_sql, sql_params, False
             else:
                 yield 'EXISTS (%s)' % filter_sql, sql_params, self.ext_sql is not None
 
+    def conditions(self, terms, statistics):
+        stats = statistics.get(self.index_name)
+        use_name_index = _NAME_INDEX in statistics
+        for term, (conds, args, exts) in zip(
+                terms.get(self.param, []),
+                self.filter(terms, use_name_index)):
+            if term['not']:
+                # Negative terms rule out few files and can't be started
+                # from, so they go last.
+                yield Condition(conds, args, exts, cost=2)
+                continue
+            rows = None
+            if stats and len(stats) >= 2:
+                rows_in_table, rows_per_name = stats[:2]
+                # Wildcards can match any number of names. Guess.
+                rows = (rows_in_table // _WILDCARD_FRACTION
+                        if not term['qualified'] and _has_wildcard(term['arg'])
+                        else rows_per_name)
+            yield Condition(
+                conds, args, exts, rows=rows,
+                driver=self.driver_sql and
+                       self.driver_sql %
+                           self._expression(term, use_name_index)[0])
+
     def extents(self, terms, execute_sql, file_id):
         def builder():
             for term in terms.get(self.param, []):
-                arg = term['arg']
-                escaped_arg, sql_expr = (
-                    (arg, self.qual_expr) if term['qualified']
-                    else (like_escape(arg), self.like_expr))
+                sql_expr, args = self._expression(term)
                 for start, end in execute_sql(self.ext_sql % sql_expr,
-                                              [file_id, escaped_arg]):
+                                              [file_id] + args):
                     # Nones used to occur in the DB. Is this still true?
                     if start and end:
                         yield start, end, []
         if self.ext_sql:
             yield builder()
 
+    def extents_for_files(self, terms, execute_sql, file_ids):
+        if not self.ext_sql:
+            return {}
+        extents = dict((file_id, []) for file_id in file_ids)
+        for term in terms.get(self.param, []):
+            sql_expr, args = self._expression(term)
+            sql = self.batch_ext_sql % sql_expr
+            # Stay under SQLite's limit of 999 parameters:
+            for i in xrange(0, len(file_ids), _FILES_PER_QUERY):
+                some_ids = file_ids[i:i + _FILES_PER_QUERY]
+                for file_id, start, end in execute_sql(
+                        sql % ', '.join(['?'] * len(some_ids)),
+                        some_ids + args):
+                    # Nones used to occur in the DB. Is this still true?
+                    if start and end:
+                        extents[file_id].append((start, end, []))
+        return dict((file_id, [iter(hits)])
+                    for file_id, hits in extents.iteritems())
+
 
 class UnionFilter(SearchFilter):
     """Provides a filter matching the union of the given filters.
@@ -611,6 +1064,20 @@ class UnionFilter(SearchFilter):
                    [arg for (conds, args, exts) in res for arg in args],
                    any(exts for (conds, args, exts) in res))
 
+    def conditions(self, terms, statistics):
+        for res in zip(*(filt.conditions(terms, statistics)
+                         for filt in self.filters)):
+            known = all(c.rows is not None for c in res)
+            drivable = all(c.driver is not None for c in res)
+            yield Condition(
+                '(' + ' OR '.join(c.sql for c in res) + ')',
+                [arg for c in res for arg in c.args],
+                any(c.has_extents for c in res),
+                cost=max(c.cost for c in res),
+                rows=sum(c.rows for c in res) if known else None,
+                driver=' UNION '.join(c.driver for c in res)
+                       if drivable else None)
+
     def extents(self, terms, execute_sql, file_id):
         def builder():
             for filt in self.filters:
@@ -622,6 +1089,18 @@ class UnionFilter(SearchFilter):
                 yield hits[0]
         yield sorter()
 
+    def extents_for_files(self, terms, execute_sql, file_ids):
+        extents_by_filter = [
+            filt.extents_for_files(terms, execute_sql, file_ids)
+            for filt in self.filters]
+        extents = {}
+        for file_id in file_ids:
+            hits = sorted(hit for extents_by_file in extents_by_filter
+                              for stream in extents_by_file.get(file_id, [])
+                              for hit in stream)
+            extents[file_id] = [iter([hit for hit, _ in groupby(hits)])]
+        return extents
+
 
 # Register filters by adding them to this list:
 filters = [
@@ -1390,6 +1869,37 @@ class QueryVisitor(NodeVisitor):
         return visited_children or node
 
 
+class FrozenDict(dict):
+    """A dict which refuses to be changed"""
+
+    def _refuse(self, *args, **kwargs):
+        raise TypeError('This dict is shared and must not be changed.')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = \
+        _refuse
+
+
+# Recently parsed queries, so the live search's request per keystroke
+# doesn't have to parse the same strings over and over:
+_parsed_queries = LRUCache(1000)
+
+
+def parsed_terms(querystr, is_case_sensitive):
+    """Return the terms of a query string, as a read-only version of what
+    ``QueryVisitor`` returns: a ``FrozenDict`` of tuples of ``FrozenDict``\s.
+
+    """
+    key = querystr, is_case_sensitive
+    terms = _parsed_queries.get(key)
+    if terms is None:
+        visited = QueryVisitor(is_case_sensitive=is_case_sensitive).visit(
+            query_grammar.parse(querystr))
+        terms = FrozenDict((name, tuple(FrozenDict(term) for term in terms))
+                           for name, terms in visited.iteritems())
+        _parsed_queries.put(key, terms)
+    return terms
+
+
 def filter_menu_items(language):
     """Return the additional template variables needed to render filter.html."""
     return (f.menu_item() for f in filters if f.valid_for_language(language))
@@ -58,6 +58,7 @@ class SchemaTable(object):
         self.columns = []
         self.needLang = False
         self.needFileKey = False
+        self._insert_sql = None
         defaults = ['VARCHAR(256)', True]
         for col in tblschema:
             if isinstance(tblschema, tuple) or isinstance(tblschema, list):
@@ -124,17 +125,18 @@ class SchemaTable(object):
         return sql
 
     def get_insert_sql(self, args):
-        colset = set(col[0] for col in self.columns)
-        unwanted = []
-
-        # Only add the keys in the columns
-        for key in args.iterkeys():
-            if key not in colset:
-                unwanted.append(key)
-
-        for key in unwanted:
-            del args[key]
-
-        return ('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' %
-                        (self.name, ','.join(args.keys()), ','.join('?' for k in range(0, len(args)))),
-                        args.values())
+        """Return (SQL, parameters) for inserting a row made of the values in
+        ``args`` that are columns of this table.
+
+        The SQL always names every column (absent ones get NULL), so it's the
+        same string for every row of the table. It's built only once, and
+        rows can be grouped by it and inserted with ``executemany()``.
+
+        """
+        if self._insert_sql is None:
+            names = [col for col, _ in self.columns]
+            self._insert_sql = ('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' %
+                                (self.name,
+                                 ','.join(names),
+                                 ','.join('?' * len(names))))
+        return self._insert_sql, [args.get(col) for col, _ in self.columns]
@@ -25,6 +25,26 @@ $(function() {
         }
     }
 
+    // The page's table of menus, if it has one, parsed on first use
+    var menuTable = null;
+
+    /**
+     * Return the menu items of a symbol's link, which carries either the
+     * items themselves or their index in the page's table of menus.
+     *
+     * @param {object} link - The link of the symbol.
+     */
+    function menuOf(link) {
+        var index = link.data('menu-id');
+        if (index === undefined) {
+            return link.data('menu');
+        }
+        if (menuTable === null) {
+            menuTable = JSON.parse($('#menus').text());
+        }
+        return menuTable[index];
+    }
+
     /**
      * Populates the context menu template, positions and shows
      * the widget. Also attached required listeners.
@@ -145,8 +165,7 @@ $(function() {
             if (currentNode.length) {
                 toggleSymbolHighlights(currentNode);
 
-                var currentNodeData = currentNode.data('menu');
-                menuItems = menuItems.concat(currentNodeData);
+                menuItems = menuItems.concat(menuOf(currentNode));
             }
 
             contextMenu.menuItems = menuItems;
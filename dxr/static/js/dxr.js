@@ -140,6 +140,7 @@ $(function() {
         didScroll = false,
         resultCount = 0,
         dataOffset = 0,
+        nextToken = '', // Continuation token for fetching the page after the last one shown
         previousDataLimit = 0,
         defaultDataLimit = 100;
 
@@ -173,8 +174,10 @@ $(function() {
      * @param {bool} isCaseSensitive - Whether the query should be case-sensitive
      * @param {int} limit - The number of results to return.
      * @param [int] offset - The cursor position
+     * @param [string] after - A continuation token from the previous page,
+     *     which takes precedence over the offset
      */
-    function buildAjaxURL(query, isCaseSensitive, limit, offset) {
+    function buildAjaxURL(query, isCaseSensitive, limit, offset, after) {
         var search = dxr.searchUrl;
         var params = {};
         params.q = query;
@@ -182,7 +185,11 @@ $(function() {
         params.format = 'json';
         params['case'] = isCaseSensitive;
         params.limit = limit;
-        params.offset = offset;
+        if (after) {
+            params.after = after;
+        } else {
+            params.offset = offset;
+        }
 
         return search + '?' + $.param(params);
     }
@@ -239,6 +246,8 @@ $(function() {
             if (previousDataLimit === 0) {
                 previousDataLimit = stateConstants.data('limit');
                 resultCount = stateConstants.data('result-count');
+                // Use attr() so jQuery doesn't helpfully turn it into a number:
+                nextToken = stateConstants.attr('data-next');
             }
 
             var maxScrollY = getMaxScrollY(),
@@ -258,7 +267,7 @@ $(function() {
                 previousDataLimit = defaultDataLimit;
 
                 //Resubmit query for the next set of results.
-                $.getJSON(buildAjaxURL(query, caseSensitiveBox.prop('checked'), defaultDataLimit, dataOffset), function(data) {
+                $.getJSON(buildAjaxURL(query, caseSensitiveBox.prop('checked'), defaultDataLimit, dataOffset, nextToken), function(data) {
                     if (data.results.length > 0) {
                         var state = {};
 
@@ -316,6 +325,7 @@ $(function() {
         data.tree = dxr.tree;
         data.top_of_tree = dxr.wwwroot + '/' + data.tree + '/source/';
         data.trees = data.trees;
+        nextToken = data.next;
 
         var params = {
             q: data.query,
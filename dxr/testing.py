@@ -162,6 +162,10 @@ class SingleFileTestCase(TestCase):
     # print its path so you can examine it:
     should_delete_instance = True
 
+    # Extra lines for the tree's section of the config file, like plugin
+    # options:
+    tree_config = ''
+
     @classmethod
     def setup_class(cls):
         """Create a temporary DXR instance on the FS, and build it."""
@@ -181,7 +185,9 @@ nb_jobs = 4
 source_folder = {config_dir_path}/code
 object_folder = {config_dir_path}/code
 build_command = $CXX -o main main.cpp
-""".format(config_dir_path=cls._config_dir_path))
+{tree_config}
+""".format(config_dir_path=cls._config_dir_path,
+           tree_config=cls.tree_config))
 
         chdir(cls._config_dir_path)
         run('dxr-build.py')
@@ -12,12 +12,17 @@ ctypes.CDLL('libtrilite.so').load_trilite_extension()
 import os
 from os import dup
 from os.path import join
+import re
+from Queue import Empty, Full, Queue
+from threading import Lock
 import jinja2
 import sqlite3
 import string
 from sys import stdout
 from urllib import quote, quote_plus
 
+from ordereddict import OrderedDict
+
 
 TEMPLATE_DIR = 'static/templates'
 
@@ -79,6 +84,25 @@ def non_negative_int(s, default):
     return default
 
 
+# The Content-Encodings HTML pages can be stored pre-compressed in, in order of
+# preference, and the suffixes of the files holding them
+PRECOMPRESSED_SUFFIXES = OrderedDict([('br', '.br'), ('gzip', '.gz')])
+
+
+_ascii_uppercase = re.compile('[A-Z]+')
+
+
+def ascii_lower(text):
+    """Lowercase the ASCII letters in a string, as SQLite's ``lower()`` and
+    LIKE do, leaving any others alone."""
+    return _ascii_uppercase.sub(lambda m: m.group().lower(), text)
+
+
+def trigrams(text):
+    """Return the set of 3-character substrings of a string."""
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
 def search_url(www_root, tree, query, **query_string_params):
     """Return the URL to the search endpoint."""
     ret = '%s/%s/search?q=%s' % (www_root,
@@ -103,15 +127,169 @@ def browse_url(tree, www_root, path):
     # search_url().
 
 
-def connect_db(dir):
+def connect_db(dir, **kwargs):
     """Return the database connection for a tree.
 
     :arg dir: The directory containing the .dxr-xref.sqlite file
 
+    Other kwargs are passed along to ``sqlite3.connect()``.
+
     """
-    conn = sqlite3.connect(join(dir, ".dxr-xref.sqlite"))
+    conn = sqlite3.connect(join(dir, ".dxr-xref.sqlite"), **kwargs)
     conn.text_factory = str
     conn.execute("PRAGMA synchronous=off")
     conn.execute("PRAGMA page_size=32768")
     conn.row_factory = sqlite3.Row
     return conn
+
+
+class _PooledConnection(sqlite3.Connection):
+    """A connection which remembers which DB file it was opened on, and the
+    statistics ``Query`` read out of it"""
+    identity = None
+    statistics = None  # (schema version, statistics)
+
+
+class ConnectionPool(object):
+    """A bounded pool of reusable connections to one tree's database
+
+    Opening a connection means opening the file, running PRAGMAs, and, for
+    each statement, compiling it anew, so we keep up to ``max_size`` idle
+    connections around between requests. Each connection keeps a cache of
+    the last ``cached_statements`` statements it prepared, so the SQL that
+    ``Query`` generates over and over gets compiled only once per connection.
+
+    Connections are checked for health as they come out of the pool: if the
+    database has been replaced by a rebuild or the connection no longer
+    works, it's thrown away and a new one is opened.
+
+    """
+    def __init__(self, dir, max_size=8, cached_statements=200):
+        """
+        :arg dir: The directory containing the .dxr-xref.sqlite file
+        :arg max_size: The most idle connections to keep around. More can be
+            open at once under heavy load; the extras are closed when they're
+            given back.
+        :arg cached_statements: The number of prepared statements each
+            connection keeps
+
+        """
+        self.dir = dir
+        self.cached_statements = cached_statements
+        self._idle = Queue(max_size)
+
+    def get(self):
+        """Return a healthy connection from the pool, opening a new one if
+        none is idle."""
+        while True:
+            try:
+                conn, identity = self._idle.get_nowait()
+            except Empty:
+                return self._connect()
+            if self._is_healthy(conn, identity):
+                return conn
+            conn.close()
+
+    def put(self, conn):
+        """Give a connection back to the pool, or close it if the pool is
+        full."""
+        try:
+            conn.rollback()
+            self._idle.put_nowait((conn, conn.identity))
+        except (Full, sqlite3.Error):
+            conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+
+    def _connect(self):
+        # Note which file we opened before opening it, so a rebuild that
+        # swaps the file out from under us between the two can only make us
+        # throw away a healthy connection, never keep a stale one.
+        identity = self._file_identity()
+        conn = connect_db(self.dir,
+                          factory=_PooledConnection,
+                          check_same_thread=False,
+                          cached_statements=self.cached_statements)
+        conn.identity = identity
+        return conn
+
+    def _file_identity(self):
+        """Return something that changes when the DB is replaced, or None if
+        there is no DB."""
+        try:
+            info = os.stat(join(self.dir, '.dxr-xref.sqlite'))
+        except OSError:
+            return None
+        return info.st_dev, info.st_ino
+
+    def version(self):
+        """Return something that changes whenever the DB is written to, even
+        in place, as by an incremental build, or None if there is no DB.
+
+        Modification times can be too coarse to tell two quick writes apart,
+        so this includes the file change counter from the DB's header, which
+        SQLite bumps on every commit (outside WAL mode, which we don't use).
+
+        """
+        try:
+            with open(join(self.dir, '.dxr-xref.sqlite'), 'rb') as db:
+                info = os.fstat(db.fileno())
+                db.seek(24)
+                change_counter = db.read(4)
+        except (IOError, OSError):
+            return None
+        return (info.st_dev, info.st_ino, info.st_mtime, info.st_size,
+                change_counter)
+
+    def _is_healthy(self, conn, identity):
+        if identity is None or identity != self._file_identity():
+            return False
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+
+class LRUCache(object):
+    """A bounded, thread-safe mapping which forgets its least recently used
+    items once it's full"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the value for ``key``, and mark it as most recently used. If
+        it isn't there, return ``default``."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used one if there's no
+        room."""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
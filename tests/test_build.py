@@ -1,16 +1,18 @@
 """Tests for the machinery that takes offsets and markup bits from plugins and
 decorates source code with them to create HTML"""
 
+import json
 from unittest import TestCase
 import warnings
 from warnings import catch_warnings
 
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
 from dxr.build import (line_boundaries, remove_overlapping_refs, Region, LINE,
                        Ref, balanced_tags, build_lines, tag_boundaries,
                        html_lines, nesting_order, balanced_tags_with_empties,
-                       lines_and_annotations)
+                       lines_and_annotations, line_count, MenuTable,
+                       sparse_annotations)
 
 
 def test_line_boundaries():
@@ -24,6 +26,14 @@ def test_line_boundaries():
          (16, False)])
 
 
+def test_line_count():
+    """Make sure ``line_count()`` agrees with the number of lines
+    ``build_lines()`` makes, so the gutter lines up with the code."""
+    for text in ['', 'abc', 'abc\n', '\n\n', 'abc\ndef\r\nghi\rjkl',
+                 'a\r\n\r\n', 'a\n\rb']:
+        eq_(line_count(text), len(list(build_lines(text, []))))
+
+
 class RemoveOverlappingTests(TestCase):
     def test_misbalanced(self):
         """Make sure we cleanly excise a tag pair from a pair of interleaved
@@ -283,6 +293,16 @@ class AnnotationsTests(TestCase):
              ('three', [{'e': 'f'}]),
              ('four', [])])
 
+    def test_sparse(self):
+        """Make sure sparse annotations come out grouped by line, without
+        entries for unannotated lines."""
+        h1 = Htmlifier(annotations=[(1, {'a': 'b'}), (6, {'g': 'h'})])
+        h2 = Htmlifier(annotations=[(1, {'c': 'd'}), (3, {'e': 'f'})])
+        eq_(sparse_annotations([h1, h2]),
+            [(1, [{'a': 'b'}, {'c': 'd'}]),
+             (3, [{'e': 'f'}]),
+             (6, [{'g': 'h'}])])
+
     def test_none(self):
         """If there are no annotations, or if the annotations run short of the
         lines, don't stop emitting lines."""
@@ -336,3 +356,39 @@ class IntegrationTests(TestCase):
         """
         list(build_lines('hello!',
                          [Htmlifier(regions=[(3, 3, 'a'), (3, 5, 'b')])]))
+
+    def test_menu_table(self):
+        """With a menu table, links should refer to each distinct menu by its
+        index, and the table should hold each once."""
+        table = MenuTable()
+        eq_(list(build_lines('a b a',
+                             [Htmlifier(refs=[(0, 1, (['</script>'], '', None)),
+                                              (2, 3, (['b'], '', None)),
+                                              (4, 5, (['</script>'], '', None))])],
+                             menu_table=table)),
+            [u'<a data-menu-id="0">a</a> <a data-menu-id="1">b</a> '
+             u'<a data-menu-id="0">a</a>'])
+        eq_(table.json(), '[["\\u003c/script>"],["b"]]')
+
+    def test_menu_table_escaping(self):
+        """The menu table should escape anything that could end or confuse
+        its <script> element and still parse as the same JSON."""
+        table = MenuTable()
+        menus = [[u'<!--'], [u'<b>'], [u'a\u2028b\u2029c']]
+        for menu in menus:
+            table.index(menu)
+        text = table.json()
+        ok_('<' not in text)
+        ok_(u'\u2028' not in text and u'\u2029' not in text)
+        eq_(json.loads(text), menus)
+
+
+def test_ref_menu_reuse():
+    """A menu shared among refs should come out the same every time, and a
+    different menu shouldn't be mistaken for it."""
+    menu = [{'html': 'Find references', 'href': '/search?q=a&b'}]
+    first = Ref((menu, 'a', None)).opener()
+    eq_(Ref((menu, 'a', None)).opener(), first)
+    ok_('&amp;' in first)
+    other = Ref(([{'html': 'Jump to file'}], '', None)).opener()
+    ok_('Jump to file' in other and 'Find references' not in other)
@@ -0,0 +1,45 @@
+"""Tests that the clang plugin's CSV and binary output formats index the same
+things"""
+
+from dxr.testing import SingleFileTestCase
+
+
+class CsvOutputTests(SingleFileTestCase):
+    """Tests for a build with the default, CSV output of the clang plugin"""
+
+    source = r"""
+        struct Point
+        {
+            int x;
+        };
+
+        int square(int n)
+        {
+            return n * n;
+        }
+
+        int main()
+        {
+            Point p;
+            p.x = square(3);
+            return p.x;
+        }
+        """
+
+    def test_type(self):
+        self.found_line_eq('type:Point', 'struct <b>Point</b>', 2)
+
+    def test_function(self):
+        self.found_line_eq('function:square', 'int <b>square</b>(int n)', 7)
+
+    def test_callers(self):
+        self.found_line_eq('callers:square', 'int <b>main</b>()', 12)
+
+    def test_member(self):
+        self.found_line_eq('+var:Point::x', 'int <b>x</b>;', 4)
+
+
+class BinaryOutputTests(CsvOutputTests):
+    """Tests for the same build with the binary output of the clang plugin"""
+
+    tree_config = 'plugin_clang_binary_output = 1'
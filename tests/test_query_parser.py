@@ -3,9 +3,9 @@
 
 from unittest import TestCase
 
-from nose.tools import eq_
+from nose.tools import assert_raises, eq_, ok_
 
-from dxr.query import query_grammar, QueryVisitor
+from dxr.query import parsed_terms, query_grammar, Query, QueryVisitor
 
 
 class VisitorTests(TestCase):
@@ -168,3 +168,22 @@ def test_quotes():
                 eq_(QueryVisitor().visit(rule.match(transform(input))),
                     transform(output))
             yield test_something
+
+
+def test_cache_key():
+    """Queries differing only in term order or spacing should share a cache
+    key; ones differing in case sensitivity should not."""
+    def key(query, is_case_sensitive=True):
+        return Query(None, query, is_case_sensitive=is_case_sensitive).cache_key()
+    eq_(key('function:main  hello'), key('hello function:main'))
+    ok_(key('hello') != key('hello', is_case_sensitive=False))
+    ok_(key('hello') != key('-hello'))
+
+
+def test_parsed_terms():
+    """Parses should be shared, so they had better be read-only."""
+    terms = parsed_terms('function:main hello', False)
+    ok_(parsed_terms('function:main hello', False) is terms)
+    eq_(terms['function'][0]['arg'], 'main')
+    assert_raises(TypeError, terms.__setitem__, 'text', [])
+    assert_raises(TypeError, terms['text'][0].update, {'not': True})
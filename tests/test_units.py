@@ -1,10 +1,27 @@
 """Unit tests that don't fit anywhere else"""
 
+import gzip
+import json
+import os
+from os.path import exists, join
+from shutil import rmtree
+import sqlite3
+from tempfile import mkdtemp
 from unittest import TestCase
 
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
-from dxr.build import linked_pathname
+from dxr.app import make_app, _page_archive
+from dxr.archive import append_pages, archive_path, page_locations, PageArchive
+from dxr.build import (_html_jobs, index_direct_hits, index_files,
+                       index_page_archive, index_symbol_names, linked_pathname,
+                       newline_offsets, start_page_archive,
+                       write_compressed_copies)
+from dxr.config import Config
+import dxr.languages
+from dxr.query import (_name_ids_sql, filters, _unpacked_offsets, fix_extents_overlap,
+                       like_escape, merge_extents, Query)
+from dxr.utils import _PooledConnection, ConnectionPool, LRUCache
 
 
 class LinkedPathnameTests(TestCase):
@@ -18,3 +35,522 @@ class LinkedPathnameTests(TestCase):
     def test_root_folder(self):
         """Make sure the root folder is treated correctly."""
         eq_(linked_pathname('', 'stuff'), [('/stuff/source', 'stuff')])
+
+
+def test_html_jobs():
+    """Make sure HTML jobs cover every file in a full build and only the
+    changed ones in an incremental one."""
+    eq_(list(_html_jobs(7, slice_size=3)),
+        [(1, 3, None), (4, 6, None), (7, 7, None)])
+    eq_(list(_html_jobs(100, [9, 2, 40, 5], slice_size=3)),
+        [(2, 9, [2, 5, 9]), (40, 40, [40])])
+    eq_(list(_html_jobs(100, [])), [])
+
+
+def test_newline_offsets():
+    """Newline offsets should round-trip through their packed form."""
+    eq_(list(_unpacked_offsets(newline_offsets('a\nbc\n\nd'))), [1, 4, 5])
+    eq_(list(_unpacked_offsets(newline_offsets('no newline'))), [])
+
+
+def test_highlit_lines_of_unread_files():
+    """Lines of files whose contents the page query didn't fetch should be
+    highlit from their stored contents and newlines, by byte offset."""
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(dxr.languages.language_schema.get_create_sql())
+    conn.execute('CREATE TABLE trg_index (id INTEGER PRIMARY KEY, text TEXT)')
+    text = u'int \xe9;\n\nint main() {}\n'
+    for id, path in [(1, 'a.c'), (2, 'b.c')]:
+        conn.execute("INSERT INTO files (id, path, icon, encoding) "
+                     "VALUES (?, ?, 'c', 'utf-8')", [id, path])
+        conn.execute('INSERT INTO trg_index (id, text) VALUES (?, ?)',
+                     [id, text])
+        conn.execute('INSERT INTO newlines (id, offsets) VALUES (?, ?)',
+                     [id, newline_offsets(text.encode('utf-8'))])
+        conn.execute("INSERT INTO functions (id, file_id, file_line, name, "
+                     "qualname, args, type, extent_start, extent_end) "
+                     "VALUES (?, ?, 3, 'main', 'main', '', '', 13, 17)",
+                     [id, id])
+    eq_(list(Query(conn, 'function:main').results()),
+        [('c', 'a.c', [(3, u'int <b>main</b>() {}')]),
+         ('c', 'b.c', [(3, u'int <b>main</b>() {}')])])
+
+
+def test_merge_extents():
+    """Extents starting at the same place should be split where the shorter
+    ends, and their keys combined."""
+    eq_(list(merge_extents(iter([(0, 4, ['a']), (6, 8, ['a'])]),
+                           iter([(0, 2, ['b']), (7, 9, ['b'])]),
+                           iter([]))),
+        [(0, 2, ['a', 'b']),
+         (2, 4, ['a']),
+         (6, 8, ['a']),
+         (7, 9, ['b'])])
+
+
+def test_fix_extents_overlap():
+    """Overlapping extents should be broken into non-overlapping pieces."""
+    eq_(list(fix_extents_overlap([(0, 4, ['a']), (2, 6, ['b']), (6, 7, ['c'])])),
+        [(0, 2, ['a']),
+         (2, 4, ['a', 'b']),
+         (4, 6, ['b']),
+         (6, 7, ['c'])])
+    eq_(list(fix_extents_overlap([])), [])
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+        open(join(self.folder, '.dxr-xref.sqlite'), 'w').close()
+        self.pool = ConnectionPool(self.folder, max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        rmtree(self.folder)
+
+    def test_reuse(self):
+        """Connections given back should be handed out again."""
+        conn = self.pool.get()
+        self.pool.put(conn)
+        ok_(self.pool.get() is conn)
+
+    def test_bounded(self):
+        """Only ``max_size`` idle connections should be kept."""
+        conns = [self.pool.get() for _ in range(3)]
+        for conn in conns:
+            self.pool.put(conn)
+        eq_(self.pool._idle.qsize(), 2)
+
+    def test_rebuilt(self):
+        """A connection to a DB which has since been replaced should be
+        thrown away."""
+        conn = self.pool.get()
+        self.pool.put(conn)
+        path = join(self.folder, '.dxr-xref.sqlite')
+        os.rename(path, path + '.old')
+        open(path, 'w').close()
+        ok_(self.pool.get() is not conn)
+
+
+def test_result_cache_in_place_update():
+    """Cached search results should be dropped when the DB is updated in
+    place, as by an incremental build."""
+    folder = mkdtemp()
+    try:
+        tree_folder = join(folder, 'trees', 'code')
+        os.makedirs(tree_folder)
+        with open(join(folder, 'config.py'), 'w') as config_file:
+            config_file.write("WWW_ROOT = ''\n"
+                              "DEFAULT_TREE = 'code'\n"
+                              "TREES = {'code': 'Code'}\n"
+                              "GENERATED_DATE = 'today'\n"
+                              "DIRECTORY_INDEX = '.dxr-directory-index.html'\n"
+                              "FILTER_LANGUAGE = 'C'\n")
+        conn = sqlite3.connect(join(tree_folder, '.dxr-xref.sqlite'))
+        conn.executescript(dxr.languages.language_schema.get_create_sql())
+        conn.execute("INSERT INTO files (id, path, icon, encoding) "
+                     "VALUES (1, 'old.c', 'c', 'utf-8')")
+        conn.commit()
+
+        client = make_app(folder).test_client()
+        def found():
+            return [result['path'] for result in json.loads(client.get(
+                '/code/search?q=path:.c&format=json&redirect=false').data)
+                ['results']]
+        eq_(found(), ['old.c'])
+
+        conn.execute("INSERT INTO files (id, path, icon, encoding) "
+                     "VALUES (2, 'new.c', 'c', 'utf-8')")
+        conn.commit()
+        conn.close()
+        eq_(found(), ['new.c', 'old.c'])
+    finally:
+        rmtree(folder)
+
+
+def test_lru_cache():
+    """The least recently used item should be the one evicted."""
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    eq_(cache.get('a'), 1)  # so 'b' is now the oldest
+    cache.put('c', 3)
+    eq_(cache.get('b'), None)
+    eq_(cache.get('a'), 1)
+    eq_(cache.get('c'), 3)
+    eq_(len(cache), 2)
+
+
+def test_symbol_name_index():
+    """Looking names up in the symbol name index should find the same ones
+    as LIKE, whatever the wildcards and case."""
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.executescript(dxr.languages.language_schema.get_create_sql())
+    names = ['main', 'Main', 'getElementById', 'get', 'a_b', 'a%b', 'ab']
+    for id, name in enumerate(names):
+        conn.execute("INSERT INTO functions (id, name, qualname, args, type) "
+                     "VALUES (?, ?, ?, '', '')", [id, name, name])
+    index_symbol_names(conn)
+    for arg in ['MAIN', 'ma*', '*by*', '*el*by?d', 'a_b', 'a?b', '*b', '?',
+                'g*id', '*']:
+        sql, args = _name_ids_sql(like_escape(arg))
+        found = conn.execute(
+            'SELECT functions.id FROM functions JOIN symbols '
+            "ON symbols.tbl = 'functions' AND symbols.id = functions.id "
+            'WHERE symbols.name_id IN (%s) ORDER BY functions.id' % sql,
+            args).fetchall()
+        expected = conn.execute(
+            'SELECT id FROM functions WHERE name LIKE ? ESCAPE "\\" '
+            'ORDER BY id', [like_escape(arg)]).fetchall()
+        eq_([row[0] for row in found], [row[0] for row in expected])
+
+
+def test_direct_hits():
+    """Direct results should be the first kind of name that leads to just
+    one place."""
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.executescript(dxr.languages.language_schema.get_create_sql())
+    for id, path in enumerate(['a/main.c', 'b/main.c', 'b/Util.c']):
+        conn.execute("INSERT INTO files (id, path, encoding) "
+                     "VALUES (?, ?, 'utf-8')", [id, path])
+    for id, name, qualname, line in [(1, 'main', 'main', 3),
+                                     (2, 'Main', 'ns::Main(int)', 5),
+                                     (3, 'helper', 'ns::helper', 8)]:
+        conn.execute("INSERT INTO functions (id, file_id, file_line, name, "
+                     "qualname, args, type) VALUES (?, 2, ?, ?, ?, '', '')",
+                     [id, line, name, qualname])
+    index_direct_hits(conn)
+
+    def direct_result(query):
+        return Query(conn, query).direct_result()
+    eq_(direct_result('util.c'), ('b/Util.c', 1))
+    eq_(direct_result('b/main.c:7'), ('b/main.c', 7))
+    eq_(direct_result('main.c'), None)  # ambiguous, and no such function
+    eq_(direct_result('main'), ('b/Util.c', 3))  # case-sensitive wins
+    eq_(direct_result('MAIN'), None)
+    eq_(direct_result('NS::main'), ('b/Util.c', 5))
+    eq_(direct_result('Helper'), ('b/Util.c', 8))
+
+
+class CompressedCopiesTests(TestCase):
+    """Tests for the pre-compressed copies of pages"""
+
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.path = join(self.folder, 'main.c.html')
+        with open(self.path, 'w') as page:
+            page.write('<html>' * 100)
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def test_gzip(self):
+        """A gzipped copy should hold the same page."""
+        write_compressed_copies(self.path, ['gzip'])
+        eq_(gzip.open(self.path + '.gz').read(), '<html>' * 100)
+
+    def test_stale_copies(self):
+        """Copies in encodings no longer asked for should be removed."""
+        write_compressed_copies(self.path, ['gzip'])
+        write_compressed_copies(self.path, [])
+        ok_(not exists(self.path + '.gz'))
+
+
+class PageArchiveTests(TestCase):
+    """Tests for the packed archive of pages"""
+
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.path = join(self.folder, '.dxr-pages')
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def test_round_trip(self):
+        """Pages appended to an archive should be found and read back, even
+        ones appended after the archive was first mapped."""
+        append_pages(self.path, [('main.c.html', '<html>main'),
+                                 ('index.html', '<html>index')])
+        archive = PageArchive(self.path)
+        locations = list(page_locations(self.path))
+        eq_([(path, archive.page(offset, length)) for
+             path, offset, length in locations],
+            [('main.c.html', '<html>main'), ('index.html', '<html>index')])
+
+        start = os.stat(self.path).st_size
+        append_pages(self.path, [('main.c.html', '<html>new main')])
+        (path, offset, length), = page_locations(self.path, start)
+        eq_((path, archive.page(offset, length)),
+            ('main.c.html', '<html>new main'))
+
+    def test_truncated(self):
+        """Pages beyond the end of an emptied archive should come back as
+        None rather than failing to map it."""
+        append_pages(self.path, [('main.c.html', '<html>main')])
+        (_, offset, length), = page_locations(self.path)
+        archive = PageArchive(self.path)
+        eq_(archive.page(offset, length), '<html>main')
+        open(self.path, 'w').close()
+        eq_(archive.page(offset, length), None)
+        eq_(PageArchive(self.path).page(offset, length), None)
+
+    def test_removed(self):
+        """The server should stop using a tree's archive once it's removed or
+        emptied, and take up a new one written in its place."""
+        path = archive_path(self.folder)
+        append_pages(path, [('main.c.html', '<html>main')])
+        archive = _page_archive(self.folder)
+        ok_(archive is not None)
+        eq_(_page_archive(self.folder), archive)
+
+        os.remove(path)
+        eq_(_page_archive(self.folder), None)
+        open(path, 'w').close()
+        eq_(_page_archive(self.folder), None)
+
+        append_pages(path, [('main.c.html', '<html>new main')])
+        new_archive = _page_archive(self.folder)
+        ok_(new_archive not in [None, archive])
+
+
+def test_file_ids_stable():
+    """File IDs should follow a sorted walk of the tree, however many workers
+    read the folders."""
+    folder = mkdtemp()
+    try:
+        for path in ['x.c', 'c.c', 'b/q.c', 'b/a/r.c', 'a/y.h', 'a/b/d/f.c',
+                     'a/c/w.c']:
+            source_path = join(folder, 'src', path)
+            if not exists(os.path.dirname(source_path)):
+                os.makedirs(os.path.dirname(source_path))
+            with open(source_path, 'w') as source_file:
+                source_file.write('hello\n')
+
+        def file_paths(nb_jobs, disable_workers):
+            config_path = join(folder, 'dxr.config')
+            with open(config_path, 'w') as config_file:
+                config_file.write('[DXR]\n'
+                                  'target_folder=%(f)s/target\n'
+                                  'temp_folder=%(f)s/temp\n'
+                                  'nb_jobs=%(jobs)s\n'
+                                  'disable_workers=%(disable)s\n'
+                                  '[code]\n'
+                                  'source_folder=%(f)s/src\n'
+                                  'object_folder=%(f)s/src\n'
+                                  'build_command=make -j $jobs\n' %
+                                  dict(f=folder, jobs=nb_jobs,
+                                       disable=disable_workers))
+            config = Config(config_path)
+            tree = config.trees[0]
+            for needed in [config.temp_folder, tree.target_folder]:
+                if not exists(needed):
+                    os.makedirs(needed)
+            conn = sqlite3.connect(':memory:')
+            conn.executescript(dxr.languages.language_schema.get_create_sql())
+            # A plain stand-in for the trilite index:
+            conn.execute('CREATE TABLE trg_index (id INTEGER PRIMARY KEY, '
+                         'text TEXT)')
+            index_files(tree, conn)
+            return [path for path, in
+                    conn.execute('SELECT path FROM files ORDER BY id')]
+
+        expected = ['c.c', 'x.c', 'a/y.h', 'a/b/d/f.c', 'a/c/w.c', 'b/q.c',
+                    'b/a/r.c']
+        eq_(file_paths(1, '1'), expected)
+        eq_(file_paths(3, ''), expected)
+    finally:
+        rmtree(folder)
+
+
+def test_vanished_folder_listing():
+    """When a folder disappears, an incremental build should remove its
+    listing and the listing's compressed copies, whether they were written
+    out or packed."""
+    folder = mkdtemp()
+    try:
+        def build(pack_html, incremental):
+            config_path = join(folder, 'dxr.config')
+            with open(config_path, 'w') as config_file:
+                config_file.write('[DXR]\n'
+                                  'target_folder=%(f)s/target\n'
+                                  'temp_folder=%(f)s/temp\n'
+                                  'disable_workers=1\n'
+                                  'compress_html=gzip\n'
+                                  'pack_html=%(pack)s\n'
+                                  '[code]\n'
+                                  'source_folder=%(f)s/src\n'
+                                  'object_folder=%(f)s/src\n'
+                                  'build_command=make -j $jobs\n' %
+                                  dict(f=folder, pack=pack_html))
+            config = Config(config_path)
+            tree = config.trees[0]
+            for needed in [config.temp_folder, tree.target_folder]:
+                if not exists(needed):
+                    os.makedirs(needed)
+            start = start_page_archive(tree)
+            index_files(tree, conn, incremental=incremental)
+            if start is not None:
+                index_page_archive(tree, conn, start)
+            return tree
+
+        for pack_html in ['', '1']:
+            rmtree(folder)
+            for path in ['x.c', 'a/y.c']:
+                source_path = join(folder, 'src', path)
+                if not exists(os.path.dirname(source_path)):
+                    os.makedirs(os.path.dirname(source_path))
+                with open(source_path, 'w') as source_file:
+                    source_file.write('hello\n')
+            conn = sqlite3.connect(':memory:')
+            conn.executescript(dxr.languages.language_schema.get_create_sql())
+            # A plain stand-in for the trilite index:
+            conn.execute('CREATE TABLE trg_index (id INTEGER PRIMARY KEY, '
+                         'text TEXT)')
+
+            tree = build(pack_html, False)
+            listing = join('a', tree.config.directory_index)
+            listings = [listing, listing + '.gz']
+            if pack_html:
+                eq_(sorted(path for path, in conn.execute(
+                        'SELECT path FROM pages WHERE path LIKE "a/%"')),
+                    listings)
+            else:
+                ok_(all(exists(join(tree.target_folder, path))
+                        for path in listings))
+
+            rmtree(join(folder, 'src', 'a'))
+            build(pack_html, True)
+            eq_(conn.execute('SELECT path FROM pages WHERE path LIKE "a/%"')
+                    .fetchall(),
+                [])
+            ok_(not any(exists(join(tree.target_folder, path))
+                        for path in listings))
+    finally:
+        rmtree(folder)
+
+
+class PlannerTests(TestCase):
+    """Tests that planning a query never changes its results"""
+
+    def setUp(self):
+        self.conn = conn = sqlite3.connect(':memory:')
+        conn.text_factory = str
+        conn.row_factory = sqlite3.Row
+        conn.executescript(dxr.languages.language_schema.get_create_sql())
+        conn.executescript("""
+            CREATE TABLE trg_index (id INTEGER PRIMARY KEY, text TEXT);
+            CREATE TABLE typedefs (id INTEGER PRIMARY KEY, name, qualname,
+                                   extent_start, extent_end, file_id,
+                                   file_line, file_col);
+            CREATE TABLE callers (callerid, targetid);
+            CREATE TABLE targets (targetid, funcid);
+            """)
+        text = 'int x;\n'
+        for id in xrange(1, 41):
+            conn.execute("INSERT INTO files (id, path, encoding) "
+                         "VALUES (?, ?, 'utf-8')", [id, 'f%02d.c' % id])
+            conn.execute('INSERT INTO trg_index (id, text) VALUES (?, ?)',
+                         [id, text])
+            conn.execute('INSERT INTO newlines (id, offsets) VALUES (?, ?)',
+                         [id, newline_offsets(text)])
+        # (id, file ID, name, qualname)
+        for id, file_id, name, qualname in [
+                (1, 1, 'main', 'main'),
+                (2, 2, 'square', 'math::square'),
+                (3, 3, 'Square', 'geom::Square'),
+                (4, 3, 'helper', 'helper'),
+                (5, 4, 'get_thing', 'get_thing'),
+                (6, 5, 'main', 'other::main'),
+                (7, 6, 'call_all', 'call_all')]:
+            conn.execute("INSERT INTO functions (id, file_id, file_line, name, "
+                         "qualname, args, type, extent_start, extent_end) "
+                         "VALUES (?, ?, 1, ?, ?, '', '', 4, 5)",
+                         [id, file_id, name, qualname])
+        conn.executemany('INSERT INTO callers (callerid, targetid) '
+                         'VALUES (?, ?)',
+                         [(1, 2), (4, 5), (7, 100)])
+        conn.executemany('INSERT INTO targets (targetid, funcid) '
+                         'VALUES (?, ?)',
+                         [(100, 2), (100, 3)])
+        conn.execute("INSERT INTO types (id, file_id, file_line, name, "
+                     "qualname, extent_start, extent_end) "
+                     "VALUES (1, 7, 1, 'Point', 'geom::Point', 4, 5)")
+        conn.execute("INSERT INTO typedefs (id, file_id, file_line, name, "
+                     "qualname, extent_start, extent_end) "
+                     "VALUES (1, 8, 1, 'point_t', 'point_t', 4, 5)")
+        index_symbol_names(conn)
+
+    queries = ['function:main', 'function:*ai*', '-function:main',
+               'function:main -function:other::main', '+function:math::square',
+               'function:s* -path:f03', 'callers:square', 'callers:Square',
+               '-callers:*q*', 'type:point*', 'type:Point function:main',
+               'path:f0 -type:Point', 'function:nothing']
+
+    def unplanned_paths(self, query):
+        """Return the paths a query should find, running the conditions the
+        filters make on their own, in order, with no planning."""
+        terms = Query(self.conn, query).terms
+        conditions, arguments = [], []
+        for f in filters:
+            for sql, args, _ in f.filter(terms):
+                conditions.append(sql)
+                arguments += args
+        return [path for path, in self.conn.execute(
+            'SELECT path FROM files WHERE %s ORDER BY path' %
+                ' AND '.join(conditions),
+            arguments)]
+
+    def planned_paths(self, query):
+        """Return the paths ``Query.results()`` finds, and the plan."""
+        query = Query(self.conn, query)
+        return ([path for _, path, _ in query.results(limit=100)],
+                ' '.join(query._plan))
+
+    def check_queries(self, should_drive=None):
+        """Check that every query finds what it should, and, if
+        ``should_drive`` isn't None, whether any turned a condition around to
+        drive the query."""
+        drove = False
+        for query in self.queries:
+            paths, plan = self.planned_paths(query)
+            eq_(paths, self.unplanned_paths(query), msg=query)
+            drove = drove or 'drives the query' in plan
+        if should_drive is not None:
+            eq_(drove, should_drive)
+
+    def test_no_statistics(self):
+        """Without ``sqlite_stat1``, conditions are only reordered."""
+        self.check_queries(should_drive=False)
+
+    def test_statistics(self):
+        """With real statistics, the name index gets used, and the planner
+        may drive from the rarest symbols."""
+        self.conn.execute('ANALYZE')
+        ok_('symbol_names_name_index' in Query(self.conn, '')._statistics())
+        self.check_queries()
+
+    def test_driving(self):
+        """When the files vastly outnumber the matches, the planner should
+        start from the matching symbols and still find the same files."""
+        self.conn.execute('ANALYZE')
+        self.conn.execute("UPDATE sqlite_stat1 SET stat = '1000000 1' "
+                          "WHERE idx = 'files_path_index'")
+        self.check_queries(should_drive=True)
+
+
+def test_statistics_cache():
+    """Pooled connections should keep their statistics until the schema
+    changes."""
+    conn = sqlite3.connect(':memory:', factory=_PooledConnection)
+    conn.execute('CREATE TABLE files (path TEXT)')
+    conn.execute('CREATE INDEX files_path_index ON files (path)')
+    conn.execute("INSERT INTO files (path) VALUES ('a.c')")
+    eq_(Query(conn, '')._statistics(), {})
+    conn.execute('ANALYZE')
+    eq_(Query(conn, '')._statistics(), {'files_path_index': [1, 1]})
+    conn.execute("UPDATE sqlite_stat1 SET stat = '5 5'")
+    eq_(Query(conn, '')._statistics(), {'files_path_index': [1, 1]})
+    conn.execute('CREATE TABLE more (x)')
+    eq_(Query(conn, '')._statistics(), {'files_path_index': [5, 5]})